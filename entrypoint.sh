@@ -6,6 +6,13 @@ cleanup() {
 
 trap cleanup SIGINT SIGTERM
 
+# in daemon mode, process_mails keeps running and waits for new emails itself
+for arg in "$@"; do
+  if [ "$arg" = "--daemon" ]; then
+    exec /home/imio/bin/process_mails "$@"
+  fi
+done
+
 while true; do
   /home/imio/bin/process_mails "$@"
   sleep 60
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# bin/runpy scripts/bench_images.py
+"""Compare main.transform_image, decoding jpeg images at a reduced scale, with the previous full decoding and BICUBIC
+resize. Each run is done in a new process, whose peak memory is read in /proc (linux only)."""
+from concurrent.futures import ProcessPoolExecutor
+from imio.email.dms.main import transform_image
+from imio.email.dms.utils import get_reduced_size
+from io import BytesIO
+from PIL import Image
+from PIL import ImageOps
+
+import multiprocessing
+import time
+
+
+def legacy_transform(content):
+    img = Image.open(BytesIO(content))
+    new_img = ImageOps.exif_transpose(img)
+    is_reduced, new_size = get_reduced_size(new_img.size, (1024, 1024))
+    new_img = new_img.resize(new_size, Image.BICUBIC)
+    new_img.save(BytesIO(), format=img.format, optimize=True, quality=75)
+
+
+def new_transform(content):
+    transform_image("bench", {"filename": "photo.jpg", "len": len(content), "content": content}, False)
+
+
+def memory(name):
+    """Get a memory value of the current process from /proc (linux), in MB"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(name + ":"):
+                return int(line.split()[1]) / 1024
+
+
+def measure(func, content):
+    """Run func in the current process: (seconds, peak memory increase in MB)"""
+    # resets the peak resident memory
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")
+    before = memory("VmRSS")
+    start = time.perf_counter()
+    func(content)
+    duration = time.perf_counter() - start
+    return duration, memory("VmHWM") - before
+
+
+def fixture(size, orientation):
+    """A photo like jpeg: gradient with noise"""
+    noise = Image.effect_noise(size, 30)
+    gradient = Image.linear_gradient("L").resize(size)
+    img = Image.merge("RGB", (noise, gradient, Image.blend(noise, gradient, 0.5)))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    content = BytesIO()
+    img.save(content, format="JPEG", quality=90, exif=exif)
+    return content.getvalue()
+
+
+if __name__ == "__main__":
+    fixtures = {
+        "12 MP": fixture((4000, 3000), 1),
+        "48 MP rotated": fixture((8000, 6000), 6),
+    }
+    context = multiprocessing.get_context("spawn")
+    for name, content in fixtures.items():
+        results = []
+        for func in (legacy_transform, new_transform):
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                # the first call imports the modules
+                executor.submit(measure, func, fixture((100, 100), 1)).result()
+                results.append(executor.submit(measure, func, content).result())
+        (legacy, legacy_mem), (new, new_mem) = results
+        print(
+            "{:<14} {:>9} bytes: legacy {:.3f}s {:.0f} MB, new {:.3f}s {:.0f} MB ({:.1f}x)".format(
+                name, len(content), legacy, legacy_mem, new, new_mem, legacy / new
+            )
+        )
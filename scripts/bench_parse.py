@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# bin/runpy scripts/bench_parse.py
+"""Compare IMAPEmailHandler.parse_mail with the previous whole message decoding (utf-8 or chardet)."""
+from email.message import EmailMessage
+from imio.email.dms.imap import IMAPEmailHandler
+from imio.email.parser import email_policy  # noqa
+
+import chardet
+import email
+import os
+import timeit
+
+
+def legacy_parse_mail(mail_body):
+    try:
+        mail_body = mail_body.decode("utf-8")
+    except UnicodeDecodeError:
+        detection = chardet.detect(mail_body)
+        mail_body = mail_body.decode(detection["encoding"])
+    return email.message_from_string(mail_body, policy=email_policy)
+
+
+def fixture(charset, cte, attachment_size=3000000):
+    msg = EmailMessage()
+    msg["From"] = "agent@mail.be"
+    msg["Subject"] = "Réunion"
+    msg.set_content("Bonjour,\nvoici le procès-verbal de la réunion de jeudi.\n" * 20, charset=charset, cte=cte)
+    msg.add_attachment(os.urandom(attachment_size), maintype="application", subtype="pdf", filename="scan.pdf")
+    return msg.as_bytes()
+
+
+fixtures = {
+    "ascii (quoted-printable text)": fixture("utf-8", "quoted-printable"),
+    "utf-8 8bit text": fixture("utf-8", "8bit"),
+    "iso-8859-1 8bit text": fixture("iso-8859-1", "8bit"),
+}
+handler = IMAPEmailHandler()
+for name, raw in fixtures.items():
+    legacy = min(timeit.repeat(lambda: legacy_parse_mail(raw), number=3, repeat=3)) / 3
+    new = min(timeit.repeat(lambda: handler.parse_mail(raw), number=3, repeat=3)) / 3
+    print("{:<32} {:>8} bytes: legacy {:.4f}s, new {:.4f}s ({:.1f}x)".format(name, len(raw), legacy, new, legacy / new))
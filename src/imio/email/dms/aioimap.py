@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""asyncio IMAP backend.
+
+AsyncIMAPEmailHandler has the interface of IMAPEmailHandler for the commands used to handle waiting mails (connect,
+search, fetch, store and idle), as coroutines. It runs on AsyncIMAP4, a minimal IMAP4rev1 client on asyncio streams
+returning responses as imaplib does, so that the response parsing of the imap module is shared.
+"""
+from imio.email.dms.imap import chunks
+from imio.email.dms.imap import fetch_batches
+from imio.email.dms.imap import FETCH_CHUNK_SIZE
+from imio.email.dms.imap import fetched_body
+from imio.email.dms.imap import fetched_partial
+from imio.email.dms.imap import fetched_skeleton
+from imio.email.dms.imap import fetched_structure
+from imio.email.dms.imap import IDLE_TIMEOUT
+from imio.email.dms.imap import IMAPEmailHandler
+from imio.email.dms.imap import MailData
+from imio.email.dms.imap import message_set
+from imio.email.dms.imap import parse_sizes
+from imio.email.dms.imap import parse_status
+from imio.email.dms.imap import partial_fetch_items
+from imio.email.dms.imap import skeleton_candidates
+from imio.email.dms.imap import skeleton_fetch_items
+from imio.email.dms.imap import SPOOL_MIN_SIZE
+from imio.email.dms.imap import status_items
+from imio.email.dms.imap import store_commands
+from imio.email.dms.imap import waiting_search_criteria
+
+import asyncio
+import imaplib
+import logging
+import re
+import ssl as ssl_module
+import tempfile
+import time
+
+
+logger = logging.getLogger("imio.email.dms")
+
+UNTAGGED_RE = re.compile(rb"\* (?P<type>[A-Za-z-]+)(?: (?P<data>.*))?$")
+UNTAGGED_STATUS_RE = re.compile(rb"\* (?P<data>\d+) (?P<type>[A-Za-z-]+)(?: (?P<data2>.*))?$")
+TAGGED_RE = re.compile(rb"(?P<tag>[^\s*+]+) (?P<type>[A-Za-z]+)(?: (?P<data>.*))?$")
+RESPONSE_CODE_RE = re.compile(rb"\[(?P<type>[A-Za-z-]+)(?: (?P<data>[^\]]*))?\]")
+LITERAL_SIZE_RE = re.compile(rb"\{(\d+)\}$")
+
+
+def quote(value):
+    """Quote a command argument"""
+    return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+class AsyncIMAP4(object):
+    """Minimal IMAP4rev1 client on asyncio streams.
+
+    Commands return (result, data) as imaplib does: data contains the untagged responses of the command type, as bytes
+    lines and (line, literal) tuples. Commands are serialized: a command is sent when the previous one is completed.
+    """
+
+    error = imaplib.IMAP4.error
+    abort = imaplib.IMAP4.abort
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.capabilities = ()
+        self.untagged_responses = {}
+        self.tagnum = 0
+        self.lock = asyncio.Lock()
+
+    async def open(self, host, port, ssl=False):
+        """Connect to the server and read its greeting and capabilities"""
+        context = ssl and ssl_module.create_default_context() or None
+        self.reader, self.writer = await asyncio.open_connection(host, port, ssl=context)
+        tag, typ, data = await self.get_response()
+        if typ not in ("OK", "PREAUTH"):
+            raise self.error("Unexpected greeting: {}".format(data))
+        await self.capability()
+
+    def _new_tag(self):
+        self.tagnum += 1
+        return b"A%d" % self.tagnum
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def readline(self):
+        """Read a line, without its CRLF"""
+        line = await self.reader.readline()
+        if not line:
+            raise self.abort("socket error: EOF")
+        return line.rstrip(b"\r\n")
+
+    async def get_response(self):
+        """Read a response with its literals. Untagged responses and response codes are stored by type.
+
+        :return: (tag, type, data): tag is b"*" for an untagged response and b"+" for a continuation request
+        """
+        line = await self.readline()
+        if line.startswith(b"+"):
+            return b"+", None, [line[2:]]
+        match = UNTAGGED_RE.match(line)
+        if match:
+            tag, typ, dat = b"*", match.group("type"), match.group("data")
+        else:
+            match = UNTAGGED_STATUS_RE.match(line) or TAGGED_RE.match(line)
+            if not match:
+                raise self.abort("Unexpected response: {}".format(line))
+            if line.startswith(b"*"):
+                tag, typ, dat = b"*", match.group("type"), match.group("data")
+                if match.group("data2"):
+                    dat += b" " + match.group("data2")
+            else:
+                tag, typ, dat = match.group("tag"), match.group("type"), match.group("data")
+        typ = typ.decode().upper()
+        dat = dat or b""
+        if typ in ("OK", "NO", "BAD", "PREAUTH", "BYE"):
+            code = RESPONSE_CODE_RE.match(dat)
+            if code:
+                self.untagged_responses.setdefault(code.group("type").decode().upper(), []).append(code.group("data"))
+        data = []
+        literal = LITERAL_SIZE_RE.search(dat)
+        while literal:
+            data.append((dat, await self.reader.readexactly(int(literal.group(1)))))
+            dat = await self.readline()
+            literal = LITERAL_SIZE_RE.search(dat)
+        data.append(dat)
+        if tag == b"*":
+            self.untagged_responses.setdefault(typ, []).extend(data)
+        return tag, typ, data
+
+    async def command(self, name, *args):
+        """Send a command and read the responses until its completion
+
+        :return: (result, tagged response data)
+        """
+        async with self.lock:
+            tag = self._new_tag()
+            args = [isinstance(arg, bytes) and arg or str(arg).encode() for arg in args]
+            await self.send(b" ".join([tag, name.encode()] + args) + b"\r\n")
+            while True:
+                resp_tag, typ, data = await self.get_response()
+                if resp_tag == tag:
+                    break
+                if resp_tag == b"+":
+                    raise self.abort("Unexpected continuation request: {}".format(data))
+                if typ == "BYE" and name != "LOGOUT":
+                    raise self.abort("Server closed the connection: {}".format(data))
+        if typ == "BAD":
+            raise self.error("{} command error: {} {}".format(name, typ, data))
+        return typ, data
+
+    def _untagged_response(self, typ, data, name):
+        if typ == "NO":
+            return typ, data
+        return typ, self.untagged_responses.pop(name, [None])
+
+    def response(self, code):
+        """Pop the stored untagged responses of a type"""
+        return code, self.untagged_responses.pop(code.upper(), [None])
+
+    async def capability(self):
+        typ, data = await self.command("CAPABILITY")
+        typ, data = self._untagged_response(typ, data, "CAPABILITY")
+        if data[-1]:
+            self.capabilities = tuple(data[-1].decode().upper().split())
+        return typ, data
+
+    async def login(self, user, password):
+        typ, data = await self.command("LOGIN", quote(user), quote(password))
+        if typ != "OK":
+            raise self.error(data[-1])
+        return typ, data
+
+    async def select(self, mailbox="INBOX"):
+        self.untagged_responses = {}
+        typ, data = await self.command("SELECT", mailbox)
+        return self._untagged_response(typ, data, "EXISTS")
+
+    async def status(self, mailbox, names):
+        typ, data = await self.command("STATUS", mailbox, names)
+        return self._untagged_response(typ, data, "STATUS")
+
+    async def uid(self, command, *args):
+        command = command.upper()
+        typ, data = await self.command("UID", command, *args)
+        return self._untagged_response(typ, data, command in ("SEARCH", "SORT", "THREAD") and command or "FETCH")
+
+    async def noop(self):
+        return await self.command("NOOP")
+
+    async def expunge(self):
+        typ, data = await self.command("EXPUNGE")
+        return self._untagged_response(typ, data, "EXPUNGE")
+
+    async def close(self):
+        return await self.command("CLOSE")
+
+    async def logout(self):
+        try:
+            return await self.command("LOGOUT")
+        finally:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+
+class AsyncIMAPEmailHandler(object):
+    """Handle IMAP mails with asyncio.
+
+    Same interface as IMAPEmailHandler for handling waiting mails, with coroutines. iter_mails and iter_waiting_emails
+    are asynchronous generators. Commands are built and responses parsed by the helpers of the imap module: only the
+    I/O differs.
+    """
+
+    connection = None
+    round_trips_saved = 0
+    uidvalidity = None
+    sync_state = None
+    sync_state_path = None
+    pending_sync_state = None
+
+    # methods without IMAP command are shared with the blocking handler
+    has_idle = IMAPEmailHandler.has_idle
+    has_condstore = IMAPEmailHandler.has_condstore
+    has_new_mails = IMAPEmailHandler.has_new_mails
+    update_uidvalidity = IMAPEmailHandler.update_uidvalidity
+    parse_mail = IMAPEmailHandler.parse_mail
+    parse_mail_file = IMAPEmailHandler.parse_mail_file
+    fetched_mails = IMAPEmailHandler.fetched_mails
+    load_sync_state = IMAPEmailHandler.load_sync_state
+    save_sync_state = IMAPEmailHandler.save_sync_state
+    end_fetch = IMAPEmailHandler.end_fetch
+    end_sync = IMAPEmailHandler.end_sync
+    queue_mark = IMAPEmailHandler.queue_mark
+
+    def __init__(self):
+        self.pending_marks = {}
+
+    async def connect(self, host, port, ssl, login, password):
+        """Connect and login to IMAP server"""
+        self.connection = AsyncIMAP4()
+        await self.connection.open(host, port, ssl)
+        await self.connection.login(login, password)
+        await self.select()
+
+    async def select(self, mailbox="INBOX"):
+        """Select mailbox and store its UIDVALIDITY"""
+        await self.connection.select(mailbox)
+        self.update_uidvalidity(mailbox)
+
+    async def idle(self, timeout=IDLE_TIMEOUT):
+        """Wait with IDLE (RFC 2177) until the server sends an untagged response or the timeout expires.
+
+        :return: True if the server sent a mailbox change
+        """
+        connection = self.connection
+        async with connection.lock:
+            tag = connection._new_tag()
+            await connection.send(tag + b" IDLE\r\n")
+            line = await connection.readline()
+            if not line.startswith(b"+"):
+                raise imaplib.IMAP4.error("IDLE refused: {}".format(line))
+            changed = False
+            deadline = time.monotonic() + timeout
+            while not changed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    line = await asyncio.wait_for(connection.readline(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                changed = not line.startswith(b"* OK")
+            await connection.send(b"DONE\r\n")
+            while not line.startswith(tag):
+                line = await connection.readline()
+        if not line.startswith(tag + b" OK"):
+            raise imaplib.IMAP4.error("IDLE failed: {}".format(line))
+        return changed
+
+    async def wait_for_changes(self, idle_timeout=IDLE_TIMEOUT, poll_interval=60):
+        """Wait for a mailbox change, with IDLE if supported or by polling with NOOP every poll_interval seconds"""
+        if self.has_idle():
+            return await self.idle(timeout=idle_timeout)
+        self.has_new_mails()
+        deadline = time.monotonic() + idle_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(poll_interval, max(deadline - time.monotonic(), 0)))
+            await self.connection.noop()
+            if self.has_new_mails():
+                return True
+        return False
+
+    async def disconnect(self):
+        """Disconnect from IMAP server"""
+        await self.flush_marks()
+        await self.connection.close()
+        await self.connection.logout()
+
+    async def search(self, *criteria):
+        """Search messages
+
+        :return: list of uids or None if the search failed
+        """
+        res, data = await self.connection.uid("SEARCH", *criteria)
+        if res != "OK":
+            return None
+        return data[0].split()
+
+    async def get_mail(self, mail_id, size=None):
+        """Fetch a message, by chunks in a spool file if it's bigger than SPOOL_MIN_SIZE (see
+        IMAPEmailHandler.get_mail)"""
+        if size and size > SPOOL_MIN_SIZE:
+            return await self.get_mail_spooled(mail_id)
+        mail_body = fetched_body(*await self.connection.uid("FETCH", mail_id, "(RFC822)"))
+        if mail_body is None:
+            logger.error("Unable to fetch mail {0}".format(mail_id))
+            return None
+        return self.parse_mail(mail_body)
+
+    async def get_mail_spooled(self, mail_id, chunk_size=FETCH_CHUNK_SIZE):
+        """Fetch a message by partial chunks written in a temporary spool file (see
+        IMAPEmailHandler.get_mail_spooled)"""
+        with tempfile.TemporaryFile() as mail_file:
+            offset = 0
+            while True:
+                chunk = fetched_partial(
+                    *await self.connection.uid("FETCH", mail_id, partial_fetch_items(offset, chunk_size))
+                )
+                if chunk is None:
+                    logger.error("Unable to fetch mail {0} at offset {1}".format(mail_id, offset))
+                    return None
+                mail_file.write(chunk)
+                offset += len(chunk)
+                if len(chunk) < chunk_size:
+                    break
+                del chunk
+            return self.parse_mail_file(mail_file)
+
+    async def get_mail_skeleton(self, mail_id):
+        """Get a light copy of a message, without downloading its big parts (see IMAPEmailHandler.get_mail_skeleton)"""
+        res, data = await self.connection.uid("FETCH", mail_id, "(UID BODYSTRUCTURE)")
+        if res != "OK" or not data or not data[0]:
+            logger.error("Unable to fetch structure of mail {0}".format(mail_id))
+            return None
+        structure = fetched_structure(data)
+        if structure is None:
+            return None
+        res, data = await self.connection.uid("FETCH", mail_id, skeleton_fetch_items(structure))
+        if res != "OK":
+            logger.error("Unable to fetch skeleton of mail {0}".format(mail_id))
+            return None
+        return self.parse_mail(fetched_skeleton(structure, data))
+
+    async def get_sizes(self, mail_ids):
+        """Get the RFC822.SIZE of messages, with one FETCH command by chunk of 1000 messages
+
+        :return: dict {uid as int: size}
+        """
+        sizes = {}
+        for chunk in chunks(mail_ids, 1000):
+            res, data = await self.connection.uid("FETCH", message_set(chunk), "(UID RFC822.SIZE)")
+            if res != "OK":
+                logger.error("Unable to fetch sizes of mails {0}".format(message_set(chunk)))
+                continue
+            sizes.update(parse_sizes(data))
+        return sizes
+
+    async def iter_mails(self, mail_ids, batch_size=200, max_batch_bytes=None, skeleton_min_size=None):
+        """Fetch messages lazily, by chunks of batch_size, with one UID FETCH command per chunk (see
+        IMAPEmailHandler.iter_mails)"""
+        sizes = {}
+        if max_batch_bytes or skeleton_min_size:
+            sizes = await self.get_sizes(mail_ids)
+        for chunk in fetch_batches(mail_ids, sizes, batch_size, max_batch_bytes):
+            # flags of the previous chunk are stored before fetching the next one
+            await self.flush_marks()
+            skeleton_ids = []
+            for mail_id in skeleton_candidates(chunk, sizes, skeleton_min_size):
+                mail = await self.get_mail_skeleton(mail_id)
+                if mail:  # otherwise fetched as usual
+                    skeleton_ids.append(mail_id)
+                    yield MailData(mail_id, mail, size=sizes[int(mail_id)], partial=True)
+            chunk = [mail_id for mail_id in chunk if mail_id not in skeleton_ids]
+            if not chunk:
+                continue
+            if len(chunk) == 1:
+                mail = await self.get_mail(chunk[0], size=sizes.get(int(chunk[0])))
+                if mail:
+                    yield MailData(chunk[0], mail, size=sizes.get(int(chunk[0])))
+                continue
+            res, data = await self.connection.uid("FETCH", message_set(chunk), "(UID FLAGS RFC822.SIZE BODY.PEEK[])")
+            if res != "OK":
+                logger.error("Unable to fetch mails {0}".format(message_set(chunk)))
+                continue
+            self.round_trips_saved += len(chunk) - 1
+            for mail_info in self.fetched_mails(data):
+                yield mail_info
+
+    async def iter_waiting_emails(self, batch_size=1, max_batch_bytes=None, skeleton_min_size=None):
+        """Fetch lazily waiting messages, using the sync state if loaded (see IMAPEmailHandler.iter_waiting_emails)"""
+        self.pending_sync_state = None
+        status = self.sync_state_path is not None and await self.status() or None
+        args = waiting_search_criteria(self.sync_state, status)
+        if args is None:
+            logger.debug("Mailbox unchanged since last run")
+            return
+        mail_ids = await self.search(*args)
+        if mail_ids is None:
+            logger.error("Unable to fetch mails")
+            return
+        not_fetched = set(int(mail_id) for mail_id in mail_ids)
+        async for mail_info in self.iter_mails(
+            mail_ids,
+            batch_size=batch_size,
+            max_batch_bytes=max_batch_bytes,
+            skeleton_min_size=skeleton_min_size,
+        ):
+            not_fetched.discard(int(mail_info.id))
+            yield mail_info
+        self.end_fetch(status, not_fetched)
+
+    async def status(self, mailbox="INBOX"):
+        """Get mailbox UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ (if CONDSTORE is supported) with one STATUS command"""
+        res, data = await self.connection.status(mailbox, status_items(self.has_condstore()))
+        if res != "OK" or not data or not data[0]:
+            logger.error("Unable to get status of {}".format(mailbox))
+            return None
+        return parse_status(data)
+
+    async def mark_mails(self, mail_ids, transition):
+        """Apply a flags transition (see FLAG_TRANSITIONS) on a set of mails, with at most two UID STORE commands
+        by chunk of STORE_CHUNK_SIZE mails
+
+        :return: True if all commands succeeded
+        """
+        success = True
+        for args in store_commands(mail_ids, transition):
+            res, data = await self.connection.uid("STORE", *args)
+            if res != "OK":
+                logger.error("Unable to store flags {} {} of mails {}".format(args[1], args[2], args[0]))
+                success = False
+        return success
+
+    async def flush_marks(self):
+        """Apply all deferred flags transitions, grouped by transition (see IMAPEmailHandler.flush_marks)
+
+        :return: True if all deferred transitions are stored
+        """
+        success = True
+        for transition, mail_ids in list(self.pending_marks.items()):
+            if await self.mark_mails(mail_ids, transition):
+                del self.pending_marks[transition]
+            else:
+                success = False
+        return success
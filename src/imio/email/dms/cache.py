@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed caches: files produced while handling an email, reused when it's handled again, and results of
+the attachments transforms, shared by all the emails"""
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+import threading
+import time
+
+
+logger = logging.getLogger("imio.email.dms")
+
+# to increment when the produced files change (attachments transform, pdf rendering, tar content)
+PIPELINE_VERSION = "1"
+WORK_CACHE_MAX_SIZE = 1000  # MB
+WORK_CACHE_MAX_AGE = 7  # days
+TRANSFORM_CACHE_MAX_SIZE = 500  # MB
+
+
+def link_or_copy(src, dst):
+    """Hard link src to dst, or copy it if they aren't on the same file system"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class WorkCache(object):
+    """Files produced by the pipeline stages (transformed attachments, rendered pdf, tar file), by email.
+
+    An entry is keyed by the hash of the email and the pipeline version. It's dropped when the email is imported, so
+    that the cache holds the emails in error: when they are requeued, only the stages which failed run again.
+    Entries are evicted when older than max_age, and the oldest ones when the cache is bigger than max_size.
+    Attachments are pickled: the cache directory must not be writable by others.
+    """
+
+    def __init__(self, path, max_size=WORK_CACHE_MAX_SIZE * 1000000, max_age=WORK_CACHE_MAX_AGE * 86400):
+        self.path = str(path)
+        self.max_size = max_size
+        self.max_age = max_age
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def key(mail):
+        """Get the key of an email: hash of its content and of the pipeline version"""
+        try:
+            content = mail.as_bytes()
+        except Exception:
+            content = mail.as_string().encode("utf8", "replace")
+        return hashlib.sha256(PIPELINE_VERSION.encode() + b"\0" + content).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get_file(self, key, name):
+        """Get the path of a cached file, or None"""
+        path = os.path.join(self.entry_path(key), name)
+        return os.path.exists(path) and path or None
+
+    def put_file(self, key, name, src):
+        """Store a file in an entry
+
+        :return: path of the cached file
+        """
+        entry_path = self.entry_path(key)
+        os.makedirs(entry_path, exist_ok=True)
+        path = os.path.join(entry_path, name)
+        tmp_path = "{}.tmp".format(path)
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        link_or_copy(src, tmp_path)
+        os.replace(tmp_path, path)
+        os.utime(entry_path)
+        return path
+
+    def get_object(self, key, name):
+        path = self.get_file(key, name)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as cached:
+                return pickle.load(cached)
+        except Exception:
+            logger.warning("Ignored invalid cached file {}".format(path))
+            return None
+
+    def put_object(self, key, name, obj):
+        entry_path = self.entry_path(key)
+        os.makedirs(entry_path, exist_ok=True)
+        path = os.path.join(entry_path, name)
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "wb") as cached:
+            pickle.dump(obj, cached, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        os.utime(entry_path)
+
+    def drop(self, key):
+        entry_path = self.entry_path(key)
+        shutil.rmtree(entry_path, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(entry_path))
+        except OSError:  # other entries with the same prefix
+            pass
+
+    def evict(self):
+        """Remove the entries older than max_age, then the oldest ones until the cache size is under max_size
+
+        :return: number of removed entries
+        """
+        entries = []
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                entry_path = os.path.join(prefix_path, key)
+                try:
+                    size = sum(entry.stat().st_size for entry in os.scandir(entry_path))
+                    entries.append((os.stat(entry_path).st_mtime, size, key))
+                except OSError:
+                    continue
+        entries.sort()
+        total = sum(size for mtime, size, key in entries)
+        limit = time.time() - self.max_age
+        removed = 0
+        for mtime, size, key in entries:
+            if mtime >= limit and total <= self.max_size:
+                break
+            self.drop(key)
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(
+                "Work cache: evicted {} emails, {} remaining ({} bytes)".format(removed, len(entries) - removed, total)
+            )
+        return removed
+
+
+class TransformCache(object):
+    """Results of the attachments transforms (reduced images, compressed pdf files).
+
+    An entry is keyed by the hash of the transformed content, of the transform parameters and of the pipeline version:
+    the same logos, letterheads or forwarded pdf files are transformed once. The least recently used entries are
+    evicted when the cache is bigger than max_size. Entries are pickled: the cache directory must not be writable by
+    others.
+    """
+
+    def __init__(self, path, max_size=TRANSFORM_CACHE_MAX_SIZE * 1000000):
+        self.path = str(path)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        self.size = sum(size for mtime, size, path in self.entries())
+
+    @staticmethod
+    def key(content, params):
+        """Get the key of a transform: hash of the content, of the parameters (tuple) and of the pipeline version"""
+        digest = hashlib.sha256("{}\0{!r}\0".format(PIPELINE_VERSION, params).encode("utf8"))
+        digest.update(content)
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def entries(self):
+        """Get the (mtime, size, path) of the entries"""
+        entries = []
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for entry in os.scandir(prefix_path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get(self, key):
+        """Get the result of a transform, or None. A hit marks the entry as recently used."""
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as cached:
+                result = pickle.load(cached)
+            os.utime(path)
+        except FileNotFoundError:
+            result = None
+        except Exception:
+            logger.warning("Ignored invalid cached file {}".format(path))
+            result = None
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def put(self, key, result):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "wb") as cached:
+            pickle.dump(result, cached, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += size
+            if self.size <= self.max_size:
+                return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache size is under 90% of max_size
+
+        :return: number of removed entries
+        """
+        with self.lock:
+            entries = sorted(self.entries())
+            self.size = sum(size for mtime, size, path in entries)
+            removed = 0
+            for mtime, size, path in entries:
+                if self.size <= self.max_size * 0.9:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                self.size -= size
+                removed += 1
+        return removed
+
+    def report(self):
+        return "Transform cache: {} hits, {} misses, {} bytes".format(self.hits, self.misses, self.size)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""Index of the fingerprints of the imported emails, to detect duplicates"""
+from collections import OrderedDict
+from imio.email.dms.utils import safe_text
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger("imio.email.dms")
+
+FINGERPRINTS_MAX = 100000
+
+
+def normalize_message_id(value):
+    """Normalize a Message-ID header: '  <Abc@Mail.BE> ' => 'Abc@mail.be' (the domain is case insensitive)"""
+    value = safe_text(value or "").strip().strip("<>").strip()
+    local, sep, domain = value.rpartition("@")
+    return sep and "{}@{}".format(local, domain.lower()) or value
+
+
+def fingerprint(message):
+    """Get the fingerprint of an email: hash of its normalized Message-ID and of the content of its parts
+
+    :return: hex digest, or None if the email has no Message-ID and no content
+    """
+    message_id = normalize_message_id(message.get("Message-ID"))
+    body_hash = hashlib.sha256()
+    size = 0
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        payload = (part.get_payload(decode=True) or b"").strip()
+        body_hash.update(b"%d:" % len(payload))
+        body_hash.update(payload)
+        size += len(payload)
+    if not message_id and not size:
+        return None
+    return hashlib.sha256(message_id.encode("utf8") + b"\0" + body_hash.digest()).hexdigest()
+
+
+class FingerprintIndex(object):
+    """Fingerprints of the imported emails, with the uid and external id of the first one.
+
+    Fingerprints are appended to a file as json lines. The index is bounded to max_entries: the oldest fingerprints
+    are evicted and the file is compacted when it has twice as many lines.
+    Fingerprints of the emails being imported are claimed, so that duplicates handled concurrently are detected too.
+    The fingerprints of the ignored duplicates are kept too, so that a requeued duplicate can be imported (see remove).
+    """
+
+    def __init__(self, path, max_entries=FINGERPRINTS_MAX):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {fingerprint: [uid, external id, time]}
+        self.duplicates = OrderedDict()  # {uid: fingerprint} of the emails ignored as duplicates
+        self.pending = {}  # {fingerprint: uid} of the emails being imported
+        self.lock = threading.Lock()
+        self.lines = 0
+        if os.path.exists(self.path):
+            with open(self.path) as index_file:
+                for line in index_file:
+                    self.lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "duplicate" in record:
+                        self.duplicates[record["duplicate"]] = record["fp"]
+                        self.duplicates.move_to_end(record["duplicate"])
+                        continue
+                    self.entries[record["fp"]] = [record["uid"], record["external_id"], record["time"]]
+                    self.entries.move_to_end(record["fp"])
+        self._evict()
+        self.file = None
+        if self.lines > len(self.entries) + len(self.duplicates):
+            self.compact()
+        self.file = open(self.path, "a")
+
+    def get(self, fp):
+        """Get the (uid, external id, time) of the imported email with this fingerprint, or None"""
+        with self.lock:
+            return self.entries.get(fp)
+
+    def claim(self, fp, uid):
+        """Claim a fingerprint for an email being imported
+
+        :return: (uid, external id) of another email imported or being imported (external id None) with this
+                 fingerprint, or None
+        """
+        uid = safe_text(uid)
+        with self.lock:
+            entry = self.entries.get(fp)
+            # the email itself can be in the index if the previous run was killed before it was flagged
+            if entry and entry[0] != uid:
+                return entry[0], entry[1]
+            if self.pending.get(fp, uid) != uid:
+                return self.pending[fp], None
+            self.pending[fp] = uid
+            return None
+
+    def release(self, fp, uid):
+        """Release the fingerprint claimed by an email which wasn't imported"""
+        with self.lock:
+            if self.pending.get(fp) == safe_text(uid):
+                del self.pending[fp]
+
+    def add(self, fp, uid, external_id):
+        entry = [safe_text(uid), external_id, time.time()]
+        with self.lock:
+            self.pending.pop(fp, None)
+            self.entries[fp] = entry
+            self.entries.move_to_end(fp)
+            self._append(self._line(fp, entry))
+
+    def add_duplicate(self, fp, uid):
+        """Keep the fingerprint of an email ignored as duplicate, to forget it if the email is requeued"""
+        uid = safe_text(uid)
+        with self.lock:
+            self.duplicates[uid] = fp
+            self.duplicates.move_to_end(uid)
+            self._append(self._duplicate_line(uid, fp))
+
+    def remove(self, uid):
+        """Forget the fingerprint of a requeued email, imported or ignored as duplicate, so that it can be imported
+
+        :return: True if a fingerprint was removed
+        """
+        uid = safe_text(uid)
+        with self.lock:
+            fps = [fp for fp, entry in self.entries.items() if entry[0] == uid]
+            if uid in self.duplicates:
+                fps.append(self.duplicates.pop(uid))
+            removed = [self.entries.pop(fp) for fp in fps if fp in self.entries]
+            if fps:
+                self.compact()
+            return bool(removed)
+
+    @staticmethod
+    def _line(fp, entry):
+        return json.dumps({"fp": fp, "uid": entry[0], "external_id": entry[1], "time": entry[2]}) + "\n"
+
+    @staticmethod
+    def _duplicate_line(uid, fp):
+        return json.dumps({"fp": fp, "duplicate": uid}) + "\n"
+
+    def _append(self, line):
+        self.file.write(line)
+        self.file.flush()
+        self.lines += 1
+        self._evict()
+        if self.lines > 2 * (len(self.entries) + len(self.duplicates)):
+            self.compact()
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        while len(self.duplicates) > self.max_entries:
+            self.duplicates.popitem(last=False)
+
+    def compact(self):
+        """Rewrite the file with the kept fingerprints only"""
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as index_file:
+            for fp, entry in self.entries.items():
+                index_file.write(self._line(fp, entry))
+            for uid, fp in self.duplicates.items():
+                index_file.write(self._duplicate_line(uid, fp))
+        if self.file is not None:
+            self.file.close()
+        os.replace(tmp_path, self.path)
+        if self.file is not None:
+            self.file = open(self.path, "a")
+        self.lines = len(self.entries) + len(self.duplicates)
+
+    def close(self):
+        self.file.close()
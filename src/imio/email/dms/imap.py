@@ -1,93 +1,894 @@
 # -*- coding: utf-8 -*-
+from email.header import decode_header
+from email.header import make_header
+from email.parser import BytesHeaderParser
 from imio.email.dms import dev_mode
-from imio.email.dms.utils import reception_date
+from imio.email.dms.utils import localized_date
+from imio.email.dms.utils import safe_text
 from imio.email.parser import email_policy  # noqa
-from imio.email.parser.parser import Parser  # noqa
-from mailparser import MailParser
+from itertools import takewhile
 
-import chardet
 import email
 import imaplib
+import json
 import logging
-import six
+import os
+import re
+import select
+import tempfile
+import time
+import zlib
 
 
 logger = logging.getLogger("imio.email.dms")
 
+FETCH_START_RE = re.compile(rb"^\d+ \(")
+FETCH_UID_RE = re.compile(rb"\bUID (\d+)")
+FETCH_FLAGS_RE = re.compile(rb"\bFLAGS \(([^)]*)\)")
+FETCH_SIZE_RE = re.compile(rb"\bRFC822\.SIZE (\d+)")
+STORE_CHUNK_SIZE = 1000
+STATUS_RE = re.compile(rb"\(([^)]*)\)")
+FETCH_SECTION_RE = re.compile(rb"BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$")
+LITERAL_RE = re.compile(rb"\{\d+\}$")
+IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+SKELETON_PART_SIZE = 100000  # parts bigger than this are not fetched in a skeleton, except text parts
+CHARSET_SAMPLE_SIZE = 65536
+IDLE_TIMEOUT = 1500  # IDLE must be renewed before 29 minutes
+SPOOL_MIN_SIZE = 5000000  # messages bigger than this are fetched by chunks in a spool file
+FETCH_CHUNK_SIZE = 1048576
+FETCH_PARTIAL_RE = re.compile(rb"BODY\[\]<(\d+)> \{\d+\}$")
+# flags removed and flags added by each transition
+FLAG_TRANSITIONS = {
+    "imported": (("waiting", "error"), ("imported",)),
+    "error": (("waiting",), ("error",)),
+    "unsupported": (("waiting",), ("unsupported",)),
+    "ignored": (("waiting",), ("ignored",)),
+    "duplicate": (("waiting",), ("ignored", "duplicate")),
+    "reset_error": (("imported", "error"), ("waiting",)),
+    "reset_ignored": (("imported", "ignored", "duplicate"), ("waiting",)),
+    "reset_all": (("imported", "error", "ignored", "unsupported", "duplicate"), ()),
+}
+
 
 class MailData(object):
-    def __init__(self, mail_id, mail_obj):
+    def __init__(self, mail_id, mail_obj, flags=None, size=None, partial=False):
         self.id = mail_id
         self.mail = mail_obj
+        self.flags = flags
+        self.size = size
+        # mail_obj is a skeleton without the big parts content (see IMAPEmailHandler.get_mail_skeleton)
+        self.partial = partial
+
+
+def chunks(lst, size):
+    """Yield successive chunks of size elements from lst"""
+    for i in range(0, len(lst), size):
+        yield lst[i : i + size]
+
+
+def message_set(mail_ids):
+    """Build a compact IMAP message set from ids: [1, 2, 3, 5] => '1:3,5'"""
+    nums = sorted(set(int(mail_id) for mail_id in mail_ids))
+    ranges = []
+    for num in nums:
+        if ranges and num == ranges[-1][1] + 1:
+            ranges[-1][1] = num
+        else:
+            ranges.append([num, num])
+    return ",".join(str(start) if start == end else "{}:{}".format(start, end) for start, end in ranges)
+
+
+def split_fetch_response(data):
+    """Split a multi-message FETCH response in (metadata, literal) tuples.
+
+    imaplib returns a tuple (b'1 (UID 5 FLAGS (...) BODY[] {123}', b'<literal>') per message, followed by a bytes
+    item containing the closing parenthesis and possibly other items sent after the literal (b' FLAGS (...))').
+    """
+    messages = []
+    for item in data:
+        if isinstance(item, tuple):
+            messages.append([item[0], item[1]])
+        elif item and messages:
+            messages[-1][0] += b" " + item
+    return [tuple(msg) for msg in messages]
+
+
+def group_fetch_response(data):
+    """Group the items of a multi-message FETCH response by message"""
+    groups = []
+    for item in data:
+        start = item[0] if isinstance(item, tuple) else item
+        if not start:
+            continue
+        if FETCH_START_RE.match(start) or not groups:
+            groups.append([])
+        groups[-1].append(item)
+    return groups
+
+
+def decode_header_value(value):
+    """Decode an ENVELOPE string, possibly containing RFC 2047 encoded words"""
+    if value is None:
+        return ""
+    value = safe_text(value)
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+def envelope_address(addresses):
+    """Format the first address of an ENVELOPE address list as: Name <mailbox@host>"""
+    if not addresses or not isinstance(addresses[0], list) or len(addresses[0]) < 4:
+        return ""
+    name, adl, mailbox, host = addresses[0][:4]
+    address = "{}@{}".format(safe_text(mailbox or b""), safe_text(host or b""))
+    name = decode_header_value(name)
+    return name and "{} <{}>".format(name, address) or address
+
+
+def forwarded_envelope(structure):
+    """Get the ENVELOPE of the first message/rfc822 part of a multipart BODYSTRUCTURE"""
+    if not is_multipart(structure):
+        return None
+    for part in subparts(structure):
+        if is_rfc822_part(part) and isinstance(part[7], list):
+            return part[7]
+    return None
+
+
+def size_batches(mail_ids, sizes, batch_size, max_batch_bytes):
+    """Group message uids in batches of at most batch_size messages and max_batch_bytes cumulated size.
+
+    A message bigger than max_batch_bytes is alone in its batch.
+
+    :param sizes: dict {uid as int: size}
+    """
+    batch = []
+    batch_bytes = 0
+    for mail_id in mail_ids:
+        size = sizes.get(int(mail_id), 0)
+        if batch and (len(batch) >= batch_size or batch_bytes + size > max_batch_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(mail_id)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def inline_literals(data):
+    """Join a FETCH response in one bytes string, literals being replaced by quoted strings"""
+    parts = []
+    for item in data:
+        if isinstance(item, tuple):
+            literal = item[1].replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+            parts.append(LITERAL_RE.sub(b"", item[0]) + b'"' + literal + b'"')
+        elif item:
+            parts.append(item)
+    return b"".join(parts)
+
+
+def parse_imap_list(text):
+    """Parse an IMAP parenthesized list (as a BODYSTRUCTURE) in nested lists of bytes. NIL becomes None."""
+    stack = [[]]
+    pos = 0
+    while True:
+        match = IMAP_TOKEN_RE.match(text, pos)
+        if not match:
+            break
+        pos = match.end()
+        opening, closing, quoted, atom = match.groups()
+        if opening:
+            stack[-1].append([])
+            stack.append(stack[-1][-1])
+        elif closing:
+            if len(stack) > 1:
+                stack.pop()
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb"\\(.)", rb"\1", quoted))
+        else:
+            stack[-1].append(None if atom.upper() == b"NIL" else atom)
+    return stack[0]
+
+
+def is_multipart(structure):
+    return bool(structure) and isinstance(structure[0], list)
+
+
+def subparts(structure):
+    """Get the parts of a multipart BODYSTRUCTURE: the lists before the subtype"""
+    return list(takewhile(lambda part: isinstance(part, list), structure))
+
+
+def is_rfc822_part(structure):
+    return (
+        len(structure) > 8
+        and isinstance(structure[0], bytes)
+        and structure[0].lower() == b"message"
+        and (structure[1] or b"").lower() == b"rfc822"
+        and isinstance(structure[8], list)
+    )
+
+
+def bodystructure_sections(structure, leaf_section="TEXT", prefix=""):
+    """Get the sections to fetch to build a message skeleton (see build_skeleton)
+
+    :param structure: parsed BODYSTRUCTURE
+    :param leaf_section: section of the content if structure is not multipart
+    :param prefix: prefix of the sub parts sections
+    """
+    sections = []
+    if is_multipart(structure):
+        for i, child in enumerate(subparts(structure), 1):
+            spec = "{}{}".format(prefix, i)
+            sections.append("{}.MIME".format(spec))
+            sections.extend(bodystructure_sections(child, spec, spec + "."))
+    elif is_rfc822_part(structure):
+        sections.append("{}.HEADER".format(leaf_section))
+        sections.extend(bodystructure_sections(structure[8], leaf_section + ".TEXT", leaf_section + "."))
+    elif (structure[0] or b"").lower() == b"text" or int(structure[6] or 0) <= SKELETON_PART_SIZE:
+        sections.append(leaf_section)
+    return sections
+
+
+def build_skeleton(structure, header, bodies, leaf_section="TEXT", prefix=""):
+    """Build the raw content of a message from its fetched sections (see bodystructure_sections).
+    Sections not fetched are left empty.
+
+    :param structure: parsed BODYSTRUCTURE
+    :param header: raw header of the entity
+    :param bodies: dict {section: fetched content}
+    """
+    header = header.rstrip(b"\r\n") + b"\r\n\r\n"
+    if is_multipart(structure):
+        boundary = BytesHeaderParser().parsebytes(header).get_param("boundary")
+        if not boundary:
+            return header
+        boundary = boundary.encode()
+        body = b""
+        for i, child in enumerate(subparts(structure), 1):
+            spec = "{}{}".format(prefix, i)
+            child_header = bodies.get("{}.MIME".format(spec), b"")
+            body += b"--" + boundary + b"\r\n" + build_skeleton(child, child_header, bodies, spec, spec + ".") + b"\r\n"
+        body += b"--" + boundary + b"--\r\n"
+    elif is_rfc822_part(structure):
+        inner_header = bodies.get("{}.HEADER".format(leaf_section), b"")
+        body = build_skeleton(structure[8], inner_header, bodies, leaf_section + ".TEXT", leaf_section + ".")
+    else:
+        body = bodies.get(leaf_section, b"")
+    return header + body
+
+
+def fetch_batches(mail_ids, sizes, batch_size, max_batch_bytes=None):
+    """Group message uids in the batches fetched with one FETCH command (see size_batches)"""
+    if max_batch_bytes:
+        return size_batches(mail_ids, sizes, batch_size, max_batch_bytes)
+    return chunks(mail_ids, batch_size)
+
+
+def skeleton_candidates(mail_ids, sizes, skeleton_min_size=None):
+    """Get the messages to fetch first as skeleton: the ones bigger than skeleton_min_size, if given"""
+    if not skeleton_min_size:
+        return []
+    return [mail_id for mail_id in mail_ids if sizes.get(int(mail_id), 0) > skeleton_min_size]
+
+
+def parse_sizes(data):
+    """Parse a "FETCH (UID RFC822.SIZE)" response
+
+    :return: dict {uid as int: size}
+    """
+    sizes = {}
+    for line in data:
+        if isinstance(line, tuple):
+            line = line[0]
+        uid = FETCH_UID_RE.search(line or b"")
+        size = FETCH_SIZE_RE.search(line or b"")
+        if uid and size:
+            sizes[int(uid.group(1))] = int(size.group(1))
+    return sizes
+
+
+def fetched_body(res, data):
+    """Get the raw message of a "FETCH (RFC822)" response, or None"""
+    if res != "OK" or not data or not isinstance(data[0], tuple):
+        return None
+    return data[0][1]
+
+
+def fetched_partial(res, data):
+    """Get the chunk of a "FETCH (BODY.PEEK[]<offset.length>)" response, or None"""
+    if res != "OK":
+        return None
+    for item in data:
+        if isinstance(item, tuple) and FETCH_PARTIAL_RE.search(item[0]):
+            return item[1]
+    return None
+
+
+def partial_fetch_items(offset, chunk_size):
+    return "(BODY.PEEK[]<{}.{}>)".format(offset, chunk_size)
+
+
+def fetched_structure(data):
+    """Get the parsed BODYSTRUCTURE of a "FETCH (UID BODYSTRUCTURE)" response, or None if it's missing or if the
+    message can't be rebuilt as a skeleton"""
+    fetched = parse_imap_list(inline_literals(data))
+    items = fetched[1] if len(fetched) > 1 and isinstance(fetched[1], list) else []
+    structure = None
+    for i, item in enumerate(items[:-1]):
+        if isinstance(item, bytes) and item.upper() == b"BODYSTRUCTURE":
+            structure = items[i + 1]
+    if not isinstance(structure, list) or is_rfc822_part(structure):
+        return None
+    return structure
+
+
+def skeleton_fetch_items(structure):
+    """Get the FETCH items of the sections of a message skeleton (see bodystructure_sections)"""
+    sections = ["HEADER"] + bodystructure_sections(structure)
+    return "({})".format(" ".join("BODY.PEEK[{}]".format(section) for section in sections))
+
+
+def fetched_skeleton(structure, data):
+    """Build the raw content of a message skeleton from the response of its sections FETCH (see build_skeleton)"""
+    bodies = {}
+    for item in data:
+        if isinstance(item, tuple):
+            match = FETCH_SECTION_RE.search(item[0])
+            if match:
+                bodies[match.group(1).decode().upper()] = item[1]
+    return build_skeleton(structure, bodies.get("HEADER", b""), bodies)
+
+
+def waiting_search_criteria(state, status):
+    """Get the SEARCH criteria of the waiting messages.
+
+    Only messages added or modified since the previous complete run are searched if both the sync state and the
+    mailbox status have a HIGHESTMODSEQ (CONDSTORE) for the same UIDVALIDITY.
+
+    :param state: sync state of the previous complete run, or None
+    :param status: mailbox status (see parse_status), or None
+    :return: list of criteria, or None if the mailbox hasn't changed since the previous run
+    """
+    args = [u"NOT KEYWORD imported", u"NOT KEYWORD unsupported", u"NOT KEYWORD error", u"NOT KEYWORD ignored"]
+    # args = [u"KEYWORD imported"]
+    # args = ['SUBJECT "PERMANNE"']
+    if state and status and state.get("UIDVALIDITY") == status.get("UIDVALIDITY"):
+        if "HIGHESTMODSEQ" in status and "HIGHESTMODSEQ" in state:
+            if state["UIDNEXT"] == status["UIDNEXT"] and state["HIGHESTMODSEQ"] == status["HIGHESTMODSEQ"]:
+                return None
+            # added messages or messages with changed flags
+            args.insert(0, "OR UID {}:* MODSEQ {}".format(state["UIDNEXT"], state["HIGHESTMODSEQ"] + 1))
+    return args
+
+
+def status_items(condstore):
+    """Get the STATUS items: UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ if the server supports CONDSTORE"""
+    items = ["UIDVALIDITY", "UIDNEXT"]
+    if condstore:
+        items.append("HIGHESTMODSEQ")
+    return "({})".format(" ".join(items))
+
+
+def parse_status(data):
+    """Parse a STATUS response: {"UIDVALIDITY": 7, "UIDNEXT": 104, ...}, or None"""
+    if not data or not data[0]:
+        return None
+    match = STATUS_RE.search(data[0])
+    if not match:
+        return None
+    values = match.group(1).split()
+    return {key.decode(): int(value) for key, value in zip(values[::2], values[1::2])}
+
+
+def store_commands(mail_ids, transition):
+    """Get the arguments of the UID STORE commands applying a flags transition (see FLAG_TRANSITIONS): at most two
+    commands by chunk of STORE_CHUNK_SIZE mails"""
+    removed, added = FLAG_TRANSITIONS[transition]
+    for chunk in chunks(list(mail_ids), STORE_CHUNK_SIZE):
+        uids = message_set(chunk)
+        if removed:
+            yield uids, "-FLAGS.SILENT", "({})".format(" ".join(removed))
+        if added:
+            yield uids, "+FLAGS.SILENT", "({})".format(" ".join(added))
+
+
+# RFC 4978, unknown to imaplib
+imaplib.Commands.setdefault("COMPRESS", ("AUTH", "SELECTED"))
+
+
+class DeflateMixin(object):
+    """COMPRESS=DEFLATE (RFC 4978) support for imaplib connections.
+
+    Once enabled, sent data are compressed and received data are decompressed between the socket and imaplib.
+    """
+
+    compressor = None
+    decompressor = None
+    inbuf = b""
+    wire_bytes = 0  # received compressed bytes
+    data_bytes = 0  # received decompressed bytes
+
+    def enable_compression(self):
+        """Negotiate COMPRESS=DEFLATE if the server supports it (capabilities are refreshed after login)
+
+        :return: True if the compression is enabled
+        """
+        if self.decompressor is not None:
+            return True
+        self._get_capabilities()
+        if "COMPRESS=DEFLATE" not in self.capabilities:
+            return False
+        typ, data = self._simple_command("COMPRESS", "DEFLATE")
+        if typ != "OK":
+            return False
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        return True
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise self.abort("socket error: EOF")
+        self.wire_bytes += len(data)
+        data = self.decompressor.decompress(data)
+        self.data_bytes += len(data)
+        self.inbuf += data
+
+    def read(self, size):
+        if self.decompressor is None:
+            return super(DeflateMixin, self).read(size)
+        while len(self.inbuf) < size:
+            self._fill()
+        data, self.inbuf = self.inbuf[:size], self.inbuf[size:]
+        return data
+
+    def readline(self):
+        if self.decompressor is None:
+            return super(DeflateMixin, self).readline()
+        while b"\n" not in self.inbuf:
+            if len(self.inbuf) > imaplib._MAXLINE:
+                raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+            self._fill()
+        line, sep, self.inbuf = self.inbuf.partition(b"\n")
+        return line + sep
+
+    def send(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        super(DeflateMixin, self).send(data)
+
+
+class IMAP4(DeflateMixin, imaplib.IMAP4):
+    """imaplib.IMAP4 with COMPRESS=DEFLATE support"""
+
+
+class IMAP4_SSL(DeflateMixin, imaplib.IMAP4_SSL):
+    """imaplib.IMAP4_SSL with COMPRESS=DEFLATE support"""
+
+
+def buffered_input(connection):
+    """Check, without blocking, if received data are waiting in the buffers of an imaplib connection: decompressed
+    data, decrypted data in the ssl socket or data read ahead by imaplib's file reader. select() doesn't see them.
+    """
+    if isinstance(connection, DeflateMixin) and connection.decompressor is not None:
+        # the socket is read directly
+        return bool(connection.inbuf)
+    sock = connection.sock
+    if getattr(sock, "pending", None) and sock.pending():
+        return True
+    # peek reads the socket when the reader buffer is empty: it must not wait for data
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        return bool(connection.file.peek(1))
+    except OSError:  # ssl.SSLWantReadError
+        return False
+    finally:
+        sock.settimeout(timeout)
 
 
 class IMAPEmailHandler(object):
-    """Handle IMAP mails"""
+    """Handle IMAP mails.
+
+    Messages are addressed by their UID (UID SEARCH, UID FETCH, UID STORE), which stays stable when other messages
+    are expunged. UIDs are only valid for the UIDVALIDITY of the selected mailbox.
+    """
 
     connection = None
+    round_trips_saved = 0
+    uidvalidity = None
+    sync_state = None
+    sync_state_path = None
+    pending_sync_state = None
+
+    def __init__(self):
+        self.pending_marks = {}
 
     def connect(self, host, port, ssl, login, password):
-        """Connect and login to IMAP server"""
+        """Connect and login to IMAP server. Data are compressed if the server supports COMPRESS=DEFLATE."""
         if ssl:
-            self.connection = imaplib.IMAP4_SSL(host, port)
+            self.connection = IMAP4_SSL(host, port)
         else:
-            self.connection = imaplib.IMAP4(host, port)
+            self.connection = IMAP4(host, port)
         self.connection.login(login, password)
-        self.connection.select("INBOX")
+        if self.connection.enable_compression():
+            logger.debug("IMAP COMPRESS=DEFLATE enabled")
+        self.select()
+
+    def select(self, mailbox="INBOX"):
+        """Select mailbox and store its UIDVALIDITY"""
+        self.connection.select(mailbox)
+        self.update_uidvalidity(mailbox)
+
+    def update_uidvalidity(self, mailbox):
+        """Store the UIDVALIDITY of the selected mailbox. Deferred flags are dropped if it has changed."""
+        res, data = self.connection.response("UIDVALIDITY")
+        if data and data[0]:
+            uidvalidity = int(data[0])
+            if self.uidvalidity is not None and uidvalidity != self.uidvalidity:
+                logger.warning("UIDVALIDITY of {} has changed: {} => {}".format(mailbox, self.uidvalidity, uidvalidity))
+                if self.pending_marks:
+                    logger.warning("Dropped flags of previous UIDVALIDITY: {}".format(self.pending_marks))
+                    self.pending_marks = {}
+            self.uidvalidity = uidvalidity
+
+    def has_idle(self):
+        """Check if the server supports IDLE"""
+        return "IDLE" in self.connection.capabilities
+
+    def idle(self, timeout=IDLE_TIMEOUT):
+        """Wait with IDLE (RFC 2177) until the server sends an untagged response or the timeout expires.
+
+        Any untagged response except keepalive "OK" ends the wait: the caller is expected to search the waiting mails.
+
+        :return: True if the server sent a mailbox change
+        """
+        tag = self.connection._new_tag()
+        self.connection.send(tag + b" IDLE\r\n")
+        line = self.connection.readline()
+        if not line.startswith(b"+"):
+            raise imaplib.IMAP4.error("IDLE refused: {}".format(line))
+        sock = self.connection.sock
+        changed = False
+        deadline = time.time() + timeout
+        while not changed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if not buffered_input(self.connection):
+                if not select.select([sock], [], [], remaining)[0]:
+                    break
+            line = self.connection.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("socket error: EOF during IDLE")
+            changed = not line.startswith(b"* OK")
+        self.connection.send(b"DONE\r\n")
+        while not line.startswith(tag):
+            line = self.connection.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("socket error: EOF during IDLE")
+        if not line.startswith(tag + b" OK"):
+            raise imaplib.IMAP4.error("IDLE failed: {}".format(line))
+        return changed
+
+    def wait_for_changes(self, idle_timeout=IDLE_TIMEOUT, poll_interval=60):
+        """Wait for a mailbox change, with IDLE if supported or by polling with NOOP every poll_interval seconds.
+
+        Returns when the mailbox may have changed or after idle_timeout seconds.
+        """
+        if self.has_idle():
+            return self.idle(timeout=idle_timeout)
+        # pop previous untagged responses (as the select one)
+        self.has_new_mails()
+        deadline = time.time() + idle_timeout
+        while time.time() < deadline:
+            time.sleep(min(poll_interval, max(deadline - time.time(), 0)))
+            self.connection.noop()
+            if self.has_new_mails():
+                return True
+        return False
+
+    def has_new_mails(self):
+        """Pop the EXISTS and RECENT untagged responses received since the last call
+
+        :return: True if there was one
+        """
+        exists = self.connection.response("EXISTS")[1][0]
+        recent = self.connection.response("RECENT")[1][0]
+        return bool(exists or recent)
 
     def disconnect(self):
         """Disconnect from IMAP server"""
+        self.flush_marks()
+        if isinstance(self.connection, DeflateMixin) and self.connection.data_bytes:
+            logger.info(
+                "IMAP COMPRESS=DEFLATE: received {} bytes for {} bytes of data".format(
+                    self.connection.wire_bytes, self.connection.data_bytes
+                )
+            )
         self.connection.close()
         self.connection.logout()
 
     def reset_errors(self):
         """Fetch all messages in error status and put them back in waiting"""
-        res, data = self.connection.search(None, u"KEYWORD error")
+        res, data = self.connection.uid("SEARCH", u"KEYWORD error")
         if res != "OK":
             logger.error("Unable to fetch mails")
             return []
-        amount = 0
-        for mail_id in data[0].split():
-            amount += 1
-            self.mark_reset_error(mail_id)
-        return amount
-
-    def get_mail(self, mail_id):
-        res, mail_data = self.connection.fetch(mail_id, "(RFC822)")
-        if res != "OK":
+        mail_ids = data[0].split()
+        self.mark_mails(mail_ids, "reset_error")
+        return len(mail_ids)
+
+    def get_mail(self, mail_id, size=None):
+        """Fetch a message. A message bigger than SPOOL_MIN_SIZE is fetched by chunks in a spool file (see
+        get_mail_spooled).
+
+        :param size: message size on the server, if known
+        """
+        if size and size > SPOOL_MIN_SIZE:
+            return self.get_mail_spooled(mail_id)
+        mail_body = fetched_body(*self.connection.uid("FETCH", mail_id, "(RFC822)"))
+        if mail_body is None:
             logger.error("Unable to fetch mail {0}".format(mail_id))
             return None
-        mail_body = mail_data[0][1]
-        if six.PY3:
-            try:
-                mail_body = mail_body.decode("utf-8")
-            except UnicodeDecodeError:
-                detection = chardet.detect(mail_body)
-                mail_body = mail_body.decode(detection["encoding"])
+        return self.parse_mail(mail_body)
+
+    def get_mail_spooled(self, mail_id, chunk_size=FETCH_CHUNK_SIZE):
+        """Fetch a message by partial chunks (BODY.PEEK[]<offset.length>) written in a temporary spool file, so that
+        at most one chunk of the raw message is in memory at a time.
+
+        :return: email message or None
+        """
+        with tempfile.TemporaryFile() as mail_file:
+            offset = 0
+            while True:
+                chunk = fetched_partial(*self.connection.uid("FETCH", mail_id, partial_fetch_items(offset, chunk_size)))
+                if chunk is None:
+                    logger.error("Unable to fetch mail {0} at offset {1}".format(mail_id, offset))
+                    return None
+                mail_file.write(chunk)
+                offset += len(chunk)
+                if len(chunk) < chunk_size:
+                    break
+                del chunk
+            return self.parse_mail_file(mail_file)
+
+    def get_mails(self, mail_ids, batch_size=200):
+        """Fetch messages by chunks of batch_size, with one UID FETCH command per chunk"""
+        return list(self.iter_mails(mail_ids, batch_size=batch_size))
+
+    def iter_mails(self, mail_ids, batch_size=200, max_batch_bytes=None, skeleton_min_size=None):
+        """Fetch messages lazily, by chunks of batch_size, with one UID FETCH command per chunk.
+
+        A chunk is fetched only when the previous one has been consumed, so that at most one chunk is kept in memory.
+
+        :param mail_ids: list of message uids
+        :param batch_size: maximum number of messages fetched with one FETCH command
+        :param max_batch_bytes: if given, maximum cumulated size of the messages fetched with one FETCH command
+        :param skeleton_min_size: if given, messages bigger than this size are first fetched as skeleton (see
+                                  get_mail_skeleton) and returned with partial=True
+        """
+        sizes = {}
+        if max_batch_bytes or skeleton_min_size:
+            sizes = self.get_sizes(mail_ids)
+        for chunk in fetch_batches(mail_ids, sizes, batch_size, max_batch_bytes):
+            # flags of the previous chunk are stored before fetching the next one
+            self.flush_marks()
+            skeleton_ids = []
+            for mail_id in skeleton_candidates(chunk, sizes, skeleton_min_size):
+                mail = self.get_mail_skeleton(mail_id)
+                if mail:  # otherwise fetched as usual
+                    skeleton_ids.append(mail_id)
+                    yield MailData(mail_id, mail, size=sizes[int(mail_id)], partial=True)
+            chunk = [mail_id for mail_id in chunk if mail_id not in skeleton_ids]
+            if not chunk:
+                continue
+            if len(chunk) == 1:
+                mail = self.get_mail(chunk[0], size=sizes.get(int(chunk[0])))
+                if mail:
+                    yield MailData(chunk[0], mail, size=sizes.get(int(chunk[0])))
+                continue
+            res, data = self.connection.uid("FETCH", message_set(chunk), "(UID FLAGS RFC822.SIZE BODY.PEEK[])")
+            if res != "OK":
+                logger.error("Unable to fetch mails {0}".format(message_set(chunk)))
+                continue
+            self.round_trips_saved += len(chunk) - 1
+            for mail_info in self.fetched_mails(data):
+                yield mail_info
+
+    def fetched_mails(self, data):
+        """Parse lazily the messages of a "FETCH (UID FLAGS RFC822.SIZE BODY[])" response.
+
+        The response list is emptied: a raw message is released as soon as it has been parsed.
+        """
+        fetched = split_fetch_response(data)
+        del data[:]
+        while fetched:
+            meta, mail_body = fetched.pop(0)
+            match = FETCH_UID_RE.search(meta)
+            if not match:
+                continue
+            mail = self.parse_mail(mail_body)
+            if not mail:
+                continue
+            flags = FETCH_FLAGS_RE.search(meta)
+            size = FETCH_SIZE_RE.search(meta)
+            yield MailData(
+                match.group(1),
+                mail,
+                flags=flags and tuple(flags.group(1).split()) or (),
+                size=size and int(size.group(1)) or None,
+            )
+
+    def get_sizes(self, mail_ids):
+        """Get the RFC822.SIZE of messages, with one FETCH command by chunk of 1000 messages
+
+        :return: dict {uid as int: size}
+        """
+        sizes = {}
+        for chunk in chunks(mail_ids, 1000):
+            res, data = self.connection.uid("FETCH", message_set(chunk), "(UID RFC822.SIZE)")
+            if res != "OK":
+                logger.error("Unable to fetch sizes of mails {0}".format(message_set(chunk)))
+                continue
+            sizes.update(parse_sizes(data))
+        return sizes
+
+    def get_mail_skeleton(self, mail_id):
+        """Get a light copy of a message, without downloading its big parts.
+
+        The BODYSTRUCTURE is fetched first, then the message header, each part MIME header and the content of text
+        parts and of parts smaller than SKELETON_PART_SIZE, with one FETCH command. Other parts are kept empty.
+        The headers, the origin and the forwarded message of the skeleton are the same as the full message ones.
+
+        :return: email message or None
+        """
+        res, data = self.connection.uid("FETCH", mail_id, "(UID BODYSTRUCTURE)")
+        if res != "OK" or not data or not data[0]:
+            logger.error("Unable to fetch structure of mail {0}".format(mail_id))
+            return None
+        structure = fetched_structure(data)
+        if structure is None:
+            return None
+        res, data = self.connection.uid("FETCH", mail_id, skeleton_fetch_items(structure))
+        if res != "OK":
+            logger.error("Unable to fetch skeleton of mail {0}".format(mail_id))
+            return None
+        return self.parse_mail(fetched_skeleton(structure, data))
+
+    def parse_mail(self, mail_body):
+        """Get an email message from raw fetched data.
+
+        Most messages are pure ascii (base64 or quoted-printable encoded parts): they are parsed from bytes, without
+        decoding. Other ones are decoded as utf-8 or, if not valid, with the charset detected on their non ascii lines
+        only.
+        """
+        if mail_body.isascii():
+            return email.message_from_bytes(mail_body, policy=email_policy)
+        try:
+            mail_body = mail_body.decode("utf-8")
+        except UnicodeDecodeError:
+            import chardet
+
+            sample = b"\n".join(line for line in mail_body.split(b"\n") if not line.isascii())
+            detection = chardet.detect(sample[:CHARSET_SAMPLE_SIZE])
+            mail_body = mail_body.decode(detection["encoding"] or "utf-8", "replace")
         mail = email.message_from_string(mail_body, policy=email_policy)
         return mail
 
-    def get_waiting_emails(self):
-        """Fetch all waiting messages"""
-        args = [u"NOT KEYWORD imported", u"NOT KEYWORD unsupported", u"NOT KEYWORD error", u"NOT KEYWORD ignored"]
-        # args = [u"KEYWORD imported"]
-        # args = ['SUBJECT "PERMANNE"']
-        res, data = self.connection.search(None, *args)
-        if res != "OK":
+    def parse_mail_file(self, mail_file):
+        """Get an email message from a raw message file (see parse_mail). A pure ascii message is parsed from the file
+        without loading it in memory as a whole."""
+        mail_file.seek(0)
+        is_ascii = all(block.isascii() for block in iter(lambda: mail_file.read(CHARSET_SAMPLE_SIZE), b""))
+        mail_file.seek(0)
+        if is_ascii:
+            return email.message_from_binary_file(mail_file, policy=email_policy)
+        return self.parse_mail(mail_file.read())
+
+    def get_waiting_emails(self, batch_size=1):
+        """Fetch all waiting messages.
+
+        :param batch_size: number of messages fetched with one FETCH command (1 fetches them one by one)
+        """
+        return list(self.iter_waiting_emails(batch_size=batch_size))
+
+    def iter_waiting_emails(self, batch_size=1, max_batch_bytes=None, skeleton_min_size=None):
+        """Fetch lazily waiting messages: a message is fetched only when the previous ones have been consumed.
+
+        When a sync state has been loaded (see load_sync_state), the mailbox STATUS is compared with it: nothing is
+        searched if the mailbox hasn't changed, and only messages added or modified since the last complete run are
+        searched if the server supports CONDSTORE. The new sync state is saved by end_sync, only when all searched
+        messages have been fetched, consumed and flagged (and never in dev mode, where they are not flagged): otherwise
+        the previous state is kept, so that the messages not flagged are searched again by the next run.
+
+        :param batch_size: number of messages fetched with one FETCH command (1 fetches them one by one)
+        :param max_batch_bytes: maximum cumulated size of messages fetched with one FETCH command
+        :param skeleton_min_size: messages bigger than this size are first fetched as skeleton (see iter_mails)
+        """
+        self.pending_sync_state = None
+        status = self.sync_state_path is not None and self.status() or None
+        args = waiting_search_criteria(self.sync_state, status)
+        if args is None:
+            logger.debug("Mailbox unchanged since last run")
+            return
+        mail_ids = self.search(*args)
+        if mail_ids is None:
             logger.error("Unable to fetch mails")
-            return []
-        waiting = []
-        for mail_id in data[0].split():
-            # if mail_id != b'388': continue
-            mail = self.get_mail(mail_id)
-            if not mail:
-                continue
-            mail_infos = MailData(mail_id, mail)
-            waiting.append(mail_infos)
-        return waiting
+            return
+        not_fetched = set(int(mail_id) for mail_id in mail_ids)
+        for mail_info in self.iter_mails(
+            mail_ids,
+            batch_size=batch_size,
+            max_batch_bytes=max_batch_bytes,
+            skeleton_min_size=skeleton_min_size,
+        ):
+            not_fetched.discard(int(mail_info.id))
+            yield mail_info
+        self.end_fetch(status, not_fetched)
+
+    def end_fetch(self, status, not_fetched):
+        """Keep the mailbox status reached by a run, to be saved as sync state by end_sync once the fetched messages are
+        flagged, unless some searched messages were not fetched or in dev mode (where they are not flagged)"""
+        if not status or dev_mode:
+            return
+        if not_fetched:
+            logger.warning("Sync state not saved: {} mails not fetched".format(len(not_fetched)))
+        else:
+            self.pending_sync_state = status
+
+    def end_sync(self, flags_stored):
+        """Save the mailbox status reached by the last complete iter_waiting_emails run as sync state. Until then, the
+        previous state is kept: if the run is killed, the messages not flagged are searched again by the next run.
+
+        :param flags_stored: True if the flags of all the fetched messages are stored (see flush_marks)
+        """
+        status, self.pending_sync_state = self.pending_sync_state, None
+        if status is None:
+            return
+        if flags_stored:
+            self.save_sync_state(status)
+        else:
+            logger.warning("Sync state not saved: flags not stored")
+
+    def has_condstore(self):
+        """Check if the server supports CONDSTORE (QRESYNC implies it)"""
+        return "CONDSTORE" in self.connection.capabilities or "QRESYNC" in self.connection.capabilities
+
+    def status(self, mailbox="INBOX"):
+        """Get mailbox UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ (if CONDSTORE is supported) with one STATUS command"""
+        res, data = self.connection.status(mailbox, status_items(self.has_condstore()))
+        if res != "OK" or not data or not data[0]:
+            logger.error("Unable to get status of {}".format(mailbox))
+            return None
+        return parse_status(data)
+
+    def load_sync_state(self, path):
+        """Load the sync state of the previous run from a json file. The state is saved in this file after each
+        complete run. Removing the file forces a full search."""
+        self.sync_state_path = path
+        self.sync_state = None
+        if os.path.exists(path):
+            try:
+                with open(path) as state_file:
+                    self.sync_state = json.load(state_file)
+            except ValueError:
+                logger.warning("Ignored invalid sync state file {}".format(path))
+
+    def save_sync_state(self, status):
+        """Save the sync state in a json file"""
+        self.sync_state = status
+        tmp_path = "{}.tmp".format(self.sync_state_path)
+        with open(tmp_path, "w") as state_file:
+            json.dump(status, state_file)
+        os.replace(tmp_path, self.sync_state_path)
 
     def should_handle(self, mail_id):
-        res, flags_data = self.connection.fetch(mail_id, "(FLAGS)")
+        res, flags_data = self.connection.uid("FETCH", mail_id, "(FLAGS)")
         if res != "OK":
             logger.error("Unable to fetch flags for mail {0}".format(mail_id))
             return False
@@ -97,38 +898,47 @@ class IMAPEmailHandler(object):
         return True
 
     def list_last_emails(self, nb=20):
-        """List last messages"""
+        """List last messages.
+
+        Date, from and subject of the messages and of their forwarded message are got from ENVELOPE and BODYSTRUCTURE
+        (which contains the envelope of message/rfc822 parts) with one FETCH command. A message is downloaded and
+        parsed only if its forwarded message isn't attached as message/rfc822.
+        """
         # args = [u"NOT KEYWORD imported", u"NOT KEYWORD unsupported", u"NOT KEYWORD error", u"NOT KEYWORD ignored"]
         # args = ['SUBJECT "PERMANNE"']
         args = ["ALL"]
-        res, data = self.connection.search(None, *args)
+        res, data = self.connection.uid("SEARCH", *args)
         if res != "OK":
             logger.error("Unable to fetch mails")
             return []
         lst = []
-        for mail_id in data[0].split()[-nb:]:
-            res, flags_data = self.connection.fetch(mail_id, "(FLAGS)")
-            if res != "OK":
-                logger.error("Unable to fetch flags for mail {0}".format(mail_id))
-                continue
-            flags = imaplib.ParseFlags(flags_data[0])
-            if isinstance(mail_id, bytes):
-                mail_id = mail_id.decode()
-                flags = [fl.decode() for fl in flags]
-            mail = self.get_mail(mail_id)
-            if not mail:
-                continue
-            parser = Parser(mail, dev_mode, mail_id)
-            parsed_orig_mail = MailParser(mail)
-            r_date = reception_date(mail)
+        for items in self.iter_envelopes(data[0].split()[-nb:]):
+            mail_id = items[b"UID"].decode()
+            flags = [flag.decode() for flag in items.get(b"FLAGS") or []]
+            envelope = items.get(b"ENVELOPE") or [None] * 10
+            r_date = localized_date(safe_text(envelope[0] or b""))
+            if not r_date and items.get(b"INTERNALDATE"):
+                internal_date = imaplib.Internaldate2tuple(b'INTERNALDATE "' + items[b"INTERNALDATE"] + b'"')
+                r_date = internal_date and time.strftime("%Y-%m-%d %H:%M", internal_date) or ""
+            forwarded = forwarded_envelope(items.get(b"BODYSTRUCTURE") or [])
+            if forwarded:
+                fwd_from, fwd_subject = envelope_address(forwarded[2]), decode_header_value(forwarded[1])
+            else:
+                from imio.email.parser.parser import Parser
+
+                mail = self.get_mail(mail_id)
+                if not mail:
+                    continue
+                parser = Parser(mail, dev_mode, mail_id)
+                fwd_from, fwd_subject = parser.parsed_message.headers.get("From"), parser.headers["Subject"]
             lst.append(
                 u"{}, {}: '{}', '{}', '{}', '{}', {}".format(
                     r_date,
                     mail_id,
-                    parsed_orig_mail.headers["From"],
-                    parsed_orig_mail.subject,
-                    parser.parsed_message.headers.get("From"),
-                    parser.headers["Subject"],
+                    envelope_address(envelope[2]),
+                    decode_header_value(envelope[1]),
+                    fwd_from,
+                    fwd_subject,
                     flags,
                 )
             )
@@ -136,61 +946,167 @@ class IMAPEmailHandler(object):
             logger.info(lst[-1])
         return lst
 
-    def stats(self):
-        """List all flags"""
-        res, data = self.connection.search(None, "ALL")
+    def iter_envelopes(self, mail_ids, chunk_size=STORE_CHUNK_SIZE):
+        """Fetch UID, FLAGS, INTERNALDATE, ENVELOPE and BODYSTRUCTURE of messages, with one FETCH command by chunk
+
+        :return: generator of dicts {b"UID": b"101", b"ENVELOPE": [...], ...}
+        """
+        for chunk in chunks(mail_ids, chunk_size):
+            res, data = self.connection.uid(
+                "FETCH", message_set(chunk), "(UID FLAGS INTERNALDATE ENVELOPE BODYSTRUCTURE)"
+            )
+            if res != "OK":
+                logger.error("Unable to fetch envelopes of mails {0}".format(message_set(chunk)))
+                continue
+            for group in group_fetch_response(data):
+                fetched = parse_imap_list(inline_literals(group))
+                if len(fetched) < 2 or not isinstance(fetched[1], list):
+                    continue
+                items = dict(zip(fetched[1][::2], fetched[1][1::2]))
+                if items.get(b"UID"):
+                    yield items
+
+    def get_subjects(self, mail_ids):
+        """Get the subject of the forwarded message, or of the message itself, without downloading the messages
+
+        :return: dict {uid as int: subject}
+        """
+        subjects = {}
+        for items in self.iter_envelopes(mail_ids):
+            envelope = forwarded_envelope(items.get(b"BODYSTRUCTURE") or []) or items.get(b"ENVELOPE") or [None] * 10
+            subjects[int(items[b"UID"])] = decode_header_value(envelope[1])
+        return subjects
+
+    def search(self, *criteria):
+        """Search messages
+
+        :return: list of uids or None if the search failed
+        """
+        res, data = self.connection.uid("SEARCH", *criteria)
         if res != "OK":
-            logger.error("Unable to fetch mails")
-            return []
-        lst = []
+            return None
+        return data[0].split()
+
+    def delete_mails(self, mail_ids):
+        """Flag messages as deleted and expunge them, with ranged commands by chunk of STORE_CHUNK_SIZE messages.
+
+        Only given messages are expunged if the server supports UIDPLUS (UID EXPUNGE).
+
+        :return: True if all commands succeeded
+        """
+        success = True
+        uidplus = "UIDPLUS" in self.connection.capabilities
+        for chunk in chunks(list(mail_ids), STORE_CHUNK_SIZE):
+            uids = message_set(chunk)
+            res, data = self.connection.uid("STORE", uids, "+FLAGS.SILENT", "(\\Deleted)")
+            if res != "OK":
+                logger.error("Unable to flag as deleted mails {}".format(uids))
+                success = False
+                continue
+            if uidplus:
+                res, data = self.connection.uid("EXPUNGE", uids)
+                if res != "OK":
+                    logger.error("Unable to expunge mails {}".format(uids))
+                    success = False
+        if not uidplus and mail_ids:
+            res, data = self.connection.expunge()
+            success = success and res == "OK"
+        return success
+
+    def stats(self, since=None, before=None):
+        """List all flags, with ranged FETCH commands.
+
+        :param since: if given, only consider mails received since this date
+        :param before: if given, only consider mails received before this date
+        """
         stats = {"tot": 0, "flags": {}}
-        for mail_id in data[0].split():
-            stats["tot"] += 1
-            res, flags_data = self.connection.fetch(mail_id, "(FLAGS)")
+        if since is None and before is None:
+            message_sets = ["1:*"]
+        else:
+            args = []
+            if since is not None:
+                args.append("SINCE {}".format(since.strftime("%d-%b-%Y")))
+            if before is not None:
+                args.append("BEFORE {}".format(before.strftime("%d-%b-%Y")))
+            res, data = self.connection.uid("SEARCH", *args)
+            if res != "OK":
+                logger.error("Unable to fetch mails")
+                return stats
+            message_sets = [message_set(chunk) for chunk in chunks(data[0].split(), STORE_CHUNK_SIZE)]
+        for uids in message_sets:
+            res, flags_data = self.connection.uid("FETCH", uids, "(FLAGS)")
             if res != "OK":
-                logger.error("Unable to fetch flags for mail {0}".format(mail_id))
+                logger.error("Unable to fetch flags for mails {0}".format(uids))
                 continue
-            for flag in imaplib.ParseFlags(flags_data[0]):
-                flag = flag.decode()
-                if flag not in stats["flags"]:
-                    stats["flags"][flag] = 0
-                stats["flags"][flag] += 1
+            for line in flags_data:
+                if isinstance(line, tuple):
+                    line = line[0]
+                if not line:
+                    continue
+                stats["tot"] += 1
+                for flag in imaplib.ParseFlags(line):
+                    flag = flag.decode()
+                    if flag not in stats["flags"]:
+                        stats["flags"][flag] = 0
+                    stats["flags"][flag] += 1
         return stats
 
+    def mark_mails(self, mail_ids, transition):
+        """Apply a flags transition (see FLAG_TRANSITIONS) on a set of mails, with at most two UID STORE commands
+        by chunk of STORE_CHUNK_SIZE mails
+
+        :return: True if all commands succeeded
+        """
+        success = True
+        for args in store_commands(mail_ids, transition):
+            res, data = self.connection.uid("STORE", *args)
+            if res != "OK":
+                logger.error("Unable to store flags {} {} of mails {}".format(args[1], args[2], args[0]))
+                success = False
+        return success
+
+    def queue_mark(self, mail_id, transition):
+        """Defer a flags transition on a mail until flush_marks is called"""
+        self.pending_marks.setdefault(transition, []).append(mail_id)
+
+    def flush_marks(self):
+        """Apply all deferred flags transitions, grouped by transition. A transition is removed from the queue only
+        once stored: if storing it fails or raises, it's stored again by the next call.
+
+        :return: True if all deferred transitions are stored
+        """
+        success = True
+        for transition, mail_ids in list(self.pending_marks.items()):
+            if self.mark_mails(mail_ids, transition):
+                del self.pending_marks[transition]
+            else:
+                success = False
+        return success
+
     def mark_reset_error(self, mail_id):
         """Reset 'error' / 'waiting' flags on specified mail"""
-        self.connection.store(mail_id, "-FLAGS", "imported")
-        self.connection.store(mail_id, "-FLAGS", "error")
-        self.connection.store(mail_id, "+FLAGS", "waiting")
+        self.mark_mails([mail_id], "reset_error")
 
     def mark_reset_ignored(self, mail_id):
         """Reset 'ignored' / 'waiting' flags on specified mail"""
-        self.connection.store(mail_id, "-FLAGS", "imported")
-        self.connection.store(mail_id, "-FLAGS", "ignored")
-        self.connection.store(mail_id, "+FLAGS", "waiting")
+        self.mark_mails([mail_id], "reset_ignored")
 
     def mark_reset_all(self, mail_id):
         """Reset all flags on specified mail"""
-        self.connection.store(mail_id, "-FLAGS", "imported error ignored unsupported")
-        # self.connection.store(mail_id, "+FLAGS", "waiting")
+        self.mark_mails([mail_id], "reset_all")
 
     def mark_mail_as_imported(self, mail_id):
         """(Un)Mark 'imported' / 'waiting' flags on specified mail"""
-        self.connection.store(mail_id, "-FLAGS", "waiting")
-        self.connection.store(mail_id, "-FLAGS", "error")
-        self.connection.store(mail_id, "+FLAGS", "imported")
+        self.mark_mails([mail_id], "imported")
 
     def mark_mail_as_error(self, mail_id):
         """(Un)Mark 'error' / 'waiting' flags on specified mail"""
-        self.connection.store(mail_id, "-FLAGS", "waiting")
-        self.connection.store(mail_id, "+FLAGS", "error")
+        self.mark_mails([mail_id], "error")
 
     def mark_mail_as_unsupported(self, mail_id):
         """(Un)Mark 'unsupported' / 'waiting' flags on specified mail"""
-        self.connection.store(mail_id, "-FLAGS", "waiting")
-        self.connection.store(mail_id, "+FLAGS", "unsupported")
+        self.mark_mails([mail_id], "unsupported")
 
     def mark_mail_as_ignored(self, mail_id):
         """(Un)Mark 'ignore' / 'waiting' flags on specified mail"""
-        self.connection.store(mail_id, "-FLAGS", "waiting")
-        self.connection.store(mail_id, "+FLAGS", "ignored")
+        self.mark_mails([mail_id], "ignored")
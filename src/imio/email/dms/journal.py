@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Append-only journal of the emails handling steps, to resume the work of a killed run"""
+from imio.email.dms.utils import get_next_id
+from imio.email.dms.utils import safe_text
+from imio.email.dms.utils import set_next_id
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger("imio.email.dms")
+
+STEPS = ("fetched", "rendered", "packaged", "metadata_posted", "uploaded", "flagged")
+# steps following an external side effect are synced on disk
+SYNC_STEPS = ("metadata_posted", "uploaded", "flagged")
+JOURNAL_MAX_AGE = 30 * 24 * 3600  # unfinished entries older than this are dropped when the journal is opened
+
+
+class Journal(object):
+    """Journal of the steps reached by each email, keyed by UID and Message-ID.
+
+    Each step is appended as a json line, with its data (file paths, external id, ...). Once the email is flagged,
+    its entry is finished. When the journal is opened, the finished entries are dropped and the unfinished ones are
+    kept: they are the emails being handled when a previous run was killed, which can so resume from their last
+    step instead of being rendered and uploaded again. A torn last line is ignored.
+    """
+
+    def __init__(self, path, max_age=JOURNAL_MAX_AGE):
+        self.path = str(path)
+        self.entries = {}  # {key: {step: time, data key: value}}
+        self.lock = threading.Lock()
+        self.finished = []
+        self.load(max_age)
+        self.file = open(self.path, "a")
+
+    @staticmethod
+    def key(mail_info):
+        message_id = mail_info.mail is not None and mail_info.mail.get("Message-ID") or ""
+        return "{}:{}".format(safe_text(mail_info.id), safe_text(message_id).strip())
+
+    def load(self, max_age):
+        """Read the journal and rewrite it with the unfinished entries only"""
+        if os.path.exists(self.path):
+            with open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning("Ignored invalid journal line '{}'".format(line.strip()))
+                        continue
+                    self._apply(record)
+        limit = time.time() - max_age
+        for key, entry in list(self.entries.items()):
+            if max(entry.get(step, 0) for step in STEPS) < limit:
+                logger.warning("Dropped journal entry {} older than {} days".format(key, max_age // 86400))
+                del self.entries[key]
+        if self.entries:
+            logger.info("Journal: {} emails to resume".format(len(self.entries)))
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as journal_file:
+            for key, entry in self.entries.items():
+                journal_file.write(json.dumps(dict(entry, key=key)) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _apply(self, record):
+        key = record.pop("key")
+        step = record.pop("step", None)
+        if step == "flagged":
+            self.entries.pop(key, None)
+            return
+        entry = self.entries.setdefault(key, {})
+        if step:
+            entry[step] = record.pop("time")
+        entry.update(record)
+
+    def get(self, mail_info):
+        """Get the steps reached and the data recorded for an email by a previous run
+
+        :return: dict, empty if the email has no unfinished entry
+        """
+        with self.lock:
+            return dict(self.entries.get(self.key(mail_info), {}))
+
+    def record(self, mail_info, step, **data):
+        """Append a step reached by an email, with its data"""
+        self._write([dict(data, key=self.key(mail_info), step=step, time=time.time())])
+
+    def _write(self, records):
+        with self.lock:
+            for record in records:
+                self.file.write(json.dumps(record) + "\n")
+                self._apply(dict(record))
+            self.file.flush()
+            if any(record["step"] in SYNC_STEPS for record in records):
+                os.fsync(self.file.fileno())
+
+    def finish(self, mail_info):
+        """Mark an email as finished: the step 'flagged' is recorded by flush, once its flags are stored"""
+        with self.lock:
+            self.finished.append(self.key(mail_info))
+
+    def flush(self):
+        """Record the finished emails as flagged (after the handler flush_marks)"""
+        with self.lock:
+            finished, self.finished = self.finished, []
+        now = time.time()
+        self._write([{"key": key, "step": "flagged", "time": now} for key in finished])
+
+    def reserve_ids(self, config):
+        """Keep the counter after the external ids given to unfinished entries, as their metadata may have been posted
+        before the counter was saved"""
+        with self.lock:
+            ids = [entry["next_id"] for entry in self.entries.values() if "next_id" in entry]
+        if not ids:
+            return
+        next_id, client_id = get_next_id(config, {"nid": None})
+        if next_id <= max(ids):
+            logger.warning("Journal: counter {} set to {}, already given to a sent email".format(client_id, max(ids)))
+            set_next_id(config, max(ids))
+
+    def close(self):
+        self.file.close()
@@ -2,7 +2,9 @@
 
 """
 Usage: process_mails FILE [--requeue_errors] [--list_emails=<number>] [--get_eml=<mail_id>] [--gen_pdf=<mail_id>]
-                          [--eml_orig] [--reset_flags=<mail_id>] [--test_eml=<path>] [--stats] [--mail_id=<mail_id>]
+                          [--eml_orig] [--reset_flags=<mail_id>] [--test_eml=<path>] [--stats] [--since=<date>]
+                          [--before=<date>] [--mail_id=<mail_id>] [--daemon] [--asyncio]
+                          [--workers=<number>]
 
 Arguments:
     FILE         config file
@@ -11,27 +13,48 @@ Options:
     -h --help               Show this screen.
     --requeue_errors        Put email in error status back in waiting for processing.
     --list_emails=<number>  List last xx emails.
-    --get_eml=<mail_id>     Get eml of original/contained email id.
+    --get_eml=<mail_id>     Get eml of original/contained email uid.
     --eml_orig              With --get_eml or --test_eml, consider original mail not contained.
-    --gen_pdf=<mail_id>     Generate pdf of contained email id.
-    --reset_flags=<mail_id> Reset all flags of email id.
+    --gen_pdf=<mail_id>     Generate pdf of contained email uid.
+    --reset_flags=<mail_id> Reset all flags of email uid and forget its fingerprint, so that a duplicate is imported.
     --test_eml=<path>       Test an eml handling.
     --stats                 Get email stats following stats.
-    --mail_id=<mail_id>     Use this mail id.
+    --since=<date>          With --stats, consider emails received since this date (YYYY-MM-DD).
+    --before=<date>         With --stats, consider emails received before this date (YYYY-MM-DD).
+    --mail_id=<mail_id>     Use this mail uid.
+    --daemon                Keep running and handle emails as they arrive (IMAP IDLE).
+    --asyncio               Handle waiting emails with the asyncio IMAP backend, fetching, rendering and uploading
+                            concurrently.
+    --workers=<number>      Number of threads parsing and rendering emails [default: 1] (see [pipeline] config).
 """
-from bs4 import BeautifulSoup
 from datetime import datetime
 from datetime import timedelta
 from docopt import docopt
-from email2pdf2 import email2pdf2
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from functools import partial
+from functools import wraps
 from hashlib import md5
 from imio.email.dms import dev_mode
 from imio.email.dms import logger
+from imio.email.dms.cache import link_or_copy
+from imio.email.dms.cache import TRANSFORM_CACHE_MAX_SIZE
+from imio.email.dms.cache import TransformCache
+from imio.email.dms.cache import WORK_CACHE_MAX_AGE
+from imio.email.dms.cache import WORK_CACHE_MAX_SIZE
+from imio.email.dms.cache import WorkCache
+from imio.email.dms.fingerprints import fingerprint
+from imio.email.dms.fingerprints import FingerprintIndex
+from imio.email.dms.fingerprints import FINGERPRINTS_MAX
 from imio.email.dms.imap import IMAPEmailHandler
 from imio.email.dms.imap import MailData
+from imio.email.dms.journal import Journal
+from imio.email.dms.journal import STEPS
+from imio.email.dms.pipeline import Pipeline
+from imio.email.dms.pipeline import ProcessPool
+from imio.email.dms.pipeline import Stage
+from imio.email.dms.utils import estimate_jpeg_quality
 from imio.email.dms.utils import get_next_id
 from imio.email.dms.utils import get_reduced_size
 from imio.email.dms.utils import get_unique_name
@@ -40,15 +63,7 @@ from imio.email.dms.utils import save_as_eml
 from imio.email.dms.utils import save_attachment  # noqa
 from imio.email.dms.utils import set_next_id
 from imio.email.parser import email_policy  # noqa
-from imio.email.parser.parser import Parser  # noqa
-from imio.email.parser.utils import stop  # noqa
-from imio.email.parser.utils import structure  # noqa
-from imio.pyutils.system import runCommand
 from io import BytesIO
-from PIL import Image
-from PIL import ImageFile
-from PIL import ImageOps
-from PIL import UnidentifiedImageError
 from smtplib import SMTP
 from time import sleep
 from xml.etree.ElementTree import ParseError
@@ -60,11 +75,14 @@ import imaplib
 import json
 import os
 import re
-import requests
+import shutil
+import signal
 import six
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 import zc.lockfile
 
 
@@ -75,12 +93,20 @@ except ImportError:
 
 
 dev_infos = {"nid": None}
+work_caches = {}  # {directory: WorkCache}
+transform_caches = {}  # {directory: TransformCache}
+fingerprint_indexes = {}  # {path: FingerprintIndex}
+image_pools = {}  # {(workers, per_mail): ProcessPool}
+shared_lock = threading.Lock()  # guards the creation of the caches, indexes and pools above, shared by the threads
 img_size_limit = 1024
-# originally 89478485 => blocks at > 13300 pixels square
-Image.MAX_IMAGE_PIXELS = None
-# OSError: broken data stream when reading image file
-ImageFile.LOAD_TRUNCATED_IMAGES = True
 EXIF_ORIENTATION = 0x0112
+JPEG_QUALITY = 75
+IMAGE_MIN_QUALITY = 40  # lowest jpeg quality used to meet a byte budget, before reducing the image
+IMAGE_MAX_TRIALS = 6  # encodes to meet a byte budget
+IMAGE_MAX_PIXELS = 50000000  # pixels decoded at most, 4 bytes by pixel
+IMAGE_MIN_GAIN = 0.1  # a transformed image is kept if it's at least 10% smaller
+image_stats = {"probed": 0, "unchanged": 0, "negligible": 0, "oversized": 0, "probe_time": 0.0}
+image_stats_lock = threading.Lock()
 MAX_SIZE_ATTACH = 19000000
 
 
@@ -122,7 +148,24 @@ def get_preview_pdf_path(config, mail_id):
     return os.path.join(output_dir, filename)
 
 
+def load_pil():
+    """Import PIL, slow to import, when images are handled and set its options.
+
+    :return: PIL.Image module
+    """
+    from PIL import Image
+    from PIL import ImageFile
+
+    # originally 89478485 => blocks at > 13300 pixels square. Bigger images are passed through (see IMAGE_MAX_PIXELS)
+    Image.MAX_IMAGE_PIXELS = None
+    # OSError: broken data stream when reading image file
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    return Image
+
+
 def compress_pdf(original_pdf_content):
+    from imio.pyutils.system import runCommand
+
     with tempfile.NamedTemporaryFile(mode="wb", delete=False, suffix=".pdf") as input_temp_file:
         input_temp_file.write(original_pdf_content)
         input_temp_file_name = input_temp_file.name
@@ -159,15 +202,19 @@ def compress_pdf(original_pdf_content):
     return compressed_pdf_content
 
 
-def modify_attachments(mail_id, attachments, with_inline=True):
+def modify_attachments(mail_id, attachments, with_inline=True, pool=None, cache=None, budget=None):
     """Modify parser attachments by reducing images size
 
     :param mail_id: mail id
     :param attachments: list of attachments
     :param with_inline: keep inline images to reduce size too
+    :param pool: ProcessPool transforming the images (see get_image_pool), or None to transform them here
+    :param cache: TransformCache giving the images and pdf files already transformed (see get_transform_cache)
+    :param budget: budget of the attached images (see get_image_budget)
     :return: new list of attachments
     """
     new_lst = []
+    images = []  # (index in new_lst, is_inline)
     for dic in attachments:
         # {k: v for k, v in dic.items() if k != 'content'}
         is_inline = False
@@ -180,85 +227,336 @@ def modify_attachments(mail_id, attachments, with_inline=True):
                     logger.info("{}: skipped inline image '{}' of size {}".format(mail_id, dic["filename"], dic["len"]))
                 continue
         if dic["type"].startswith("image/"):
-            orient_mod = size_mod = False
-            try:
-                img = Image.open(BytesIO(dic["content"]))
-            except UnidentifiedImageError:
-                if not is_inline:
-                    new_lst.append(dic)  # kept original image
-                continue
-            except Image.DecompressionBombError:  # never append because Image.MAX_IMAGE_PIXELS is set to None
-                continue
+            images.append((len(new_lst), is_inline))
+        new_lst.append(dic)
+    to_transform = []  # (index in new_lst, cache key, args of transform_image)
+    for (index, is_inline), max_bytes in zip(images, get_image_budgets(new_lst, images, budget)):
+        dic = new_lst[index]
+        max_trials = budget and budget["trials"] or IMAGE_MAX_TRIALS
+        max_pixels = budget and budget["pixels"] or IMAGE_MAX_PIXELS
+        if check_image(dic, is_inline, max_bytes, max_pixels):
             dic["is_inline"] = is_inline
-            try:
-                exif = img.getexif()
-                orient = exif.get(EXIF_ORIENTATION, 0)
-            except ParseError:
-                logger.warning(
-                    "{}: error getting exif info for image '{}', ignored orientation".format(mail_id, dic["filename"])
-                )
-                orient = 0
-            new_img = img
-            # if problem, si ImageMagik use https://github.com/IMIO/appy/blob/master/appy/pod/doc_importers.py#L545
-            if not is_inline and orient and orient != 1:
-                try:
-                    new_img = ImageOps.exif_transpose(img)
-                    orient_mod = True
-                    if dev_mode:
-                        logger.info("{}: reoriented image '{}' from {}".format(mail_id, dic["filename"], orient))
-                except Exception:
-                    pass
-            is_reduced = False
-            if is_inline:
-                is_reduced, new_size = get_reduced_size(new_img.size, (1000, None))
-            elif dic["len"] > 100000:
-                is_reduced, new_size = get_reduced_size(new_img.size, (img_size_limit, img_size_limit))
-            if is_reduced:
-                if dev_mode:
-                    logger.info("{}: resized image '{}'".format(mail_id, dic["filename"]))
-                # see https://pillow.readthedocs.io/en/stable/handbook/concepts.html#filters
-                new_img = new_img.resize(new_size, Image.BICUBIC)
-                dic["size"] = new_size
-                size_mod = True
-
-            if size_mod or orient_mod:
-                new_bytes = BytesIO()
-                # save the image in new_bytes
-                try:
-                    new_img.save(new_bytes, format=img.format, optimize=True, quality=75)
-                except ValueError:
-                    new_img.save(new_bytes, format=img.format, optimize=True)
-                new_content = new_bytes.getvalue()
-                new_len = len(new_content)
-                if orient_mod or (new_len < dic["len"] and float(new_len / dic["len"]) < 0.9):
-                    #                                      more than 10% of difference
-                    dic["filename"] = re.sub(r"(\.\w+)$", r"-(redimensionné)\1", dic["filename"])
-                    if dev_mode:
-                        logger.info(
-                            "{}: new image '{}' ({} => {}){}".format(
-                                mail_id, dic["filename"], dic["len"], new_len, is_inline and " (inline)" or ""
-                            )
-                        )
-                    dic["len"] = new_len
-                    dic["content"] = new_content
-                    dic["modified"] = True
-
-        if dic["type"] == "application/pdf":
-            new_content = compress_pdf(dic["content"])
+            continue
+        args = (mail_id, dic, is_inline, max_bytes, max_trials, max_pixels)
+        key = cache is not None and cache.key(dic["content"], ("image", img_size_limit) + args[2:]) or None
+        cached = key and cache.get(key)
+        if cached is not None:
+            new_lst[index] = apply_image_result(dic, cached)
+        else:
+            to_transform.append((index, key, args))
+    # the first images are submitted to the pool before the pdf files are compressed
+    if pool is not None:
+        results = pool.map(transform_image, [args for index, key, args in to_transform])
+    else:
+        results = (transform_image(*args) for index, key, args in to_transform)
+    for dic in new_lst:
+        if dic is not None and dic["type"] == "application/pdf":
+            key = cache is not None and cache.key(dic["content"], ("pdf", "ebook")) or None
+            new_content = key and cache.get(key)
+            if new_content is None:
+                new_content = compress_pdf(dic["content"])
+                if key:
+                    cache.put(key, new_content)
             new_len = len(new_content)
             if new_len < dic["len"] and float(new_len / dic["len"]) < 0.9:
                 dic["content"] = new_content
                 dic["len"] = new_len
-                dic["filename"] = re.sub(r"(\.\w+)$", r"-(redimensionné)\1", dic["filename"])
+                dic["filename"] = resized_filename(dic["filename"])
                 dic["modified"] = True
                 if dev_mode:
                     logger.info("{}: new pdf '{}' ({} => {})".format(mail_id, dic["filename"], dic["len"], new_len))
+    for (index, key, args), result in zip(to_transform, results):
+        new_lst[index] = result
+        if key:
+            cache.put(key, get_image_result(result))
+    return [dic for dic in new_lst if dic is not None]
 
-        new_lst.append(dic)
-    return new_lst
+
+def check_image(dic, is_inline, max_bytes=None, max_pixels=IMAGE_MAX_PIXELS):
+    """Probe an image to know if it can be passed through untouched: it's within its byte budget and it needs no
+    transform or its reduction would save less than IMAGE_MIN_GAIN. It's also passed through if it's too big to be
+    decoded within max_pixels, even at the reduced scale of a jpeg image (1/8).
+
+    :return: 'unchanged', 'negligible' (gain) or 'oversized' if the image is passed through, otherwise None
+    """
+    start = time.monotonic()
+    probe = probe_image(dic["content"])
+    skipped = None
+    pixels = probe is not None and probe["size"][0] * probe["size"][1] or 0
+    if pixels > max_pixels and (probe["format"] != "JPEG" or pixels > 64 * max_pixels):
+        skipped = "oversized"
+    elif probe is not None and (max_bytes is None or dic["len"] <= max_bytes):
+        reorient, new_size = get_image_transforms(probe["size"], probe["orientation"], dic["len"], is_inline)
+        if not reorient and new_size is None:
+            skipped = "unchanged"
+        elif not reorient and is_gain_negligible(probe, new_size):
+            skipped = "negligible"
+    record_image_probe(time.monotonic() - start, skipped)
+    return skipped
+
+
+def probe_image(content):
+    """Read the header of an image only, without decoding it.
+
+    :return: dict with format, size, orientation (exif) and quality (estimated for a jpeg image), or None if the image
+             isn't identified
+    """
+    from PIL import UnidentifiedImageError
+
+    Image = load_pil()
+    try:
+        img = Image.open(BytesIO(content))
+    except (UnidentifiedImageError, Image.DecompressionBombError):
+        return None
+    try:
+        orient = get_orientation(img)
+    except Exception:
+        orient = 0
+    quantization = getattr(img, "quantization", None)
+    return {
+        "format": img.format,
+        "size": img.size,
+        "orientation": orient,
+        "quality": quantization and estimate_jpeg_quality(quantization[0]) or None,
+    }
+
+
+def get_orientation(img):
+    """Get the exif orientation of an opened image, without decoding it"""
+    Image = load_pil()
+    if img.format == "PNG":
+        # getexif decodes a png image to find an exif chunk after the image data
+        exif = Image.Exif()
+        exif.load(img.info.get("exif"))
+    else:
+        exif = img.getexif()
+    return exif.get(EXIF_ORIENTATION, 0)
+
+
+def get_image_transforms(size, orient, length, is_inline):
+    """Get the transforms of an image: (reorient, new size once reoriented or None if it's not reduced)"""
+    reorient = bool(not is_inline and orient and orient != 1)
+    # width and height are swapped by the orientations with a rotation of 90°
+    if reorient and orient in (5, 6, 7, 8):
+        size = size[::-1]
+    is_reduced = False
+    if is_inline:
+        is_reduced, new_size = get_reduced_size(size, (1000, None))
+    elif length > 100000:
+        is_reduced, new_size = get_reduced_size(size, (img_size_limit, img_size_limit))
+    return reorient, is_reduced and new_size or None
+
+
+def is_gain_negligible(probe, new_size):
+    """Predict if reducing an image saves less than IMAGE_MIN_GAIN: too few pixels are removed and a jpeg image isn't
+    saved with a lower quality"""
+    width, height = probe["size"]
+    pixels_ratio = new_size[0] * new_size[1] / float(width * height)
+    return pixels_ratio > 1 - IMAGE_MIN_GAIN and (probe["quality"] or 0) <= JPEG_QUALITY
+
+
+def record_image_probe(seconds, skipped):
+    """Record the duration of an image probe and if the image was skipped ('unchanged', 'negligible' or 'oversized')"""
+    with image_stats_lock:
+        image_stats["probed"] += 1
+        image_stats["probe_time"] += seconds
+        if skipped:
+            image_stats[skipped] += 1
+
+
+def log_image_stats():
+    """Log the images probe stats since the last call"""
+    with image_stats_lock:
+        stats = dict(image_stats)
+        image_stats.update({"probed": 0, "unchanged": 0, "negligible": 0, "oversized": 0, "probe_time": 0.0})
+    if stats["probed"]:
+        logger.info(
+            "Images: {} probed in {:.3f}s, passed through: {} unchanged ({:.0%}), {} with a negligible gain "
+            "({:.0%}), {} over the pixel budget ({:.0%})".format(
+                stats["probed"],
+                stats["probe_time"],
+                stats["unchanged"],
+                stats["unchanged"] / stats["probed"],
+                stats["negligible"],
+                stats["negligible"] / stats["probed"],
+                stats["oversized"],
+                stats["oversized"] / stats["probed"],
+            )
+        )
+
+
+def get_image_budgets(attachments, images, budget):
+    """Get the byte budget of each image: `image` bytes at most, and `mail` bytes shared by the attached images in
+    proportion to their size. Inline images, rendered in the pdf printout, have no budget.
+
+    :param images: list of (index in attachments, is_inline)
+    :param budget: see get_image_budget
+    :return: list of byte budgets (or None)
+    """
+    if not budget or not (budget["image"] or budget["mail"]):
+        return [None] * len(images)
+    total = sum(attachments[index]["len"] for index, is_inline in images if not is_inline)
+    budgets = []
+    for index, is_inline in images:
+        shares = []
+        if not is_inline and budget["image"]:
+            shares.append(budget["image"])
+        if not is_inline and budget["mail"]:
+            shares.append(max(int(budget["mail"] * attachments[index]["len"] / total), 1))
+        budgets.append(shares and min(shares) or None)
+    return budgets
+
+
+def encode_image(img, fmt, max_bytes=None, max_trials=IMAGE_MAX_TRIALS):
+    """Encode an image, within a byte budget if max_bytes is given. The jpeg quality is lowered to IMAGE_MIN_QUALITY,
+    then the image is reduced, with at most max_trials encodes: the first encode within the budget is kept, otherwise
+    the smallest one.
+
+    :return: (content, size)
+    """
+    Image = load_pil()
+
+    def encode(image, quality):
+        content = BytesIO()
+        try:
+            image.save(content, format=fmt, optimize=True, quality=quality)
+        except ValueError:
+            image.save(content, format=fmt, optimize=True)
+        return content.getvalue()
+
+    quality = JPEG_QUALITY
+    content = encode(img, quality)
+    best = content, img.size
+    trials = 1
+    while max_bytes is not None and len(content) > max_bytes and trials < max_trials:
+        if fmt in ("JPEG", "WEBP") and quality > IMAGE_MIN_QUALITY:
+            # the size is roughly proportional to the quality in this range
+            quality = max(min(int(quality * max_bytes / len(content)), quality - 5), IMAGE_MIN_QUALITY)
+        else:
+            # the size is roughly proportional to the pixels number
+            ratio = 0.95 * (max_bytes / len(content)) ** 0.5
+            img = img.resize((max(int(img.width * ratio), 1), max(int(img.height * ratio), 1)), Image.BICUBIC)
+        content = encode(img, quality)
+        trials += 1
+        if len(content) < len(best[0]):
+            best = content, img.size
+    return best
+
+
+def resized_filename(filename):
+    return re.sub(r"(\.\w+)$", r"-(redimensionné)\1", filename)
+
+
+def get_image_result(dic):
+    """Get the result of transform_image to cache: the values depending on the image content only"""
+    if dic is None:
+        return {"dropped": True}
+    result = {key: dic[key] for key in ("is_inline", "size", "modified") if key in dic}
+    if dic.get("modified"):
+        result.update({"content": dic["content"], "len": dic["len"]})
+    return result
+
+
+def apply_image_result(dic, result):
+    """Apply a cached result of transform_image to an image attachment
+
+    :return: the modified attachment, or None if the image is dropped
+    """
+    if result.get("dropped"):
+        return None
+    dic.update(result)
+    if result.get("modified"):
+        dic["filename"] = resized_filename(dic["filename"])
+    return dic
+
+
+def transform_image(mail_id, dic, is_inline, max_bytes=None, max_trials=IMAGE_MAX_TRIALS, max_pixels=IMAGE_MAX_PIXELS):
+    """Reorient and reduce an image attachment. Run in a process of the images pool.
+
+    :param max_bytes: byte budget of the image (see encode_image)
+    :param max_pixels: pixels decoded at most: a bigger image is kept as is, without being decoded
+
+    :return: the modified attachment, or None if the image is dropped
+    """
+    from PIL import ImageOps
+    from PIL import UnidentifiedImageError
+
+    Image = load_pil()
+    orient_mod = size_mod = False
+    try:
+        img = Image.open(BytesIO(dic["content"]))
+    except UnidentifiedImageError:
+        if not is_inline:
+            return dic  # kept original image
+        return None
+    except Image.DecompressionBombError:  # never append because Image.MAX_IMAGE_PIXELS is set to None
+        return None
+    dic["is_inline"] = is_inline
+    try:
+        orient = get_orientation(img)
+    except ParseError:
+        logger.warning(
+            "{}: error getting exif info for image '{}', ignored orientation".format(mail_id, dic["filename"])
+        )
+        orient = 0
+    new_img = img
+    reorient, new_size = get_image_transforms(img.size, orient, dic["len"], is_inline)
+    swapped = reorient and orient in (5, 6, 7, 8)
+    is_reduced = new_size is not None
+    if is_reduced and img.format == "JPEG":
+        # decoded at the smallest scale (1/2, 1/4 or 1/8) still bigger than the new size
+        img.draft(img.mode, swapped and new_size[::-1] or new_size)
+    if img.width * img.height > max_pixels:
+        logger.warning(
+            "{}: image '{}' of {}x{} pixels is over the pixel budget, kept as is".format(
+                mail_id, dic["filename"], img.width, img.height
+            )
+        )
+        return dic
+    # if problem, si ImageMagik use https://github.com/IMIO/appy/blob/master/appy/pod/doc_importers.py#L545
+    if reorient:
+        try:
+            new_img = ImageOps.exif_transpose(img)
+            orient_mod = True
+            if dev_mode:
+                logger.info("{}: reoriented image '{}' from {}".format(mail_id, dic["filename"], orient))
+        except Exception:
+            if is_reduced and swapped:
+                new_size = new_size[::-1]
+    if is_reduced:
+        if dev_mode:
+            logger.info("{}: resized image '{}'".format(mail_id, dic["filename"]))
+        # see https://pillow.readthedocs.io/en/stable/handbook/concepts.html#filters
+        new_img = new_img.resize(new_size, Image.BICUBIC)
+        dic["size"] = new_size
+        size_mod = True
+
+    over_budget = max_bytes is not None and dic["len"] > max_bytes
+    if size_mod or orient_mod or over_budget:
+        new_content, encoded_size = encode_image(new_img, img.format, max_bytes, max_trials)
+        if encoded_size != new_img.size:
+            dic["size"] = encoded_size
+        new_len = len(new_content)
+        gain = over_budget and 0 or IMAGE_MIN_GAIN
+        if orient_mod or (new_len < dic["len"] and float(new_len / dic["len"]) < 1 - gain):
+            #                                      more than 10% of difference, or any if over the budget
+            dic["filename"] = resized_filename(dic["filename"])
+            if dev_mode:
+                logger.info(
+                    "{}: new image '{}' ({} => {}){}".format(
+                        mail_id, dic["filename"], dic["len"], new_len, is_inline and " (inline)" or ""
+                    )
+                )
+            dic["len"] = new_len
+            dic["content"] = new_content
+            dic["modified"] = True
+    return dic
 
 
 def resize_inline_images(mail_id, message, attachments):
+    from bs4 import BeautifulSoup
+    from email2pdf2 import email2pdf2
+
     new_message = copy.deepcopy(message)
     size_pattern = r'(size=["\'])([^"\']*)(["\'])'
     cids = {}
@@ -330,6 +628,8 @@ def resize_inline_images(mail_id, message, attachments):
 
 
 def post_with_retries(url, auth, action, mail_id, json_data=None, files=None, retries=5, delay=20):
+    import requests
+
     for attempt in range(1, retries + 1):
         try:
             response = requests.post(url, auth=auth, json=json_data, files=files)
@@ -352,11 +652,100 @@ def post_with_retries(url, auth, action, mail_id, json_data=None, files=None, re
 
 
 def send_to_ws(config, headers, main_file_path, attachments, mail_id):
+    upload_package(config, package_mail(headers, main_file_path, attachments, mail_id), mail_id)
+
+
+def get_work_cache(config):
+    """Get the cache of the files produced for the emails in error ([work_cache] config section), or None"""
+    if not config.has_section("work_cache"):
+        return None
+    section = config["work_cache"]
+    path = section["dir"]
+    with shared_lock:
+        if path not in work_caches:
+            work_caches[path] = WorkCache(
+                path,
+                max_size=int(section.get("max_size", WORK_CACHE_MAX_SIZE)) * 1000000,
+                max_age=float(section.get("max_age", WORK_CACHE_MAX_AGE)) * 86400,
+            )
+        return work_caches[path]
+
+
+def get_transform_cache(config):
+    """Get the cache of the transformed images and pdf files ([transform_cache] config section), or None"""
+    if not config.has_section("transform_cache"):
+        return None
+    section = config["transform_cache"]
+    path = section["dir"]
+    with shared_lock:
+        if path not in transform_caches:
+            transform_caches[path] = TransformCache(
+                path, max_size=int(section.get("max_size", TRANSFORM_CACHE_MAX_SIZE)) * 1000000
+            )
+        return transform_caches[path]
+
+
+def get_image_budget(config):
+    """Get the budget of the attached images, set in the [images] config section: bytes by `max_bytes` (by image) and
+    `mail_max_bytes` (by mail), with `max_trials` encodes at most, and pixels decoded by `max_pixels` and
+    `max_memory` (MB)."""
+    section = config.has_section("images") and config["images"] or {}
+    pixels = int(section.get("max_pixels", IMAGE_MAX_PIXELS))
+    if section.get("max_memory"):
+        pixels = min(pixels, int(section["max_memory"]) * 1000000 // 4)
+    return {
+        "image": int(section.get("max_bytes", 0)),
+        "mail": int(section.get("mail_max_bytes", 0)),
+        "trials": int(section.get("max_trials", IMAGE_MAX_TRIALS)),
+        "pixels": pixels,
+    }
+
+
+def get_image_pool(config):
+    """Get the processes transforming the images, kept for the run, or None if the [images] config section doesn't
+    set `workers`: images are then transformed in the calling thread. A mail has at most `per_mail` images pending."""
+    section = config.has_section("images") and config["images"] or {}
+    workers = int(section.get("workers", 0))
+    if workers < 1:
+        return None
+    key = (workers, int(section.get("per_mail", workers)))
+    with shared_lock:
+        if key not in image_pools:
+            image_pools[key] = ProcessPool(*key)
+        return image_pools[key]
+
+
+def close_image_pools():
+    with shared_lock:
+        while image_pools:
+            image_pools.popitem()[1].shutdown()
+
+
+def get_fingerprint_index(config):
+    """Get the index of the imported emails fingerprints, in counter_dir, or None in dev mode or if disabled by
+    `duplicates_max = 0` ([mailinfos] config section)"""
+    max_entries = int(config["mailinfos"].get("duplicates_max", FINGERPRINTS_MAX))
+    if dev_mode or not max_entries:
+        return None
     ws = config["webservice"]
-    next_id, client_id = get_next_id(config, dev_infos)
-    external_id = "{0}{1:08d}".format(client_id, next_id)
+    path = os.path.join(ws["counter_dir"], "fingerprints_{}.log".format(ws["client_id"]))
+    with shared_lock:
+        if path not in fingerprint_indexes:
+            fingerprint_indexes[path] = FingerprintIndex(path, max_entries=max_entries)
+        return fingerprint_indexes[path]
+
 
-    tar_path = Path("/tmp") / "{}.tar".format(external_id)
+def get_tar_path(mail_id):
+    """Get the temporary path of the tar file of a mail (see upload_package)"""
+    return Path("/tmp") / "mail_{}.tar".format(safe_text(mail_id))
+
+
+def package_mail(headers, main_file_path, attachments, mail_id):
+    """Create the tar file sent to the webservice, with a temporary name (see upload_package)
+
+    :return: tar file path
+    """
+    tar_path = get_tar_path(mail_id)
     with tarfile.open(str(tar_path), "w") as tar:
         # 1) email pdf printout or eml file
         with Path(main_file_path).open("rb") as f:
@@ -383,6 +772,29 @@ def send_to_ws(config, headers, main_file_path, attachments, mail_id):
             )
             attachment_info.size = len(attachment_contents)
             tar.addfile(tarinfo=attachment_info, fileobj=BytesIO(attachment_contents))
+    return tar_path
+
+
+def upload_package(config, tar_path, mail_id, job=None):
+    """Give the next external id to a tar file and send it to the webservice.
+
+    The counter is incremented as soon as the metadata are posted, so that an external id is given only once, even
+    if the upload fails: uploads must be sequential.
+
+    :param job: MailJob recording the steps in the journal. If its metadata was posted by a killed run, the same
+                external id is used and only the file is uploaded (the metadata are posted again if the tar file
+                was rebuilt). Until it's uploaded, the tar file is kept in counter_dir, next to the journal
+    """
+    ws = config["webservice"]
+    progress = job is not None and job.progress or {}
+    if "metadata_posted" in progress:
+        next_id, client_id, response_id = progress["next_id"], progress["client_id"], progress["response_id"]
+    else:
+        next_id, client_id = get_next_id(config, dev_infos)
+        response_id = None
+    external_id = "{0}{1:08d}".format(client_id, next_id)
+    if tar_path.name != "{}.tar".format(external_id):
+        tar_path = tar_path.replace(tar_path.with_name("{}.tar".format(external_id)))
     if dev_mode:
         logger.info("tar file '{}' created".format(tar_path))
     else:  # we send to the ws
@@ -408,14 +820,27 @@ def send_to_ws(config, headers, main_file_path, attachments, mail_id):
             ws=ws,
             client_id=client_id,
         )
-        metadata_req_content = post_with_retries(metadata_url, auth, "post metadata", mail_id, json_data=metadata)
-        # {'message': 'Well done', 'external_id': '05Z507000024176', 'id': 2557054, 'success': True}
-        if not metadata_req_content["success"] or "id" not in metadata_req_content:
-            msg = "mail_id: {}, code: '{}', error: '{}', metadata: '{}'".format(
-                mail_id, metadata_req_content["error_code"], metadata_req_content["error"], metadata
-            ).encode("utf8")
-            raise DmsMetadataError(msg)
-        response_id = metadata_req_content["id"]
+        if response_id is None:
+            metadata_req_content = post_with_retries(metadata_url, auth, "post metadata", mail_id, json_data=metadata)
+            # {'message': 'Well done', 'external_id': '05Z507000024176', 'id': 2557054, 'success': True}
+            if not metadata_req_content["success"] or "id" not in metadata_req_content:
+                msg = "mail_id: {}, code: '{}', error: '{}', metadata: '{}'".format(
+                    mail_id, metadata_req_content["error_code"], metadata_req_content["error"], metadata
+                ).encode("utf8")
+                raise DmsMetadataError(msg)
+            response_id = metadata_req_content["id"]
+            set_next_id(config, next_id)
+            if job is not None and job.journal is not None:
+                tar_path = Path(shutil.move(str(tar_path), os.path.join(ws["counter_dir"], tar_path.name)))
+            if job is not None:
+                job.record(
+                    "metadata_posted",
+                    next_id=next_id,
+                    client_id=client_id,
+                    external_id=external_id,
+                    response_id=response_id,
+                    tar_path=str(tar_path),
+                )
 
         upload_url = "{proto}://{ws[host]}:{ws[port]}/file_upload/{ws[version]}/{id}".format(
             proto=proto, ws=ws, id=response_id
@@ -430,7 +855,10 @@ def send_to_ws(config, headers, main_file_path, attachments, mail_id):
             ).encode("utf8")
             raise FileUploadError(msg)
 
-        set_next_id(config, next_id)
+        if job is not None:
+            job.record("uploaded")
+        if tar_path.parent == Path(ws["counter_dir"]):
+            shutil.move(str(tar_path), str(get_tar_path(mail_id).with_name(tar_path.name)))
 
 
 def process_mails():
@@ -472,6 +900,9 @@ def process_mails():
         lock.close()
         sys.exit()
     elif arguments.get("--get_eml"):
+        from imio.email.parser.parser import Parser
+        from imio.email.parser.utils import stop
+
         mail_id = arguments["--get_eml"]
         if not mail_id:
             stop("Error: you must give an email id (--get_eml=25 by example)", logger)
@@ -499,6 +930,9 @@ def process_mails():
         lock.close()
         sys.exit()
     elif arguments.get("--gen_pdf"):
+        from imio.email.parser.parser import Parser
+        from imio.email.parser.utils import stop
+
         mail_id = arguments["--gen_pdf"]
         if not mail_id:
             stop("Error: you must give an email id (--gen_pdf=25 by example)", logger)
@@ -516,14 +950,23 @@ def process_mails():
     elif arguments.get("--reset_flags"):
         mail_id = arguments["--reset_flags"]
         if not mail_id:
+            from imio.email.parser.utils import stop
+
             stop("Error: you must give an email id (--reset_flags=25 by example)", logger)
         # handler.mark_mail_as_error(mail_id)
         # handler.mark_mail_as_imported(mail_id)
         handler.mark_reset_all(mail_id)
+        # a requeued duplicate must not be ignored again
+        index = get_fingerprint_index(config)
+        if index is not None and index.remove(mail_id):
+            logger.info("{}: fingerprint removed from the duplicates index".format(mail_id))
         handler.disconnect()
         lock.close()
         sys.exit()
     elif arguments.get("--test_eml"):
+        from imio.email.parser.parser import Parser
+        from imio.email.parser.utils import stop
+
         handler.disconnect()
         eml_path = arguments["--test_eml"]
         if not eml_path or not os.path.exists(eml_path):
@@ -559,7 +1002,9 @@ def process_mails():
         sys.exit()
     elif arguments.get("--stats"):
         logger.info("Started at {}".format(datetime.now()))
-        stats = handler.stats()
+        since = arguments.get("--since") and datetime.strptime(arguments["--since"], "%Y-%m-%d")
+        before = arguments.get("--before") and datetime.strptime(arguments["--before"], "%Y-%m-%d")
+        stats = handler.stats(since=since or None, before=before or None)
         logger.info("Total mails: {}".format(stats.pop("tot")))
         for flag in sorted(stats["flags"]):
             logger.info("Flag '{}' => {}".format(flag, stats["flags"][flag]))
@@ -568,92 +1013,678 @@ def process_mails():
         logger.info("Ended at {}".format(datetime.now()))
         sys.exit()
 
-    imported = errors = unsupported = ignored = total = 0
+    handler.load_sync_state(counter_dir / "sync_{0}.json".format(config["webservice"]["client_id"]))
+    workers = int(arguments.get("--workers") or 1)
+    # steps reached by each email, to resume the emails of a killed run
+    journal = None
+    if not dev_mode:
+        journal = Journal(counter_dir / "journal_{0}.log".format(config["webservice"]["client_id"]))
     if arguments.get("--mail_id"):
+        from imio.email.parser.utils import stop
+
         mail_id = arguments["--mail_id"]
         if not mail_id:
             stop("Error: you must give an email id (--mail_id=25 by example)", logger)
         mail = handler.get_mail(mail_id)
         if not mail:
             stop("Error: no mail found for id {}".format(mail_id), logger)
-        emails = [MailData(mail_id, mail)]
+        treat_emails(config, handler, [MailData(mail_id, mail)], journal=journal)
+        del mail
+    elif arguments.get("--daemon"):
+        try:
+            run_daemon(config, handler, (host, port, ssl, login, password), workers=workers, journal=journal)
+        finally:
+            close_image_pools()
+            journal and journal.close()
+            lock.close()
+        sys.exit()
+    elif arguments.get("--asyncio"):
+        import asyncio
+
+        handler.disconnect()
+        try:
+            asyncio.run(
+                process_mails_async(
+                    config,
+                    (host, port, ssl, login, password),
+                    counter_dir / "sync_{0}.json".format(config["webservice"]["client_id"]),
+                    journal=journal,
+                )
+            )
+        finally:
+            close_image_pools()
+            journal and journal.close()
+            lock.close()
+        sys.exit()
+    else:
+        treat_emails(config, handler, workers=workers, journal=journal)
+    close_image_pools()
+    handler.disconnect()
+    journal and journal.close()
+    lock.close()
+    sys.exit()
+
+
+def treat_emails(config, handler, emails=None, workers=1, journal=None):
+    """Handle given emails or all waiting emails, then log a summary.
+
+    :param emails: list of MailData. If None, waiting emails are fetched lazily: one batch is kept in memory at a time
+    :param workers: default number of threads of the pipeline stages (see handle_mails_in_pipeline). Emails are
+                    handled one by one if it's 1 and the [pipeline] config section is missing
+    :param journal: Journal recording the steps reached by each email, to resume them if the run is killed
+    :return: number of treated emails
+    """
+    counts = {"imported": 0, "unsupported": 0, "error": 0, "ignored": 0, "duplicate": 0}
+    total = 0
+    handler.round_trips_saved = 0
+    if journal is not None:
+        journal.reserve_ids(config)
+    cache = get_work_cache(config)
+    if cache is not None:
+        cache.evict()
+    get_fingerprint_index(config)
+    if emails is None:
+        emails = handler.iter_waiting_emails(
+            batch_size=int(config["mailbox"].get("fetch_batch_size", 200)),
+            max_batch_bytes=int(config["mailbox"].get("fetch_batch_bytes", 10000000)),
+            # these mails cannot be attached to a notification: no need to download them if they are rejected
+            skeleton_min_size=MAX_SIZE_ATTACH,
+        )
+    if workers > 1 or config.has_section("pipeline"):
+        states = handle_mails_in_pipeline(config, handler, emails, workers=workers, journal=journal)
     else:
-        emails = handler.get_waiting_emails()
-    for mail_info in emails:
+        states = (
+            handle_mail(config, handler, mail_info.id, mail_info.mail, mail_info.size, mail_info.partial, journal)
+            for mail_info in emails
+        )
+    for state in states:
         total += 1
-        mail_id = mail_info.id
-        mail = mail_info.mail
-        main_file_path = get_preview_pdf_path(config, mail_id)
-        parser = None
+        counts[state] += 1
+    # remaining grouped flags are stored, then the sync state (only once all the fetched emails are flagged)
+    handler.end_sync(handler.flush_marks())
+    if journal is not None:
+        journal.flush()
+
+    if total:
+        logger.info(
+            "Treated {} emails: {} imported. {} unsupported. {} in error. {} ignored. {} duplicates.".format(
+                total,
+                counts["imported"],
+                counts["unsupported"],
+                counts["error"],
+                counts["ignored"],
+                counts["duplicate"],
+            )
+        )
+    else:
+        logger.info("Treated no email.")
+    if handler.round_trips_saved:
+        logger.info("Saved {} IMAP round trips with batched fetch.".format(handler.round_trips_saved))
+    log_image_stats()
+    transform_cache = get_transform_cache(config)
+    if transform_cache is not None:
+        logger.info(transform_cache.report())
+    return total
+
+
+def handle_mails_in_pipeline(config, handler, emails, workers=1, journal=None):
+    """Handle emails in a pipeline of stages run by threads and linked by bounded queues: parse (and check),
+    transform (images and pdf files), render (pdf printout), package (tar file) and upload.
+
+    Stages concurrency and queues size are set in the [pipeline] config section (parse, transform, render and
+    package default to workers). The upload stage is sequential and keeps the fetching order: external ids stay gapless
+    and monotonic. Fetching and flagging are done in the calling thread, which only uses the IMAP connection.
+    Skeletons of big emails (see IMAPEmailHandler.iter_mails) are checked before entering the pipeline, and
+    downloaded if accepted. Stages activity is logged at the end.
+
+    :return: generator of the resulting states
+    """
+    section = config.has_section("pipeline") and config["pipeline"] or {}
+    queue_size = int(section.get("queue_size", 2))
+    stages = [
+        Stage(name, partial(func, config), int(section.get(name, default)), queue_size)
+        for name, func, default in (
+            ("parse", parse_stage, workers),
+            ("transform", transform_stage, workers),
+            ("render", render_stage, workers),
+            ("package", package_stage, 1),
+        )
+    ]
+    stages.append(Stage("upload", partial(upload_stage, config), 1, queue_size, ordered=True))
+    pipeline = Pipeline(stages)
+
+    def flag(job):
+        start = time.monotonic()
+        state = job.finish()
+        if not dev_mode:
+            handler.queue_mark(job.mail_info.id, state)
+        pipeline.record("flag", time.monotonic() - start)
+        return state
+
+    pipeline.start()
+    emails = iter(emails)
+    try:
+        while True:
+            start = time.monotonic()
+            mail_info = next(emails, None)
+            if mail_info is None:
+                break
+            job = MailJob(mail_info, journal=journal)
+            if mail_info.partial:
+                download_stage(config, job, handler.get_mail)
+            pipeline.record("fetch", time.monotonic() - start)
+            for job in pipeline.put(job):
+                yield flag(job)
+    finally:
+        pipeline.close()
+    for job in pipeline.results(wait=True):
+        yield flag(job)
+    for line in pipeline.report():
+        logger.info(line)
+
+
+class MailJob(object):
+    """An email going through the pipeline stages (see handle_mails_in_pipeline).
+
+    With a journal, the steps reached are recorded and the steps already reached by a killed run are skipped.
+    """
+
+    seq = None
+    cache_key = None
+    fingerprint = None
+    fingerprint_index = None
+
+    def __init__(self, mail_info, journal=None):
+        self.mail_info = mail_info
+        # resulting state, set when the email is rejected, in error or imported
+        self.state = None
+        self.parser = None
+        self.message = None
+        self.attachments = None
+        self.main_file_path = None
+        self.tar_path = None
+        self.journal = journal
+        # steps reached and data recorded by a previous run
+        self.progress = journal is not None and journal.get(mail_info) or {}
+        if self.progress:
+            step = max((step for step in STEPS if step in self.progress), key=STEPS.index)
+            logger.info("{}: resuming after step '{}'".format(mail_info.id, step))
+        else:
+            self.record("fetched")
+
+    def record(self, step, **data):
+        """Record a step reached, with its data"""
+        self.progress.update(data)
+        self.progress[step] = time.time()
+        if self.journal is not None:
+            self.journal.record(self.mail_info, step, **data)
+
+    def resumed_file(self, name):
+        """Get a file path recorded by a previous run, if the file still exists"""
+        path = self.progress.get(name)
+        return path and os.path.exists(path) and path or None
+
+    def finish(self):
+        """Get the resulting state of a job which went through all stages"""
+        state = self.state or "error"
+        # the entry of an email in error is kept, to resume it when it's requeued
+        if self.journal is not None and state != "error":
+            self.journal.finish(self.mail_info)
+        if self.fingerprint_index is not None and state != "imported":
+            self.fingerprint_index.release(self.fingerprint, self.mail_info.id)
+        return state
+
+
+def mail_stage(func):
+    """Decorate a pipeline stage: emails already rejected or in error are skipped, errors are notified"""
+
+    @wraps(func)
+    def wrapper(config, job, *args):
+        if job.state:
+            return
         try:
-            parser = Parser(mail, dev_mode, mail_id)
-            headers = parser.headers
-            if parser.origin == "Generic inbox":
-                if not dev_mode:
-                    handler.mark_mail_as_unsupported(mail_id)
-                unsupported += 1
-                try:
-                    Notify(mail, config, headers).unsupported_origin()
-                except Exception:  # better to continue than advise user
-                    pass
-                continue
-            # we check if the pushing agent has a permitted email format
-            if "Agent" in headers and not check_transferer(
-                headers["Agent"][0][1], config["mailinfos"].get("sender-pattern", ".+")
-            ):
-                if not dev_mode:
-                    handler.mark_mail_as_ignored(mail_id)
-                # logger.error('Rejecting {}: {}'.format(headers['Agent'][0][1], headers['Subject']))
-                ignored += 1
-                try:
-                    Notify(mail, config, headers).ignored(mail_id)
-                except Exception:  # better to continue than advise user
-                    pass
-                continue
-            # logger.info('Accepting {}: {}'.format(headers['Agent'][0][1], headers['Subject']))
-            try:
-                attachments = modify_attachments(mail_id, parser.attachments)
-            except Exception:
-                logger.error("Error modifying attachments", exc_info=True)
-                attachments = parser.attachments
-            try:
-                message = resize_inline_images(mail_id, parser.message, attachments)
-            except Exception:
-                logger.error("Error resizing inline images", exc_info=True)
-                message = parser.message
-            try:
-                parser.generate_pdf(main_file_path, message=message)
-            except Exception:
-                logger.error("Error generating pdf file", exc_info=True)
-                # if 'XDG_SESSION_TYPE=wayland' not in str(pdf_exc):
-                main_file_path = main_file_path.replace(".pdf", ".eml")
-                save_as_eml(main_file_path, parser.message)
-            send_to_ws(config, headers, main_file_path, attachments, mail_id)
-            if not dev_mode:
-                handler.mark_mail_as_imported(mail_id)
-            imported += 1
+            func(config, job, *args)
         except Exception as e:
             logger.error(e, exc_info=True)
+            mail_info = job.mail_info
+            mail_size = mail_info.partial and mail_info.size or None
+            notify_error(config, mail_info.id, mail_info.mail, job.parser, e, mail_size=mail_size)
+            job.state = "error"
+
+    return wrapper
+
+
+@mail_stage
+def download_stage(config, job, get_mail):
+    """Check the skeleton of a big email and download the whole email if it's accepted
+
+    :param get_mail: function fetching the whole email (see IMAPEmailHandler.get_mail)
+    """
+    parse_stage(config, job)
+    if job.state:
+        return
+    mail_info = job.mail_info
+    mail = get_mail(mail_info.id, size=mail_info.size)
+    if not mail:
+        raise ValueError("Unable to fetch whole mail {}".format(mail_info.id))
+    job.mail_info = MailData(mail_info.id, mail, flags=mail_info.flags, size=mail_info.size)
+
+
+@mail_stage
+def parse_stage(config, job):
+    from imio.email.parser.parser import Parser
+
+    mail_info = job.mail_info
+    job.parser = Parser(mail_info.mail, dev_mode, mail_info.id)
+    job.state = check_mail(config, mail_info.id, mail_info.mail, job.parser, size=mail_info.size)
+    index = get_fingerprint_index(config)
+    # a skeleton is fingerprinted when parsed again as a whole email, its big parts being empty
+    if job.state or index is None or mail_info.partial:
+        return
+    try:
+        job.fingerprint = fingerprint(job.parser.message)
+    except Exception:
+        logger.warning("{}: unable to get the fingerprint".format(mail_info.id), exc_info=True)
+        return
+    if not job.fingerprint:
+        return
+    imported = index.claim(job.fingerprint, mail_info.id)
+    if imported is None:
+        job.fingerprint_index = index
+    else:
+        if imported[1]:
+            logger.info("{}: duplicate of email {} imported as {}, ignored".format(mail_info.id, *imported))
+        else:
+            logger.info("{}: duplicate of email {} being imported, ignored".format(mail_info.id, imported[0]))
+        job.state = "duplicate"
+        # forgotten if the email is requeued (see --reset_flags)
+        index.add_duplicate(job.fingerprint, mail_info.id)
+
+
+@mail_stage
+def transform_stage(config, job):
+    cache = get_work_cache(config)
+    if cache is not None:
+        job.cache_key = cache.key(job.mail_info.mail)
+    if "uploaded" in job.progress or job.resumed_file("tar_path"):
+        return
+    if cache is not None:
+        if cache.get_file(job.cache_key, "mail.tar"):
+            return
+        job.attachments = cache.get_object(job.cache_key, "attachments")
+        if job.attachments is not None:
+            logger.info("{}: reused cached attachments".format(job.mail_info.id))
+            if not get_cached_main_file(cache, job.cache_key):
+                job.attachments, job.message = transform_mail(job.mail_info.id, job.parser, job.attachments)
+            return
+    job.attachments, job.message = transform_mail(
+        job.mail_info.id,
+        job.parser,
+        pool=get_image_pool(config),
+        cache=get_transform_cache(config),
+        budget=get_image_budget(config),
+    )
+    if cache is not None:
+        cache.put_object(job.cache_key, "attachments", job.attachments)
+
+
+def get_cached_main_file(cache, key):
+    return cache.get_file(key, "email.pdf") or cache.get_file(key, "email.eml")
+
+
+@mail_stage
+def render_stage(config, job):
+    if "uploaded" in job.progress or job.resumed_file("tar_path"):
+        return
+    cache = get_work_cache(config)
+    if cache is not None and cache.get_file(job.cache_key, "mail.tar"):
+        return
+    job.main_file_path = job.resumed_file("main_file_path") or cache and get_cached_main_file(cache, job.cache_key)
+    if not job.main_file_path:
+        job.main_file_path = render_pdf(config, job.mail_info.id, job.parser, job.message)
+        if cache is not None:
+            ext = os.path.splitext(job.main_file_path)[1]
+            job.main_file_path = cache.put_file(job.cache_key, "email{}".format(ext), job.main_file_path)
+        job.record("rendered", main_file_path=job.main_file_path)
+    job.message = None
+
+
+@mail_stage
+def package_stage(config, job):
+    if "uploaded" in job.progress:
+        return
+    job.tar_path = job.resumed_file("tar_path")
+    if job.tar_path:
+        job.tar_path = Path(job.tar_path)
+        return
+    cache = get_work_cache(config)
+    cached_path = cache is not None and cache.get_file(job.cache_key, "mail.tar")
+    if cached_path:
+        logger.info("{}: reused cached tar file".format(job.mail_info.id))
+        job.tar_path = get_tar_path(job.mail_info.id)
+        if job.tar_path.exists():
+            job.tar_path.unlink()
+        link_or_copy(cached_path, str(job.tar_path))
+    else:
+        job.tar_path = package_mail(job.parser.headers, job.main_file_path, job.attachments, job.mail_info.id)
+        if cache is not None:
+            cache.put_file(job.cache_key, "mail.tar", str(job.tar_path))
+    if "metadata_posted" in job.progress:
+        # the size and md5 of the rebuilt tar file differ from the posted ones: the metadata are posted again
+        logger.warning("{}: tar file rebuilt, its metadata will be posted again".format(job.mail_info.id))
+        job.record("packaged", tar_path=str(job.tar_path), response_id=None)
+    else:
+        job.record("packaged", tar_path=str(job.tar_path))
+    job.attachments = None
+
+
+@mail_stage
+def upload_stage(config, job):
+    if "uploaded" in job.progress:
+        logger.info("{}: already uploaded with external id {}".format(job.mail_info.id, job.progress["external_id"]))
+    else:
+        upload_package(config, job.tar_path, job.mail_info.id, job=job)
+    job.state = "imported"
+    cache = get_work_cache(config)
+    if cache is not None and job.cache_key:
+        cache.drop(job.cache_key)
+    if job.fingerprint_index is not None:
+        job.fingerprint_index.add(job.fingerprint, job.mail_info.id, job.progress.get("external_id"))
+
+
+# stages run one after the other by handle_mail and prepare_mail
+MAIL_STAGES = (parse_stage, transform_stage, render_stage, package_stage)
+
+
+def run_daemon(config, handler, mailbox_infos, workers=1, journal=None):
+    """Keep one IMAP session open and handle emails as they arrive.
+
+    The mailbox is watched with IMAP IDLE, or polled with NOOP if the server doesn't support it.
+    The connection is reopened when lost. SIGTERM and SIGINT stop the daemon when it's waiting, or after the current
+    batch when it's handling emails.
+
+    :param mailbox_infos: connection parameters (host, port, ssl, login, password)
+    :param workers: number of emails prepared concurrently (see treat_emails)
+    :param journal: Journal recording the steps reached by each email (see treat_emails)
+    """
+    idle_timeout = int(config["mailbox"].get("idle_timeout", 1500))  # RFC 2177: less than 29 minutes
+    poll_interval = int(config["mailbox"].get("poll_interval", 60))
+    state = {"waiting": False, "stopping": False}
+
+    def stop_daemon(signum, frame):
+        state["stopping"] = True
+        if state["waiting"]:
+            raise SystemExit()
+
+    previous_handlers = {sig: signal.signal(sig, stop_daemon) for sig in (signal.SIGTERM, signal.SIGINT)}
+    logger.info("Daemon started with {}".format(handler.has_idle() and "IDLE" or "NOOP polling"))
+    try:
+        while not state["stopping"]:
             try:
-                # check parser and parser.headers
-                Notify(mail, config, parser.headers).exception(mail_id, e)
-            except Exception:
-                Notify(mail, config, None).exception(mail_id, e)
-            if not dev_mode:
-                handler.mark_mail_as_error(mail_id)
-            errors += 1
+                treat_emails(config, handler, workers=workers, journal=journal)
+                if state["stopping"]:
+                    break
+                state["waiting"] = True
+                try:
+                    handler.wait_for_changes(idle_timeout=idle_timeout, poll_interval=poll_interval)
+                finally:
+                    state["waiting"] = False
+            except (imaplib.IMAP4.abort, OSError) as e:
+                logger.warning("IMAP connection lost ({}), reconnecting in {} seconds".format(e, poll_interval))
+                # the lost connection is closed, not to leak its socket
+                try:
+                    handler.disconnect()
+                except Exception:
+                    try:
+                        handler.connection.shutdown()
+                    except OSError:
+                        pass
+                state["waiting"] = True
+                try:
+                    sleep(poll_interval)
+                finally:
+                    state["waiting"] = False
+                try:
+                    handler.connect(*mailbox_infos)
+                except (imaplib.IMAP4.error, OSError) as e:
+                    logger.error("Unable to reconnect: {}".format(e))
+    finally:
+        logger.info("Daemon stopped")
+        for sig, previous_handler in previous_handlers.items():
+            signal.signal(sig, previous_handler)
+        try:
+            handler.disconnect()
+        except Exception:
+            pass
+
+
+def handle_mail(config, handler, mail_id, mail, size=None, partial=False, journal=None):
+    """Handle a waiting mail: generate pdf, send it to the webservice and flag it.
+
+    :param size: mail size on the server
+    :param partial: mail is a skeleton without the big parts content. The whole mail is downloaded only if it's
+                    imported
+    :param journal: Journal recording the steps reached
+    :return: the resulting state: 'imported', 'unsupported', 'ignored', 'duplicate' or 'error'
+    """
+    job = MailJob(MailData(mail_id, mail, size=size, partial=partial), journal=journal)
+    if partial:
+        download_stage(config, job, handler.get_mail)
+    for stage in MAIL_STAGES + (upload_stage,):
+        stage(config, job)
+    state = job.finish()
+    if not dev_mode:
+        handler.queue_mark(mail_id, state)
+    return state
+
+
+def check_mail(config, mail_id, mail, parser, size=None):
+    """Check that a parsed mail can be imported, otherwise notify its sender.
+
+    :return: the rejection state, 'unsupported' or 'ignored', or None if the mail can be imported
+    """
+    headers = parser.headers
+    if parser.origin == "Generic inbox":
+        try:
+            Notify(mail, config, headers, mail_size=size).unsupported_origin()
+        except Exception:  # better to continue than advise user
+            pass
+        return "unsupported"
+    # we check if the pushing agent has a permitted email format
+    if "Agent" in headers and not check_transferer(
+        headers["Agent"][0][1], config["mailinfos"].get("sender-pattern", ".+")
+    ):
+        # logger.error('Rejecting {}: {}'.format(headers['Agent'][0][1], headers['Subject']))
+        try:
+            Notify(mail, config, headers, mail_size=size).ignored(mail_id)
+        except Exception:  # better to continue than advise user
+            pass
+        return "ignored"
+    # logger.info('Accepting {}: {}'.format(headers['Agent'][0][1], headers['Subject']))
+    return None
+
+
+def transform_mail(mail_id, parser, attachments=None, pool=None, cache=None, budget=None):
+    """Reduce the images and pdf files attached to a parsed mail, and its inline images.
+
+    :param attachments: attachments already reduced (see WorkCache): only the inline images are replaced
+    :param pool: ProcessPool transforming the images
+    :param cache: TransformCache of the transformed images and pdf files
+    :param budget: budget of the attached images
+    :return: (attachments, message)
+    """
+    if attachments is None:
+        try:
+            attachments = modify_attachments(mail_id, parser.attachments, pool=pool, cache=cache, budget=budget)
+        except Exception:
+            logger.error("Error modifying attachments", exc_info=True)
+            attachments = parser.attachments
+    try:
+        message = resize_inline_images(mail_id, parser.message, attachments)
+    except Exception:
+        logger.error("Error resizing inline images", exc_info=True)
+        message = parser.message
+    return attachments, message
+
+
+def render_pdf(config, mail_id, parser, message):
+    """Generate the pdf printout of a mail message, or its eml file if it fails.
+
+    :return: main file path
+    """
+    main_file_path = get_preview_pdf_path(config, mail_id)
+    try:
+        parser.generate_pdf(main_file_path, message=message)
+    except Exception:
+        logger.error("Error generating pdf file", exc_info=True)
+        # if 'XDG_SESSION_TYPE=wayland' not in str(pdf_exc):
+        main_file_path = main_file_path.replace(".pdf", ".eml")
+        save_as_eml(main_file_path, parser.message)
+    return main_file_path
+
+
+def notify_error(config, mail_id, mail, parser, error, mail_size=None):
+    """Notify the support and the agent of an error while handling a mail"""
+    try:
+        # check parser and parser.headers
+        Notify(mail, config, parser.headers, mail_size=mail_size).exception(mail_id, error)
+    except Exception:
+        Notify(mail, config, None, mail_size=mail_size).exception(mail_id, error)
+
+
+def prepare_mail(config, mail_info, journal=None, get_mail=None):
+    """Parse, check, render and package a mail: first stages of handle_mail.
+
+    :param get_mail: function fetching the whole email if mail_info is a skeleton (see download_stage)
+    :return: (state, rendered): state is 'unsupported', 'ignored', 'duplicate' or 'error' if the mail is rejected,
+             otherwise None and rendered is the MailJob to upload
+    """
+    job = MailJob(mail_info, journal=journal)
+    if mail_info.partial:
+        download_stage(config, job, get_mail)
+    for stage in MAIL_STAGES:
+        stage(config, job)
+    if job.state:
+        job.finish()
+        return job.state, None
+    return None, job
+
+
+def upload_mail(config, mail_info, rendered):
+    """Send a rendered mail to the webservice: last stage of handle_mail, without IMAP command.
+
+    :return: 'imported' or 'error'
+    """
+    upload_stage(config, rendered)
+    return rendered.finish()
+
+
+async def treat_emails_async(config, handler, journal=None):
+    """Handle all waiting emails with an AsyncIMAPEmailHandler, in a pipeline of three stages linked by queues of one
+    mail: fetching, rendering (prepare_mail) and uploading (upload_mail).
+
+    The next mail is fetched and the previous one uploaded while a mail is rendered. Rendering and uploading are
+    blocking: they run in threads. Uploads stay sequential, as the external ids. Flags are queued in the event loop.
+    Big emails are fetched as skeleton: the whole email is downloaded only if it's accepted (see download_stage).
+
+    :param journal: Journal recording the steps reached by each email
+    :return: number of treated emails
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    counts = {"imported": 0, "unsupported": 0, "error": 0, "ignored": 0, "duplicate": 0}
+    to_render = asyncio.Queue(maxsize=1)
+    to_upload = asyncio.Queue(maxsize=1)
+    handler.round_trips_saved = 0
+    if journal is not None:
+        journal.reserve_ids(config)
+    cache = get_work_cache(config)
+    if cache is not None:
+        cache.evict()
+    get_fingerprint_index(config)
+
+    def done(mail_info, state):
+        counts[state] += 1
+        if not dev_mode:
+            handler.queue_mark(mail_info.id, state)
+
+    def get_mail(mail_id, size=None):
+        # called by a rendering thread: the whole email is fetched in the event loop
+        return asyncio.run_coroutine_threadsafe(handler.get_mail(mail_id, size=size), loop).result()
+
+    async def fetch():
+        async for mail_info in handler.iter_waiting_emails(
+            batch_size=int(config["mailbox"].get("fetch_batch_size", 200)),
+            max_batch_bytes=int(config["mailbox"].get("fetch_batch_bytes", 10000000)),
+            skeleton_min_size=MAX_SIZE_ATTACH,
+        ):
+            await to_render.put(mail_info)
+        await to_render.put(None)
+
+    async def render():
+        while True:
+            mail_info = await to_render.get()
+            if mail_info is None:
+                break
+            state, rendered = await loop.run_in_executor(None, prepare_mail, config, mail_info, journal, get_mail)
+            if rendered is None:
+                done(mail_info, state)
+            else:
+                await to_upload.put((mail_info, rendered))
+        await to_upload.put(None)
+
+    async def upload():
+        while True:
+            item = await to_upload.get()
+            if item is None:
+                break
+            done(item[0], await loop.run_in_executor(None, upload_mail, config, *item))
 
+    tasks = [asyncio.ensure_future(stage()) for stage in (fetch, render, upload)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    handler.end_sync(await handler.flush_marks())
+    if journal is not None:
+        journal.flush()
+
+    total = sum(counts.values())
     if total:
         logger.info(
-            "Treated {} emails: {} imported. {} unsupported. {} in error. {} ignored.".format(
-                total, imported, unsupported, errors, ignored
+            "Treated {} emails: {} imported. {} unsupported. {} in error. {} ignored. {} duplicates.".format(
+                total,
+                counts["imported"],
+                counts["unsupported"],
+                counts["error"],
+                counts["ignored"],
+                counts["duplicate"],
             )
         )
     else:
         logger.info("Treated no email.")
-    handler.disconnect()
-    lock.close()
-    sys.exit()
+    if handler.round_trips_saved:
+        logger.info("Saved {} IMAP round trips with batched fetch.".format(handler.round_trips_saved))
+    log_image_stats()
+    transform_cache = get_transform_cache(config)
+    if transform_cache is not None:
+        logger.info(transform_cache.report())
+    return total
+
+
+async def process_mails_async(config, mailbox_infos, sync_state_path, journal=None):
+    """Connect an AsyncIMAPEmailHandler and handle all waiting emails"""
+    from imio.email.dms.aioimap import AsyncIMAPEmailHandler
+
+    handler = AsyncIMAPEmailHandler()
+    await handler.connect(*mailbox_infos)
+    handler.load_sync_state(sync_state_path)
+    try:
+        return await treat_emails_async(config, handler, journal=journal)
+    finally:
+        await handler.disconnect()
 
 
 def clean_mails():
@@ -680,44 +1711,38 @@ def clean_mails():
     handler.connect(host, port, ssl, login, password)
     before_date = (datetime.now() - timedelta(days)).strftime("%d-%b-%Y")  # date string 01-Jan-2021
     # before_date = '01-Jun-2021'
-    res, data = handler.connection.search(None, "(BEFORE {0})".format(before_date))
-    if res != "OK":
+    mail_ids = handler.search("(BEFORE {0})".format(before_date))
+    if mail_ids is None:
         logger.error("Unable to fetch mails before '{}'".format(before_date))
         handler.disconnect()
         sys.exit()
     deleted = ignored = error = 0
-    mail_ids = data[0].split()
     mail_ids_len = len(mail_ids)
     out = ["Get '{}' emails older than '{}'".format(mail_ids_len, before_date)]
     logger.info("Get '{}' emails older than '{}'".format(mail_ids_len, before_date))
     # sys.exit()
+    if not arguments["--ignored_too"]:
+        mail_ids = handler.search("(BEFORE {0} KEYWORD imported)".format(before_date))
+        if mail_ids is None:
+            logger.error("Unable to fetch imported mails before '{}'".format(before_date))
+            handler.disconnect()
+            sys.exit()
+        ignored = mail_ids_len - len(mail_ids)
+    subjects = handler.get_subjects(mail_ids)
+    to_delete = []
     for mail_id in mail_ids:
-        res, flags_data = handler.connection.fetch(mail_id, "(FLAGS)")
-        if res != "OK":
-            logger.error("Unable to fetch flags for mail {0}".format(mail_id))
-            error += 1
-            continue
-        flags = imaplib.ParseFlags(flags_data[0])
-        if not arguments["--ignored_too"] and b"imported" not in flags:
-            ignored += 1
-            continue
-        mail = handler.get_mail(mail_id)
-        if not mail:
+        if int(mail_id) not in subjects:
+            logger.error("Unable to fetch envelope of mail {0}".format(mail_id))
             error += 1
             continue
-        parser = Parser(mail, dev_mode, mail_id)
-        logger.info("{}: '{}'".format(mail_id, parser.headers["Subject"]))
-        out.append("{}: '{}'".format(mail_id, parser.headers["Subject"]))
-        if doit:
-            handler.connection.store(mail_id, "+FLAGS", "\\Deleted")
-        deleted += 1
-    if deleted:
-        logger.info("Get '{}' emails older than '{}'".format(mail_ids_len, before_date))
-        if doit:
-            res, data = handler.connection.expunge()
-            if res != "OK":
-                out.append("ERROR: Unable to delete mails !!")
-                logger.error("Unable to delete mails")
+        logger.info("{}: '{}'".format(safe_text(mail_id), subjects[int(mail_id)]))
+        out.append("{}: '{}'".format(safe_text(mail_id), subjects[int(mail_id)]))
+        to_delete.append(mail_id)
+    deleted = len(to_delete)
+    if deleted and doit:
+        if not handler.delete_mails(to_delete):
+            out.append("ERROR: Unable to delete mails !!")
+            logger.error("Unable to delete mails")
     handler.disconnect()
     out.append(
         "{} emails have been deleted. {} emails are ignored. {} emails have caused an error.".format(
@@ -794,18 +1819,22 @@ IMAP login : {1}\n
 {2}\n
 """
 
-    def __init__(self, mail, config, headers):
+    def __init__(self, mail, config, headers, mail_size=None):
+        """
+        :param mail_size: size of the original mail, when mail is only a skeleton of it
+        """
         self.mail = mail
         self.config = config
         self.smtp_infos = self.config["smtp"]
         self.headers = headers
+        self.mail_size = mail_size
 
     def _set_message(self, msg, unformatted_message, format_args):
         mail_string = self.mail.as_string()
         len_ok = True
         additional = ""
 
-        if len(mail_string) > MAX_SIZE_ATTACH:
+        if (self.mail_size or len(mail_string)) > MAX_SIZE_ATTACH:
             len_ok = False
             additional = "La pièce jointe est trop grosse: on ne sait pas l'envoyer par mail !"
 
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Staged pipeline: jobs go through stages run by threads and linked by bounded queues"""
+from collections import deque
+from itertools import islice
+
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger("imio.email.dms")
+
+STOP = object()
+
+
+class Stage(object):
+    """A pipeline stage: concurrency threads apply func on the jobs of a bounded queue.
+
+    An ordered stage handles the jobs in the order they were put in the pipeline. It has only one thread.
+    """
+
+    def __init__(self, name, func, concurrency=1, queue_size=2, ordered=False):
+        if ordered and concurrency != 1:
+            raise ValueError("Ordered stage {} must have one thread".format(name))
+        self.name = name
+        self.func = func
+        self.concurrency = max(concurrency, 1)
+        self.ordered = ordered
+        self.queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.lock = threading.Lock()
+        self.running = 0
+        self.next_seq = 0
+        self.count = 0
+        self.busy = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.gets = 0
+
+    def get(self):
+        """Get the next job, sampling the queue depth"""
+        depth = self.queue.qsize()
+        with self.lock:
+            self.gets += 1
+            self.depth_sum += depth
+            self.depth_max = max(self.depth_max, depth)
+        return self.queue.get()
+
+    def process(self, job):
+        start = time.monotonic()
+        try:
+            self.func(job)
+        except Exception:
+            logger.error("Error in pipeline stage {}".format(self.name), exc_info=True)
+        with self.lock:
+            self.count += 1
+            self.busy += time.monotonic() - start
+
+    def report(self):
+        depth_avg = self.gets and self.depth_sum / self.gets or 0
+        return "Stage {}: {} jobs, {} threads, busy {:.2f}s, queue depth avg {:.1f} max {}".format(
+            self.name, self.count, self.concurrency, self.busy, depth_avg, self.depth_max
+        )
+
+
+class Pipeline(object):
+    """Run jobs through stages, each stage in its own threads.
+
+    The number of jobs in the pipeline is limited to max_jobs (by default the capacity of the queues and threads), so
+    that the memory stays bounded: put blocks until a job leaves the pipeline. Jobs leave the pipeline in the thread
+    calling put and results, which can so do the work needing a single thread (as IMAP commands).
+    """
+
+    def __init__(self, stages, max_jobs=None):
+        self.stages = stages
+        self.max_jobs = max_jobs or sum(stage.queue.maxsize + stage.concurrency for stage in stages)
+        self.done = queue.Queue()
+        self.threads = []
+        self.pending = 0
+        self.seq = 0
+        self.external = {}  # {name: [count, busy]} of the stages run by the calling thread
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            stage.running = stage.concurrency
+            for num in range(stage.concurrency):
+                thread = threading.Thread(
+                    target=self._work, args=(index,), name="{}-{}".format(stage.name, num), daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        output = index + 1 < len(self.stages) and self.stages[index + 1].queue or self.done
+        waiting = {}
+        while True:
+            job = stage.get()
+            if job is STOP:
+                break
+            if not stage.ordered:
+                stage.process(job)
+                output.put(job)
+                continue
+            waiting[job.seq] = job
+            while stage.next_seq in waiting:
+                job = waiting.pop(stage.next_seq)
+                stage.next_seq += 1
+                stage.process(job)
+                output.put(job)
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+        if last and index + 1 < len(self.stages):
+            for num in range(self.stages[index + 1].concurrency):
+                self.stages[index + 1].queue.put(STOP)
+
+    def put(self, job):
+        """Put a job in the first stage, waiting while the pipeline is full
+
+        :return: list of the jobs which left the pipeline meanwhile
+        """
+        finished = []
+        while self.pending >= self.max_jobs:
+            finished.append(self._finish(self.done.get()))
+        job.seq = self.seq
+        self.seq += 1
+        self.pending += 1
+        self.stages[0].queue.put(job)
+        finished.extend(self.results())
+        return finished
+
+    def results(self, wait=False):
+        """Yield the jobs which went through all stages
+
+        :param wait: wait until all put jobs are finished
+        """
+        while self.pending:
+            try:
+                job = self.done.get(block=wait)
+            except queue.Empty:
+                return
+            yield self._finish(job)
+
+    def _finish(self, job):
+        self.pending -= 1
+        return job
+
+    def close(self):
+        """Stop the threads once all put jobs are processed"""
+        for num in range(self.stages[0].concurrency):
+            self.stages[0].queue.put(STOP)
+
+    def record(self, name, seconds):
+        """Record the busy time of a stage run by the calling thread"""
+        stats = self.external.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+    def report(self):
+        """Get a report line by stage"""
+        lines = ["Stage {}: {} jobs, busy {:.2f}s".format(name, *stats) for name, stats in self.external.items()]
+        return lines + [stage.report() for stage in self.stages]
+
+
+class ProcessPool(object):
+    """Processes shared by the jobs of a run, for the cpu bound work (as images transcoding).
+
+    Each job has at most per_job calls pending, so that a job doesn't hold all the processes. Processes are spawned
+    (not forked from the threads of the pipeline) when the pool is first used and kept until shutdown. A pool broken
+    by a crashed process is replaced for the next calls.
+    """
+
+    def __init__(self, workers, per_job=None):
+        self.workers = workers
+        self.per_job = max(per_job or workers, 1)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        import multiprocessing
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+    def map(self, func, args_list):
+        """Call func with each args of args_list in the processes. The first calls are submitted at once.
+
+        :return: iterator of the results, in the order of args_list
+        """
+        from concurrent.futures.process import BrokenProcessPool
+
+        executor = self.get_executor()
+        args_list = iter(args_list)
+        pending = deque(executor.submit(func, *args) for args in islice(args_list, self.per_job))
+
+        def results():
+            while pending:
+                try:
+                    result = pending.popleft().result()
+                except BrokenProcessPool:
+                    with self.lock:
+                        if self.executor is executor:
+                            self.executor = None
+                    raise
+                for args in islice(args_list, 1):
+                    pending.append(executor.submit(func, *args))
+                yield result
+
+        return results()
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
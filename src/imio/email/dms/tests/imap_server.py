@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""In-process IMAP server, supporting the commands sent by the handlers, to test them without a real server"""
+import asyncio
+import email
+import email.utils
+import re
+
+
+COMMAND_RE = re.compile(rb"(?P<tag>\S+) (?P<name>\S+)(?: (?P<args>.*))?$")
+FLAGS_RE = re.compile(rb"\((?P<flags>[^)]*)\)")
+PARTIAL_RE = re.compile(rb"BODY\.PEEK\[\]<(\d+)\.(\d+)>")
+
+
+def quoted(value):
+    """Get an IMAP quoted string, or NIL"""
+    if value is None:
+        return b"NIL"
+    return b'"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"').encode()
+
+
+def address_list(value):
+    """Get an ENVELOPE address list from a header value"""
+    if not value:
+        return b"NIL"
+    addresses = []
+    for name, address in email.utils.getaddresses([value]):
+        mailbox, __, host = address.partition("@")
+        addresses.append(b"(%s NIL %s %s)" % (quoted(name or None), quoted(mailbox), quoted(host)))
+    return b"(%s)" % b"".join(addresses)
+
+
+def envelope(mail):
+    """Get the ENVELOPE of a message"""
+    return b"(%s)" % b" ".join(
+        [quoted(mail.get("Date")), quoted(mail.get("Subject"))]
+        + [address_list(mail.get("From"))] * 3
+        + [address_list(mail.get(name)) for name in ("To", "Cc", "Bcc")]
+        + [quoted(mail.get("In-Reply-To")), quoted(mail.get("Message-ID"))]
+    )
+
+
+def part_structure(part, size):
+    """Get the BODYSTRUCTURE of a message part: single part, multipart or message/rfc822"""
+    if part.get_content_type() == "message/rfc822":
+        forwarded = part.get_payload(0)
+        raw = forwarded.as_bytes()
+        return b'("message" "rfc822" NIL NIL NIL "7bit" %d %s %s %d)' % (
+            size,
+            envelope(forwarded),
+            part_structure(forwarded, len(raw.partition(b"\n\n")[2])),
+            raw.count(b"\n"),
+        )
+    if part.is_multipart():
+        subparts = [
+            part_structure(subpart, len(subpart.as_bytes().partition(b"\n\n")[2])) for subpart in part.get_payload()
+        ]
+        return b'(%s "%s")' % (b"".join(subparts), part.get_content_subtype().encode())
+    return b'("%s" "%s" NIL NIL NIL "7bit" %d%s NIL NIL NIL NIL)' % (
+        part.get_content_maintype().encode(),
+        part.get_content_subtype().encode(),
+        size,
+        part.get_content_maintype() == "text" and b" 1" or b"",
+    )
+
+
+def body_structure(raw):
+    """Get the BODYSTRUCTURE item of a message"""
+    return b"BODYSTRUCTURE " + part_structure(email.message_from_bytes(raw), len(raw.partition(b"\r\n\r\n")[2]))
+
+
+def parse_set(value, uids):
+    """Get the uids matching an IMAP message set: b"1:3,5,7:*" """
+    last = uids and max(uids) or 0
+    selected = set()
+    for part in value.split(b","):
+        start, __, end = part.partition(b":")
+        start = start == b"*" and last or int(start)
+        end = end and (end == b"*" and last or int(end)) or start
+        selected.update(uid for uid in uids if min(start, end) <= uid <= max(start, end))
+    return sorted(selected)
+
+
+class FakeIMAPServer(object):
+    """IMAP server with one mailbox, listening on localhost.
+
+    Supported commands: CAPABILITY, LOGIN, SELECT, STATUS, NOOP, IDLE, CLOSE, EXPUNGE, LOGOUT and UID SEARCH (ALL,
+    KEYWORD, NOT), UID FETCH (UID, FLAGS, RFC822.SIZE, ENVELOPE, BODYSTRUCTURE, RFC822, BODY.PEEK[], partial
+    BODY.PEEK[]<offset.length> and, for single part messages, BODY.PEEK[HEADER] and BODY.PEEK[TEXT]), UID STORE (FLAGS),
+    UID EXPUNGE.
+    """
+
+    def __init__(self, capabilities=("IMAP4rev1", "IDLE", "UIDPLUS"), uidvalidity=1):
+        self.capabilities = capabilities
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.mails = {}  # {uid: (raw message, set of flags)}
+        self.commands = []  # received commands, without tag
+        self.idling = []
+        self.server = None
+        self.port = None
+
+    def append(self, raw, flags=()):
+        """Add a message and notify the idling clients"""
+        uid = self.uidnext
+        self.uidnext += 1
+        self.mails[uid] = (raw, set(flags))
+        for writer in self.idling:
+            writer.write(b"* %d EXISTS\r\n" % len(self.mails))
+        return uid
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        writer.write(b"* OK Fake IMAP server ready\r\n")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                match = COMMAND_RE.match(line.rstrip(b"\r\n"))
+                tag, name, args = match.group("tag"), match.group("name").upper(), match.group("args") or b""
+                self.commands.append(b" ".join([name, args]).strip())
+                if name == b"UID":
+                    name, __, args = args.partition(b" ")
+                    name = b"UID_" + name.upper()
+                method = getattr(self, "do_" + name.decode().lower(), None)
+                if method is None:
+                    writer.write(tag + b" BAD unknown command\r\n")
+                    continue
+                result = await method(reader, writer, args)
+                writer.write(tag + b" " + (result or b"OK completed") + b"\r\n")
+                await writer.drain()
+                if name == b"LOGOUT":
+                    break
+        finally:
+            writer.close()
+
+    async def do_capability(self, reader, writer, args):
+        writer.write(b"* CAPABILITY " + " ".join(self.capabilities).encode() + b"\r\n")
+
+    async def do_login(self, reader, writer, args):
+        pass
+
+    async def do_select(self, reader, writer, args):
+        writer.write(b"* %d EXISTS\r\n* 0 RECENT\r\n" % len(self.mails))
+        writer.write(b"* OK [UIDVALIDITY %d] UIDs valid\r\n" % self.uidvalidity)
+        writer.write(b"* OK [UIDNEXT %d] Predicted next UID\r\n" % self.uidnext)
+        return b"OK [READ-WRITE] SELECT completed"
+
+    async def do_status(self, reader, writer, args):
+        writer.write(b"* STATUS INBOX (UIDVALIDITY %d UIDNEXT %d)\r\n" % (self.uidvalidity, self.uidnext))
+
+    async def do_noop(self, reader, writer, args):
+        pass
+
+    async def do_close(self, reader, writer, args):
+        pass
+
+    async def do_logout(self, reader, writer, args):
+        writer.write(b"* BYE Logging out\r\n")
+
+    async def do_idle(self, reader, writer, args):
+        writer.write(b"+ idling\r\n")
+        self.idling.append(writer)
+        try:
+            await reader.readline()  # DONE
+        finally:
+            self.idling.remove(writer)
+        return b"OK IDLE terminated"
+
+    async def do_expunge(self, reader, writer, args):
+        for uid in [uid for uid, (raw, flags) in self.mails.items() if b"\\Deleted" in flags]:
+            del self.mails[uid]
+
+    async def do_uid_expunge(self, reader, writer, args):
+        for uid in parse_set(args, list(self.mails)):
+            if b"\\Deleted" in self.mails[uid][1]:
+                del self.mails[uid]
+
+    async def do_uid_search(self, reader, writer, args):
+        tokens = args.replace(b"(", b" ").replace(b")", b" ").split()
+        uids = []
+        for uid, (raw, flags) in sorted(self.mails.items()):
+            matched, negate, i = True, False, 0
+            while i < len(tokens):
+                token = tokens[i].upper()
+                if token == b"NOT":
+                    negate = True
+                elif token == b"KEYWORD":
+                    i += 1
+                    matched = matched and (tokens[i] in flags) != negate
+                    negate = False
+                i += 1
+            if matched:
+                uids.append(uid)
+        writer.write(b"* SEARCH" + b"".join(b" %d" % uid for uid in uids) + b"\r\n")
+
+    async def do_uid_fetch(self, reader, writer, args):
+        msg_set, __, items = args.partition(b" ")
+        items = items.upper()
+        seqs = {uid: i + 1 for i, uid in enumerate(sorted(self.mails))}
+        for uid in parse_set(msg_set, list(self.mails)):
+            raw, flags = self.mails[uid]
+            parts = [b"UID %d" % uid]
+            if b"FLAGS" in items:
+                parts.append(b"FLAGS (%s)" % b" ".join(sorted(flags)))
+            if b"RFC822.SIZE" in items:
+                parts.append(b"RFC822.SIZE %d" % len(raw))
+            if b"ENVELOPE" in items:
+                parts.append(b"ENVELOPE " + envelope(email.message_from_bytes(raw)))
+            if b"BODYSTRUCTURE" in items:
+                parts.append(body_structure(raw))
+            header, __, text = raw.partition(b"\r\n\r\n")
+            literals = []
+            partial = PARTIAL_RE.search(items)
+            if partial:
+                offset, length = int(partial.group(1)), int(partial.group(2))
+                literals.append((b"BODY[]<%d>" % offset, raw[offset : offset + length]))
+            elif b"BODY.PEEK[]" in items:
+                literals.append((b"BODY[]", raw))
+            elif re.search(rb"\bRFC822(?!\.)", items):
+                literals.append((b"RFC822", raw))
+            if b"BODY.PEEK[HEADER]" in items:
+                literals.append((b"BODY[HEADER]", header + b"\r\n\r\n"))
+            if b"BODY.PEEK[TEXT]" in items:
+                literals.append((b"BODY[TEXT]", text))
+            line = b"* %d FETCH (%s" % (seqs[uid], b" ".join(parts))
+            for name, literal in literals:
+                line += b" %s {%d}\r\n%s" % (name, len(literal), literal)
+            writer.write(line + b")\r\n")
+
+    async def do_uid_store(self, reader, writer, args):
+        msg_set, __, rest = args.partition(b" ")
+        action, __, rest = rest.partition(b" ")
+        values = set(FLAGS_RE.search(rest).group("flags").split())
+        for uid in parse_set(msg_set, list(self.mails)):
+            flags = self.mails[uid][1]
+            if action.startswith(b"+"):
+                flags.update(values)
+            elif action.startswith(b"-"):
+                flags.difference_update(values)
+            else:
+                flags.clear()
+                flags.update(values)
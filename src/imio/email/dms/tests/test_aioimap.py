@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from imio.email.dms.aioimap import AsyncIMAPEmailHandler
+from imio.email.dms.tests.imap_server import FakeIMAPServer
+from unittest.mock import patch
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+
+def raw_mail(subject, body="body"):
+    return "From: agent@mail.be\r\nSubject: {}\r\n\r\n{}\r\n".format(subject, body).encode()
+
+
+class TestAsyncIMAP(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = FakeIMAPServer(uidvalidity=7)
+        self.server.append(raw_mail("first"))
+        self.server.append(raw_mail("imported"), flags=[b"imported"])
+        self.server.append(raw_mail("second"))
+        await self.server.start()
+        self.handler = AsyncIMAPEmailHandler()
+        await self.handler.connect("127.0.0.1", self.server.port, False, "user", 'pass "word"')
+
+    async def asyncTearDown(self):
+        await self.handler.disconnect()
+        await self.server.stop()
+
+    async def test_connect(self):
+        self.assertEqual(self.handler.uidvalidity, 7)
+        self.assertTrue(self.handler.has_idle())
+        self.assertIn(b'LOGIN "user" "pass \\"word\\""', self.server.commands)
+
+    async def test_iter_waiting_emails(self):
+        mails = [mail_info async for mail_info in self.handler.iter_waiting_emails(batch_size=200)]
+        self.assertEqual([mail_info.id for mail_info in mails], [b"1", b"3"])
+        self.assertEqual(mails[1].mail["Subject"], "second")
+        self.assertEqual(mails[1].size, len(raw_mail("second")))
+        self.assertEqual(self.handler.round_trips_saved, 1)
+        self.assertIn(b"UID FETCH 1,3 (UID FLAGS RFC822.SIZE BODY.PEEK[])", self.server.commands)
+        # one by one, with batches limited in bytes
+        mails = [mail_info async for mail_info in self.handler.iter_waiting_emails(batch_size=200, max_batch_bytes=10)]
+        self.assertEqual([mail_info.id for mail_info in mails], [b"1", b"3"])
+        self.assertEqual(self.server.commands[-1], b"UID FETCH 3 (RFC822)")
+
+    async def test_iter_waiting_emails_skeleton(self):
+        self.server.append(b"Subject: big\r\nContent-Type: application/pdf\r\n\r\n" + b"x" * 200000 + b"\r\n")
+        mails = [mail_info async for mail_info in self.handler.iter_waiting_emails(skeleton_min_size=100000)]
+        self.assertEqual([mail_info.id for mail_info in mails], [b"1", b"3", b"4"])
+        self.assertEqual([mail_info.partial for mail_info in mails], [False, False, True])
+        self.assertEqual(mails[2].mail["Subject"], "big")
+        self.assertEqual(mails[2].mail.get_payload(), "")
+        self.assertIn(b"UID FETCH 4 (BODY.PEEK[HEADER])", self.server.commands)
+
+    async def test_get_mail_spooled(self):
+        self.server.append(raw_mail("big", "x" * 30))
+        mail = await self.handler.get_mail_spooled(b"4", chunk_size=20)
+        self.assertEqual(mail["Subject"], "big")
+        self.assertEqual(mail.get_payload(), "x" * 30 + "\n")
+        self.assertEqual(self.server.commands[-1], b"UID FETCH 4 (BODY.PEEK[]<60.20>)")
+        # big mails are spooled
+        with patch("imio.email.dms.aioimap.SPOOL_MIN_SIZE", 10):
+            mail = await self.handler.get_mail(b"4", size=len(raw_mail("big", "x" * 30)))
+        self.assertEqual(mail["Subject"], "big")
+        self.assertEqual(self.server.commands[-1], b"UID FETCH 4 (BODY.PEEK[]<0.1048576>)")
+
+    async def test_marks(self):
+        self.handler.queue_mark(b"1", "imported")
+        self.handler.queue_mark(b"3", "error")
+        await self.handler.flush_marks()
+        self.assertEqual(self.server.mails[1][1], {b"imported"})
+        self.assertEqual(self.server.mails[3][1], {b"error"})
+        self.assertEqual(await self.handler.search("NOT KEYWORD imported"), [b"3"])
+
+    async def test_idle(self):
+        self.assertFalse(await self.handler.idle(timeout=0.1))
+        task = asyncio.ensure_future(self.handler.wait_for_changes(idle_timeout=5))
+        while not self.server.idling:
+            await asyncio.sleep(0.01)
+        self.server.append(raw_mail("new"))
+        self.assertTrue(await task)
+        # the connection is usable after IDLE
+        self.assertEqual(await self.handler.search("ALL"), [b"1", b"2", b"3", b"4"])
+
+    async def test_sync_state(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "sync.json")
+            self.handler.load_sync_state(path)
+            mails = [mail_info async for mail_info in self.handler.iter_waiting_emails(batch_size=200)]
+            self.assertEqual(len(mails), 2)
+            # saved once the mails are flagged
+            self.assertFalse(os.path.exists(path))
+            for mail_info in mails:
+                self.handler.queue_mark(mail_info.id, "imported")
+            self.handler.end_sync(await self.handler.flush_marks())
+            self.assertEqual(self.handler.sync_state, {"UIDVALIDITY": 7, "UIDNEXT": 4})
+            self.assertTrue(os.path.exists(path))
+
+    async def test_sync_state_fetch_error(self):
+        get_mail = self.handler.get_mail
+
+        async def get_mail_error(mail_id, *args, **kwargs):
+            return mail_id != b"3" and await get_mail(mail_id, *args, **kwargs) or None
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "sync.json")
+            self.handler.load_sync_state(path)
+            self.handler.get_mail = get_mail_error
+            mails = [mail_info async for mail_info in self.handler.iter_waiting_emails(max_batch_bytes=10)]
+            self.assertEqual([mail_info.id for mail_info in mails], [b"1"])
+            self.handler.end_sync(True)
+            self.assertIsNone(self.handler.sync_state)
+            self.assertFalse(os.path.exists(path))
+            self.handler.get_mail = get_mail
+            mails = [mail_info async for mail_info in self.handler.iter_waiting_emails(max_batch_bytes=10)]
+            self.assertEqual([mail_info.id for mail_info in mails], [b"1", b"3"])
+            self.handler.end_sync(True)
+            self.assertTrue(os.path.exists(path))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from imio.email.dms.cache import TransformCache
+from imio.email.dms.cache import WorkCache
+
+import email
+import os
+import tempfile
+import time
+import unittest
+
+
+class TestWorkCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = WorkCache(os.path.join(self.tmp_dir.name, "cache"), max_size=100, max_age=3600)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def put(self, key, content):
+        src = os.path.join(self.tmp_dir.name, "src")
+        with open(src, "wb") as src_file:
+            src_file.write(content)
+        path = self.cache.put_file(key, "mail.tar", src)
+        os.unlink(src)
+        return path
+
+    def test_key(self):
+        mail = email.message_from_string("Subject: test\n\nbody\n")
+        other = email.message_from_string("Subject: test\n\nother body\n")
+        self.assertEqual(WorkCache.key(mail), WorkCache.key(email.message_from_string(mail.as_string())))
+        self.assertNotEqual(WorkCache.key(mail), WorkCache.key(other))
+
+    def test_files(self):
+        self.assertIsNone(self.cache.get_file("abcd", "mail.tar"))
+        path = self.put("abcd", b"tar")
+        self.assertEqual(self.cache.get_file("abcd", "mail.tar"), path)
+        with open(path, "rb") as cached:
+            self.assertEqual(cached.read(), b"tar")
+        self.cache.put_object("abcd", "attachments", [{"content": b"image"}])
+        self.assertEqual(self.cache.get_object("abcd", "attachments"), [{"content": b"image"}])
+        self.cache.drop("abcd")
+        self.assertIsNone(self.cache.get_file("abcd", "mail.tar"))
+        self.assertIsNone(self.cache.get_object("abcd", "attachments"))
+
+    def test_evict(self):
+        self.put("aa01", b"x" * 40)
+        old = self.cache.entry_path("aa01")
+        os.utime(old, (time.time() - 7200, time.time() - 7200))
+        self.put("bb02", b"x" * 40)
+        os.utime(self.cache.entry_path("bb02"), (time.time() - 60, time.time() - 60))
+        self.put("cc03", b"x" * 40)
+        # too old
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertIsNone(self.cache.get_file("aa01", "mail.tar"))
+        self.put("dd04", b"x" * 40)
+        # too big: the oldest entry is removed
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertIsNone(self.cache.get_file("bb02", "mail.tar"))
+        self.assertIsNotNone(self.cache.get_file("cc03", "mail.tar"))
+        self.assertIsNotNone(self.cache.get_file("dd04", "mail.tar"))
+
+
+class TestTransformCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = TransformCache(self.tmp_dir.name, max_size=1100)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get(self):
+        key = TransformCache.key(b"logo", ("image", False, 1024))
+        self.assertNotEqual(key, TransformCache.key(b"logo", ("image", True, 1024)))
+        self.assertNotEqual(key, TransformCache.key(b"other logo", ("image", False, 1024)))
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, {"len": 3})
+        self.assertEqual(self.cache.get(key), {"len": 3})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        # kept between runs
+        self.assertEqual(TransformCache(self.tmp_dir.name).get(key), {"len": 3})
+
+    def test_evict(self):
+        keys = [TransformCache.key(str(num).encode(), ("pdf",)) for num in range(3)]
+        for num, key in enumerate(keys):
+            self.cache.put(key, b"x" * 300)
+            os.utime(self.cache.entry_path(key), (time.time() - 100 + num, time.time() - 100 + num))
+        # the first one is used
+        self.cache.get(keys[0])
+        self.cache.put(TransformCache.key(b"3", ("pdf",)), b"x" * 300)
+        self.assertLessEqual(self.cache.size, 990)
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNotNone(self.cache.get(keys[2]))
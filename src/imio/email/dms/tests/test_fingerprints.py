@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from imio.email.dms.fingerprints import fingerprint
+from imio.email.dms.fingerprints import FingerprintIndex
+from imio.email.dms.fingerprints import normalize_message_id
+
+import email
+import os
+import tempfile
+import unittest
+
+
+MAIL = "Message-ID: {}\nSubject: test\nContent-Type: text/plain\n\n{}\n"
+
+
+class TestFingerprints(unittest.TestCase):
+    def test_normalize_message_id(self):
+        self.assertEqual(normalize_message_id("  <Abc@Mail.BE> "), "Abc@mail.be")
+        self.assertEqual(normalize_message_id(None), "")
+
+    def test_fingerprint(self):
+        mail = email.message_from_string(MAIL.format("<abc@mail.be>", "body"))
+        # redelivered, with other headers
+        same = email.message_from_string("Received: by mx\n" + MAIL.format("<abc@MAIL.be>", "body"))
+        self.assertEqual(fingerprint(mail), fingerprint(same))
+        other_body = email.message_from_string(MAIL.format("<abc@mail.be>", "other"))
+        self.assertNotEqual(fingerprint(mail), fingerprint(other_body))
+        other_id = email.message_from_string(MAIL.format("<def@mail.be>", "body"))
+        self.assertNotEqual(fingerprint(mail), fingerprint(other_id))
+        self.assertIsNone(fingerprint(email.message_from_string("Subject: empty\n\n")))
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "fingerprints.log")
+            index = FingerprintIndex(path, max_entries=2)
+            index.add("fp1", b"1", "01Z999900000001")
+            index.add("fp2", b"2", "01Z999900000002")
+            self.assertEqual(index.get("fp1")[:2], ["1", "01Z999900000001"])
+            index.add("fp3", b"3", "01Z999900000003")
+            # the oldest is evicted
+            self.assertIsNone(index.get("fp1"))
+            index.add("fp4", b"4", "01Z999900000004")
+            index.add("fp5", b"5", "01Z999900000005")
+            # duplicates handled concurrently
+            self.assertIsNone(index.claim("fp6", b"6"))
+            self.assertEqual(index.claim("fp6", b"7"), ("6", None))
+            self.assertEqual(index.claim("fp5", b"7"), ("5", "01Z999900000005"))
+            index.release("fp6", b"6")
+            self.assertIsNone(index.claim("fp6", b"7"))
+            index.close()
+            # compacted when the file has twice as many lines
+            with open(path) as index_file:
+                self.assertEqual(len(index_file.readlines()), 2)
+            index = FingerprintIndex(path, max_entries=2)
+            self.assertEqual(list(index.entries), ["fp4", "fp5"])
+            index.close()
+
+    def test_index_remove(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "fingerprints.log")
+            index = FingerprintIndex(path)
+            index.add("fp1", b"1", "01Z999900000001")
+            index.add("fp2", b"2", "01Z999900000002")
+            self.assertEqual(index.claim("fp1", b"3"), ("1", "01Z999900000001"))
+            index.add_duplicate("fp1", b"3")
+            index.close()
+            # the duplicates are kept in the file
+            index = FingerprintIndex(path)
+            self.assertEqual(index.duplicates, {"3": "fp1"})
+            # a requeued duplicate is not a duplicate anymore
+            self.assertTrue(index.remove(b"3"))
+            self.assertIsNone(index.claim("fp1", b"3"))
+            self.assertFalse(index.remove(b"3"))
+            # nor is a requeued imported email
+            self.assertTrue(index.remove(b"2"))
+            self.assertIsNone(index.get("fp2"))
+            index.close()
+            with open(path) as index_file:
+                self.assertEqual(len(index_file.readlines()), 0)
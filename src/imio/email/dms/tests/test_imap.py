@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from imio.email.dms.imap import IMAP4
+from imio.email.dms.imap import IMAPEmailHandler
+from imio.email.dms.imap import inline_literals
+from imio.email.dms.imap import message_set
+from imio.email.dms.imap import parse_imap_list
+from imio.email.dms.imap import split_fetch_response
+from imio.email.dms.imap import SPOOL_MIN_SIZE
+from imio.email.parser.tests.test_parser import get_eml_message
+from unittest.mock import call
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import base64
+import imaplib
+import json
+import os
+import socket
+import tempfile
+import unittest
+import zlib
+
+
+def fetch_item(uid, raw, flags=b"\\Seen"):
+    return (
+        b"%d (UID %d FLAGS (%s) RFC822.SIZE %d BODY[] {%d}" % (uid % 100, uid, flags, len(raw), len(raw)),
+        raw,
+    )
+
+
+class TestIMAP(unittest.TestCase):
+    def setUp(self):
+        self.handler = IMAPEmailHandler()
+        self.handler.connection = MagicMock()
+
+    def test_message_set(self):
+        self.assertEqual(message_set([b"1", b"2", b"3", b"5"]), "1:3,5")
+        self.assertEqual(message_set(["7", "4", "6", "9", "10"]), "4,6:7,9:10")
+        self.assertEqual(message_set([3]), "3")
+
+    def test_split_fetch_response(self):
+        data = [
+            (b"1 (UID 101 BODY[] {3}", b"abc"),
+            b" FLAGS (\\Seen imported))",
+            (b"2 (UID 102 FLAGS () BODY[] {2}", b"de"),
+            b")",
+        ]
+        self.assertListEqual(
+            split_fetch_response(data),
+            [
+                (b"1 (UID 101 BODY[] {3}  FLAGS (\\Seen imported))", b"abc"),
+                (b"2 (UID 102 FLAGS () BODY[] {2} )", b"de"),
+            ],
+        )
+
+    def test_connect(self):
+        with patch("imio.email.dms.imap.IMAP4") as MockIMAP4:
+            MockIMAP4.return_value.response.return_value = ("UIDVALIDITY", [b"1234"])
+            self.handler.connect("localhost", 143, False, "login", "pass")
+        MockIMAP4.return_value.enable_compression.assert_called_once_with()
+        MockIMAP4.return_value.select.assert_called_once_with("INBOX")
+        self.assertEqual(self.handler.uidvalidity, 1234)
+
+    def test_get_mails(self):
+        raw1 = get_eml_message("01_email_with_inline_and_annexes.eml").as_bytes()
+        raw2 = get_eml_message("04_email_with_pdf_attachment.eml").as_bytes()
+        self.handler.connection.uid.side_effect = [
+            ("OK", [fetch_item(101, raw1), b")", fetch_item(102, raw2, flags=b""), b")"]),
+            ("OK", [fetch_item(105, raw1), b")"]),
+        ]
+        mails = self.handler.get_mails([b"101", b"102", b"105"], batch_size=2)
+        self.assertEqual(self.handler.connection.uid.call_count, 2)
+        self.assertEqual(self.handler.connection.uid.call_args_list[0][0][:2], ("FETCH", "101:102"))
+        self.assertListEqual([m.id for m in mails], [b"101", b"102", b"105"])
+        self.assertEqual(mails[0].flags, (b"\\Seen",))
+        self.assertEqual(mails[1].flags, ())
+        self.assertEqual(mails[1].size, len(raw2))
+        self.assertEqual(mails[0].mail["Subject"], get_eml_message("01_email_with_inline_and_annexes.eml")["Subject"])
+        self.assertEqual(self.handler.round_trips_saved, 1)
+
+    def test_iter_waiting_emails(self):
+        raw = get_eml_message("04_email_with_pdf_attachment.eml").as_bytes()
+        sizes = [b"%d (UID %d RFC822.SIZE %d)" % (uid - 100, uid, len(raw)) for uid in (101, 102, 103)]
+        self.handler.connection.uid.side_effect = [
+            ("OK", [b"101 102 103"]),
+            ("OK", sizes),
+            ("OK", [fetch_item(101, raw), b")", fetch_item(102, raw), b")"]),
+            ("OK", [(b"3 (UID 103 RFC822 {%d}" % len(raw), raw), b")"]),
+        ]
+        mails = self.handler.iter_waiting_emails(batch_size=10, max_batch_bytes=len(raw) * 2)
+        self.assertEqual(self.handler.connection.uid.call_count, 0)  # lazy
+        self.assertEqual(next(mails).id, b"101")
+        self.assertEqual(self.handler.connection.uid.call_count, 3)
+        self.assertListEqual([m.id for m in mails], [b"102", b"103"])
+        calls = self.handler.connection.uid.call_args_list
+        self.assertEqual(calls[0][0][0], "SEARCH")
+        self.assertEqual(calls[2][0][:2], ("FETCH", "101:102"))
+        self.assertEqual(calls[3][0], ("FETCH", b"103", "(RFC822)"))
+
+    def test_mark_mails(self):
+        self.handler.connection.uid.return_value = ("OK", [None])
+        self.handler.mark_mail_as_imported(b"101")
+        self.assertListEqual(
+            self.handler.connection.uid.call_args_list,
+            [
+                call("STORE", "101", "-FLAGS.SILENT", "(waiting error)"),
+                call("STORE", "101", "+FLAGS.SILENT", "(imported)"),
+            ],
+        )
+        self.handler.connection.reset_mock()
+        self.handler.mark_reset_all(b"101")
+        self.assertEqual(self.handler.connection.uid.call_count, 1)
+
+    def test_reset_errors(self):
+        self.handler.connection.uid.return_value = ("OK", [b"101 102 103 110"])
+        self.assertEqual(self.handler.reset_errors(), 4)
+        self.assertListEqual(
+            self.handler.connection.uid.call_args_list[1:],
+            [
+                call("STORE", "101:103,110", "-FLAGS.SILENT", "(imported error)"),
+                call("STORE", "101:103,110", "+FLAGS.SILENT", "(waiting)"),
+            ],
+        )
+
+    def test_flush_marks(self):
+        self.handler.connection.uid.return_value = ("OK", [None])
+        for uid, transition in ((b"101", "imported"), (b"102", "error"), (b"103", "imported")):
+            self.handler.queue_mark(uid, transition)
+        self.handler.connection.uid.assert_not_called()
+        self.assertTrue(self.handler.flush_marks())
+        self.assertEqual(self.handler.connection.uid.call_count, 4)
+        self.assertIn(
+            call("STORE", "101,103", "+FLAGS.SILENT", "(imported)"), self.handler.connection.uid.call_args_list
+        )
+        self.assertTrue(self.handler.flush_marks())
+        self.assertEqual(self.handler.connection.uid.call_count, 4)
+
+    def test_flush_marks_error(self):
+        conn = self.handler.connection
+        for uid, transition in ((b"101", "imported"), (b"102", "error"), (b"103", "imported")):
+            self.handler.queue_mark(uid, transition)
+        # the transitions not stored are kept
+        conn.uid.side_effect = [("OK", [None]), ("OK", [None]), imaplib.IMAP4.abort("socket error")]
+        with self.assertRaises(imaplib.IMAP4.abort):
+            self.handler.flush_marks()
+        self.assertEqual(self.handler.pending_marks, {"error": [b"102"]})
+        conn.uid.side_effect = [("OK", [None]), ("NO", [b"failed"])]
+        with self.assertLogs("imio.email.dms", level="ERROR"):
+            self.assertFalse(self.handler.flush_marks())
+        self.assertEqual(self.handler.pending_marks, {"error": [b"102"]})
+        conn.uid.side_effect = None
+        conn.uid.return_value = ("OK", [None])
+        conn.uid.reset_mock()
+        self.assertTrue(self.handler.flush_marks())
+        self.assertEqual(
+            conn.uid.call_args_list,
+            [call("STORE", "102", "-FLAGS.SILENT", "(waiting)"), call("STORE", "102", "+FLAGS.SILENT", "(error)")],
+        )
+        self.assertEqual(self.handler.pending_marks, {})
+
+    def test_stats(self):
+        self.handler.connection.uid.return_value = (
+            "OK",
+            [b"1 (UID 101 FLAGS (\\Seen imported))", b"2 (UID 102 FLAGS (\\Seen error))", b"3 (UID 103 FLAGS ())"],
+        )
+        stats = self.handler.stats()
+        self.handler.connection.uid.assert_called_once_with("FETCH", "1:*", "(FLAGS)")
+        self.assertDictEqual(stats, {"tot": 3, "flags": {"\\Seen": 2, "imported": 1, "error": 1}})
+
+        self.handler.connection.reset_mock()
+        self.handler.connection.uid.side_effect = [
+            ("OK", [b"101 102"]),
+            ("OK", [b"1 (UID 101 FLAGS (\\Seen imported))", b"2 (UID 102 FLAGS (\\Seen error))"]),
+        ]
+        stats = self.handler.stats(since=datetime(2025, 1, 6), before=datetime(2025, 2, 1))
+        self.assertListEqual(
+            self.handler.connection.uid.call_args_list,
+            [call("SEARCH", "SINCE 06-Jan-2025", "BEFORE 01-Feb-2025"), call("FETCH", "101:102", "(FLAGS)")],
+        )
+        self.assertEqual(stats["tot"], 2)
+
+    def test_idle(self):
+        server, client = socket.socketpair()
+        conn = self.handler.connection
+        conn.sock = client
+        conn.file = client.makefile("rb")
+        conn._new_tag.return_value = b"A001"
+        conn.readline.side_effect = [b"+ idling\r\n", b"A001 OK IDLE terminated\r\n"]
+        self.assertFalse(self.handler.idle(timeout=0.1))
+        conn.send.assert_has_calls([call(b"A001 IDLE\r\n"), call(b"DONE\r\n")])
+
+        server.sendall(b"* 3 EXISTS\r\n")  # makes the socket readable
+        conn.readline.side_effect = [
+            b"+ idling\r\n",
+            b"* OK Still here\r\n",
+            b"* 3 EXISTS\r\n",
+            b"A001 OK IDLE terminated\r\n",
+        ]
+        self.assertTrue(self.handler.idle(timeout=5))
+        server.close()
+        client.close()
+
+    def test_idle_buffered(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        connection = IMAP4.__new__(IMAP4)
+        connection.sock = client
+        connection.file = client.makefile("rb")
+        self.addCleanup(connection.file.close)
+        self.handler.connection = connection
+        # the change is read ahead with the continuation line: the socket is not readable anymore
+        server.sendall(b"+ idling\r\n* 3 EXISTS\r\nA001 OK IDLE terminated\r\n")
+        with patch.object(connection, "_new_tag", return_value=b"A001"):
+            self.assertTrue(self.handler.idle(timeout=1))
+        self.assertEqual(server.recv(100), b"A001 IDLE\r\nDONE\r\n")
+        self.assertIsNone(client.gettimeout())
+
+    def test_wait_for_changes_without_idle(self):
+        conn = self.handler.connection
+        conn.capabilities = ("IMAP4REV1",)
+        conn.response.side_effect = [("EXISTS", [b"3"]), ("RECENT", [None]), ("EXISTS", [b"4"]), ("RECENT", [None])]
+        with patch("imio.email.dms.imap.time.sleep") as mock_sleep:
+            self.assertTrue(self.handler.wait_for_changes(idle_timeout=300, poll_interval=60))
+        mock_sleep.assert_called_once_with(60)
+        conn.noop.assert_called_once_with()
+
+    def test_incremental_sync(self):
+        conn = self.handler.connection
+        conn.capabilities = ("IMAP4REV1", "IDLE", "CONDSTORE")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_path = os.path.join(tmp_dir, "sync_019999.json")
+            self.handler.load_sync_state(state_path)
+            # first run: full search
+            conn.status.return_value = ("OK", [b'"INBOX" (UIDVALIDITY 7 UIDNEXT 104 HIGHESTMODSEQ 500)'])
+            conn.uid.return_value = ("OK", [b""])
+            self.assertListEqual(list(self.handler.iter_waiting_emails()), [])
+            self.assertEqual(conn.uid.call_args[0][:2], ("SEARCH", "NOT KEYWORD imported"))
+            self.handler.end_sync(True)
+            with open(state_path) as state_file:
+                self.assertDictEqual(json.load(state_file), {"UIDVALIDITY": 7, "UIDNEXT": 104, "HIGHESTMODSEQ": 500})
+            # no change: only STATUS
+            conn.reset_mock()
+            self.handler.load_sync_state(state_path)
+            self.assertListEqual(list(self.handler.iter_waiting_emails()), [])
+            conn.status.assert_called_once_with("INBOX", "(UIDVALIDITY UIDNEXT HIGHESTMODSEQ)")
+            conn.uid.assert_not_called()
+            # changes: only new or modified messages are searched
+            conn.status.return_value = ("OK", [b'"INBOX" (UIDVALIDITY 7 UIDNEXT 105 HIGHESTMODSEQ 502)'])
+            self.assertListEqual(list(self.handler.iter_waiting_emails()), [])
+            self.assertEqual(conn.uid.call_args[0][:2], ("SEARCH", "OR UID 104:* MODSEQ 501"))
+            self.handler.end_sync(True)
+            self.assertEqual(self.handler.sync_state["HIGHESTMODSEQ"], 502)
+            # uidvalidity change: full search
+            conn.status.return_value = ("OK", [b'"INBOX" (UIDVALIDITY 8 UIDNEXT 2 HIGHESTMODSEQ 3)'])
+            self.assertListEqual(list(self.handler.iter_waiting_emails()), [])
+            self.assertEqual(conn.uid.call_args[0][:2], ("SEARCH", "NOT KEYWORD imported"))
+
+    def test_incremental_sync_fetch_error(self):
+        conn = self.handler.connection
+        conn.capabilities = ("IMAP4REV1", "IDLE", "CONDSTORE")
+        raw = b"From: agent@mail.be\r\nSubject: test\r\n\r\nbody\r\n"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_path = os.path.join(tmp_dir, "sync_019999.json")
+            with open(state_path, "w") as state_file:
+                json.dump({"UIDVALIDITY": 7, "UIDNEXT": 101, "HIGHESTMODSEQ": 500}, state_file)
+            self.handler.load_sync_state(state_path)
+            conn.status.return_value = ("OK", [b'"INBOX" (UIDVALIDITY 7 UIDNEXT 104 HIGHESTMODSEQ 510)'])
+            # the fetch of the second mail fails
+            conn.uid.side_effect = [
+                ("OK", [b"101 102 103"]),
+                ("OK", [fetch_item(101, raw), b")"]),
+                ("NO", [None]),
+                ("OK", [fetch_item(103, raw), b")"]),
+            ]
+            self.assertListEqual([m.id for m in self.handler.iter_waiting_emails()], [b"101", b"103"])
+            # the previous state is kept: the next run still searches the mail not fetched
+            self.handler.end_sync(True)
+            self.assertEqual(self.handler.sync_state["UIDNEXT"], 101)
+            self.handler.load_sync_state(state_path)
+            conn.uid.side_effect = [("OK", [b"102"]), ("OK", [fetch_item(102, raw), b")"])]
+            with patch("imio.email.dms.imap.dev_mode", True):
+                self.assertListEqual([m.id for m in self.handler.iter_waiting_emails()], [b"102"])
+            self.assertEqual(conn.uid.call_args_list[-2][0][:2], ("SEARCH", "OR UID 101:* MODSEQ 501"))
+            # not saved in dev mode, where the mails are not flagged
+            self.handler.end_sync(True)
+            self.assertEqual(self.handler.sync_state["UIDNEXT"], 101)
+            conn.uid.side_effect = [("OK", [b"102"]), ("OK", [fetch_item(102, raw), b")"])]
+            self.assertListEqual([m.id for m in self.handler.iter_waiting_emails()], [b"102"])
+            self.handler.end_sync(True)
+            with open(state_path) as state_file:
+                self.assertEqual(json.load(state_file)["UIDNEXT"], 104)
+
+    def test_incremental_sync_flags_error(self):
+        conn = self.handler.connection
+        conn.capabilities = ("IMAP4REV1", "IDLE", "CONDSTORE")
+        raw = b"From: agent@mail.be\r\nSubject: test\r\n\r\nbody\r\n"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_path = os.path.join(tmp_dir, "sync_019999.json")
+            with open(state_path, "w") as state_file:
+                json.dump({"UIDVALIDITY": 7, "UIDNEXT": 101, "HIGHESTMODSEQ": 500}, state_file)
+            self.handler.load_sync_state(state_path)
+            conn.status.return_value = ("OK", [b'"INBOX" (UIDVALIDITY 7 UIDNEXT 102 HIGHESTMODSEQ 510)'])
+            conn.uid.side_effect = [("OK", [b"101"]), ("OK", [fetch_item(101, raw), b")"])]
+            for mail_info in self.handler.iter_waiting_emails():
+                self.handler.queue_mark(mail_info.id, "imported")
+            # all the mails are fetched, but not flagged yet: the state isn't saved
+            self.assertEqual(self.handler.sync_state["UIDNEXT"], 101)
+            conn.uid.side_effect = [("OK", [None]), ("NO", [b"failed"])]
+            with self.assertLogs("imio.email.dms", level="WARNING") as logs:
+                self.handler.end_sync(self.handler.flush_marks())
+            self.assertIn("Sync state not saved: flags not stored", logs.output[-1])
+            self.assertEqual(self.handler.sync_state["UIDNEXT"], 101)
+            with open(state_path) as state_file:
+                self.assertEqual(json.load(state_file)["UIDNEXT"], 101)
+            # the next run searches the mail again
+            self.handler = IMAPEmailHandler()
+            self.handler.connection = conn
+            self.handler.load_sync_state(state_path)
+            conn.uid.side_effect = [
+                ("OK", [b"101"]),
+                ("OK", [fetch_item(101, raw), b")"]),
+                ("OK", [None]),
+                ("OK", [None]),
+            ]
+            for mail_info in self.handler.iter_waiting_emails():
+                self.handler.queue_mark(mail_info.id, "imported")
+            self.assertEqual(conn.uid.call_args_list[-2][0][:2], ("SEARCH", "OR UID 101:* MODSEQ 501"))
+            self.handler.end_sync(self.handler.flush_marks())
+            self.assertEqual(self.handler.sync_state["UIDNEXT"], 102)
+
+    def test_parse_imap_list(self):
+        data = [(b'1 (UID 5 BODYSTRUCTURE ("text" "plain" ("name" {5}', b'a"b\\c'), b') NIL NIL "7bit" 3 1))']
+        self.assertListEqual(
+            parse_imap_list(inline_literals(data)),
+            [
+                b"1",
+                [
+                    b"UID",
+                    b"5",
+                    b"BODYSTRUCTURE",
+                    [b"text", b"plain", [b"name", b'a"b\\c'], None, None, b"7bit", b"3", b"1"],
+                ],
+            ],
+        )
+
+    def test_get_mail_skeleton(self):
+        bodystructure = (
+            b'1 (UID 101 BODYSTRUCTURE (("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 13 1 NIL NIL NIL NIL)'
+            b'("message" "rfc822" NIL NIL NIL "7bit" 900 ("date" "Inner" NIL NIL NIL NIL NIL NIL NIL NIL) '
+            b'("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 12 1 NIL NIL NIL NIL) 10 NIL NIL NIL NIL)'
+            b'("application" "pdf" NIL NIL NIL "base64" 25000000 NIL NIL NIL NIL) "mixed" ("boundary" "b1") NIL NIL))'
+        )
+        sections = {
+            b"HEADER": b'From: agent@mail.be\r\nSubject: Fwd\r\nContent-Type: multipart/mixed; boundary="b1"\r\n\r\n',
+            b"1.MIME": b"Content-Type: text/plain\r\n\r\n",
+            b"1": b"see attached",
+            b"2.MIME": b"Content-Type: message/rfc822\r\n\r\n",
+            b"2.HEADER": b"From: orig@mail.be\r\nSubject: Inner\r\n\r\n",
+            b"2.TEXT": b"hello inner",
+            b"3.MIME": b"Content-Type: application/pdf\r\nContent-Transfer-Encoding: base64\r\n\r\n",
+        }
+        fetched = [(b"1 (UID 101 BODY[%s] {%d}" % (sec, len(val)), val) for sec, val in sections.items()]
+        self.handler.connection.uid.side_effect = [("OK", [bodystructure]), ("OK", fetched + [b")"])]
+        mail = self.handler.get_mail_skeleton(b"101")
+        self.assertEqual(
+            self.handler.connection.uid.call_args_list[1][0][2],
+            "(BODY.PEEK[HEADER] BODY.PEEK[1.MIME] BODY.PEEK[1] BODY.PEEK[2.MIME] BODY.PEEK[2.HEADER] "
+            "BODY.PEEK[2.TEXT] BODY.PEEK[3.MIME])",
+        )
+        self.assertListEqual(
+            [part.get_content_type() for part in mail.walk()],
+            ["multipart/mixed", "text/plain", "message/rfc822", "text/plain", "application/pdf"],
+        )
+        self.assertEqual(mail["Subject"], "Fwd")
+        self.assertEqual(mail.get_payload(1).get_payload(0)["Subject"], "Inner")
+        self.assertEqual(mail.get_payload(1).get_payload(0).get_content().strip(), "hello inner")
+        self.assertEqual(mail.get_payload(2).get_payload(), "")
+
+    def test_parse_mail(self):
+        raw = get_eml_message("01_email_with_inline_and_annexes.eml").as_bytes()
+        self.assertTrue(raw.isascii())
+        mail = self.handler.parse_mail(raw)
+        self.assertEqual(mail["Subject"], get_eml_message("01_email_with_inline_and_annexes.eml")["Subject"])
+        content = "Réunion du collège échevinal\n"
+        for charset in ("utf-8", "iso-8859-1"):
+            raw = (
+                b"From: agent@mail.be\nSubject: test\nContent-Type: text/plain; charset=%s\n"
+                b"Content-Transfer-Encoding: 8bit\n\n%s" % (charset.encode(), content.encode(charset) * 20)
+            )
+            self.assertEqual(self.handler.parse_mail(raw).get_payload(), content * 20)
+
+    @patch("imio.email.parser.parser.Parser")
+    def test_list_last_emails(self, MockParser):
+        fwd = (
+            b'1 (UID 101 FLAGS (\\Seen imported) INTERNALDATE "06-Jan-2025 08:51:00 +0100" ENVELOPE '
+            b'("Mon, 06 Jan 2025 08:51:00 +0100" "Fwd: =?utf-8?q?R=C3=A9union?=" (("Agent" NIL "agent" "mail.be")) '
+            b"NIL NIL NIL NIL NIL NIL NIL) BODYSTRUCTURE ("
+            b'("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 13 1 NIL NIL NIL NIL)'
+            b'("message" "rfc822" NIL NIL NIL "7bit" 900 ("Sun, 05 Jan 2025 10:00:00 +0100" {8}'
+        )
+        data = [
+            (fwd, "Réunion".encode()),
+            b' (("Orig" NIL "orig" "mail.be")) NIL NIL NIL NIL NIL NIL NIL) '
+            b'("text" "plain" NIL NIL NIL "7bit" 12 1 NIL NIL NIL NIL) 10 NIL NIL NIL NIL) "mixed" NIL NIL NIL NIL))',
+            b'2 (UID 102 FLAGS () INTERNALDATE "07-Jan-2025 10:00:00 +0100" ENVELOPE (NIL "Redirected" '
+            b'((NIL NIL "agent" "mail.be")) NIL NIL NIL NIL NIL NIL NIL) BODYSTRUCTURE ("text" "plain" NIL NIL NIL '
+            b'"7bit" 12 1 NIL NIL NIL NIL))',
+        ]
+        self.handler.connection.uid.side_effect = [("OK", [b"99 100 101 102"]), ("OK", data)]
+        MockParser.return_value.parsed_message.headers = {"From": "Other <other@mail.be>"}
+        MockParser.return_value.headers = {"Subject": "Original"}
+        with patch.object(self.handler, "get_mail") as get_mail:
+            lst = self.handler.list_last_emails(nb=2)
+        get_mail.assert_called_once_with("102")
+        self.assertEqual(
+            self.handler.connection.uid.call_args_list[1][0],
+            ("FETCH", "101:102", "(UID FLAGS INTERNALDATE ENVELOPE BODYSTRUCTURE)"),
+        )
+        self.assertEqual(len(lst), 2)
+        self.assertTrue(
+            lst[0].endswith(
+                "101: 'Agent <agent@mail.be>', 'Fwd: Réunion', 'Orig <orig@mail.be>', 'Réunion', "
+                "['\\\\Seen', 'imported']"
+            ),
+            lst[0],
+        )
+        self.assertTrue(
+            lst[1].endswith("102: 'agent@mail.be', 'Redirected', 'Other <other@mail.be>', 'Original', []"), lst[1]
+        )
+        self.assertTrue(lst[1].startswith("2025-01-07 "))
+
+    def test_get_subjects(self):
+        data = [
+            b'1 (UID 101 FLAGS () INTERNALDATE "06-Jan-2025 08:51:00 +0100" ENVELOPE (NIL "Fwd: test" NIL NIL NIL '
+            b'NIL NIL NIL NIL NIL) BODYSTRUCTURE (("text" "plain" NIL NIL NIL "7bit" 13 1 NIL NIL NIL NIL)'
+            b'("message" "rfc822" NIL NIL NIL "7bit" 900 (NIL "Original" NIL NIL NIL NIL NIL NIL NIL NIL) '
+            b'("text" "plain" NIL NIL NIL "7bit" 12 1 NIL NIL NIL NIL) 10 NIL NIL NIL NIL) "mixed" NIL NIL NIL NIL))',
+            b'2 (UID 102 FLAGS () INTERNALDATE "07-Jan-2025 10:00:00 +0100" ENVELOPE (NIL "Redirected" NIL NIL NIL '
+            b'NIL NIL NIL NIL NIL) BODYSTRUCTURE ("text" "plain" NIL NIL NIL "7bit" 12 1 NIL NIL NIL NIL))',
+        ]
+        self.handler.connection.uid.return_value = ("OK", data)
+        self.assertEqual(self.handler.get_subjects([b"101", b"102", b"103"]), {101: "Original", 102: "Redirected"})
+        self.handler.connection.uid.assert_called_once_with(
+            "FETCH", "101:103", "(UID FLAGS INTERNALDATE ENVELOPE BODYSTRUCTURE)"
+        )
+
+    def test_delete_mails(self):
+        self.handler.connection.uid.return_value = ("OK", [None])
+        self.handler.connection.capabilities = ("IMAP4REV1", "UIDPLUS")
+        self.assertTrue(self.handler.delete_mails([b"1", b"2", b"3", b"7"]))
+        self.assertEqual(
+            [c[0] for c in self.handler.connection.uid.call_args_list],
+            [("STORE", "1:3,7", "+FLAGS.SILENT", "(\\Deleted)"), ("EXPUNGE", "1:3,7")],
+        )
+        self.handler.connection.expunge.assert_not_called()
+        # without UIDPLUS, the whole mailbox is expunged once
+        self.handler.connection.uid.reset_mock()
+        self.handler.connection.capabilities = ("IMAP4REV1",)
+        self.handler.connection.expunge.return_value = ("OK", [None])
+        self.assertTrue(self.handler.delete_mails([b"1"]))
+        self.handler.connection.uid.assert_called_once_with("STORE", "1", "+FLAGS.SILENT", "(\\Deleted)")
+        self.handler.connection.expunge.assert_called_once_with()
+
+    def test_deflate(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        connection = IMAP4.__new__(IMAP4)
+        connection.sock = client
+        connection.capabilities = ("IMAP4REV1", "COMPRESS=DEFLATE")
+        with (
+            patch.object(connection, "_get_capabilities"),
+            patch.object(connection, "_simple_command", return_value=("OK", [b"DEFLATE active"])) as command,
+        ):
+            self.assertTrue(connection.enable_compression())
+        command.assert_called_once_with("COMPRESS", "DEFLATE")
+        literal = base64.encodebytes(b"\x00" * 30000)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        server.sendall(
+            compressor.compress(b"* 1 FETCH (BODY[] {%d}\r\n%s)\r\n" % (len(literal), literal))
+            + compressor.flush(zlib.Z_SYNC_FLUSH)
+        )
+        self.assertEqual(connection.readline(), b"* 1 FETCH (BODY[] {%d}\r\n" % len(literal))
+        self.assertEqual(connection.read(len(literal)), literal)
+        self.assertEqual(connection.readline(), b")\r\n")
+        self.assertLess(connection.wire_bytes * 10, connection.data_bytes)
+        connection.send(b"A1 NOOP\r\n")
+        self.assertEqual(zlib.decompressobj(-15).decompress(server.recv(100)), b"A1 NOOP\r\n")
+
+    def test_get_mail_spooled(self):
+        raw = b"From: agent@mail.be\r\nSubject: big\r\n\r\n" + b"x" * 30 + b"\r\n"
+        chunk_size = 20
+        responses = []
+        for offset in range(0, len(raw), chunk_size):
+            chunk = raw[offset : offset + chunk_size]
+            responses.append(("OK", [(b"1 (UID 101 BODY[]<%d> {%d}" % (offset, len(chunk)), chunk), b")"]))
+        self.handler.connection.uid.side_effect = responses
+        mail = self.handler.get_mail_spooled(b"101", chunk_size=chunk_size)
+        self.assertEqual(mail["Subject"], "big")
+        self.assertEqual(mail.get_content(), "x" * 30 + "\n")
+        self.assertEqual(
+            [call[0][2] for call in self.handler.connection.uid.call_args_list],
+            ["(BODY.PEEK[]<{}.20>)".format(offset) for offset in range(0, len(raw), chunk_size)],
+        )
+        # big mails are spooled
+        with patch.object(self.handler, "get_mail_spooled") as get_mail_spooled:
+            self.handler.get_mail(b"101", size=SPOOL_MIN_SIZE + 1)
+        get_mail_spooled.assert_called_once_with(b"101")
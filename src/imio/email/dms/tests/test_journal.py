@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from email.message import EmailMessage
+from imio.email.dms.imap import MailData
+from imio.email.dms.journal import Journal
+from imio.email.dms.utils import get_next_id
+
+import configparser
+import os
+import tempfile
+import time
+import unittest
+
+
+def mail_data(mail_id, message_id):
+    mail = EmailMessage()
+    mail["Message-ID"] = message_id
+    return MailData(mail_id, mail)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "journal.log")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resume(self):
+        first, second = mail_data(b"1", "<first@mail.be>"), mail_data(b"2", "<second@mail.be>")
+        journal = Journal(self.path)
+        self.assertEqual(journal.key(first), "1:<first@mail.be>")
+        journal.record(first, "fetched")
+        journal.record(first, "rendered", main_file_path="/tmp/1.pdf")
+        journal.record(second, "fetched")
+        journal.record(second, "uploaded", next_id=3)
+        journal.finish(second)
+        journal.flush()
+        journal.record(first, "packaged", tar_path="/tmp/mail_1.tar")
+        journal.close()
+        # the run is killed while writing a line
+        with open(self.path, "a") as journal_file:
+            journal_file.write('{"key": "1:<first@mail.be>", "st')
+        journal = Journal(self.path)
+        progress = journal.get(first)
+        self.assertEqual(sorted(progress), ["fetched", "main_file_path", "packaged", "rendered", "tar_path"])
+        self.assertEqual(progress["tar_path"], "/tmp/mail_1.tar")
+        self.assertEqual(journal.get(second), {})
+        # same uid, other message
+        self.assertEqual(journal.get(mail_data(b"1", "<other@mail.be>")), {})
+        journal.close()
+        # the journal is compacted: one line by unfinished email
+        with open(self.path) as journal_file:
+            self.assertEqual(len(journal_file.readlines()), 1)
+
+    def test_max_age(self):
+        journal = Journal(self.path)
+        journal.record(mail_data(b"1", "<first@mail.be>"), "fetched")
+        journal.close()
+        time.sleep(0.01)
+        journal = Journal(self.path, max_age=0)
+        self.assertEqual(journal.entries, {})
+        journal.close()
+
+    def test_reserve_ids(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"webservice": {"client_id": "019999", "counter_dir": self.tmp_dir.name}})
+        journal = Journal(self.path)
+        journal.record(mail_data(b"1", "<first@mail.be>"), "metadata_posted", next_id=5, response_id=12)
+        journal.reserve_ids(config)
+        self.assertEqual(get_next_id(config, {"nid": None}), (6, "01Z9999"))
+        journal.reserve_ids(config)
+        self.assertEqual(get_next_id(config, {"nid": None}), (6, "01Z9999"))
+        journal.close()
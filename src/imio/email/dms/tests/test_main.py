@@ -1,31 +1,91 @@
 from docopt import docopt
+from imio.email.dms.aioimap import AsyncIMAPEmailHandler
+from imio.email.dms.cache import TransformCache
 from imio.email.dms.imap import MailData
+from imio.email.dms.journal import Journal
 from imio.email.dms.main import __doc__
 from imio.email.dms.main import clean_mails
+from imio.email.dms.main import close_image_pools
 from imio.email.dms.main import compress_pdf
+from imio.email.dms.main import encode_image
+from imio.email.dms.main import get_fingerprint_index
+from imio.email.dms.main import get_image_budget
+from imio.email.dms.main import get_image_pool
+from imio.email.dms.main import IMAGE_MAX_PIXELS
+from imio.email.dms.main import IMAGE_MAX_TRIALS
+from imio.email.dms.main import log_image_stats
 from imio.email.dms.main import modify_attachments
 from imio.email.dms.main import Notify
+from imio.email.dms.main import probe_image
 from imio.email.dms.main import process_mails
 from imio.email.dms.main import resize_inline_images
+from imio.email.dms.main import run_daemon
+from imio.email.dms.main import transform_image
+from imio.email.dms.main import treat_emails
+from imio.email.dms.main import treat_emails_async
+from imio.email.dms.pipeline import ProcessPool
+from imio.email.dms.tests.imap_server import FakeIMAPServer
+from imio.email.dms.utils import get_next_id
 from imio.email.parser import email_policy  # noqa
 from imio.email.parser.parser import Parser
 from imio.email.parser.tests import test_parser
 from imio.email.parser.tests.test_parser import get_eml_message
+from io import BytesIO
 from pathlib import Path
+from PIL import Image
+from PIL import JpegImagePlugin
+from unittest.mock import ANY
+from unittest.mock import call
+from unittest.mock import MagicMock
 from unittest.mock import patch
 
+import asyncio
 import configparser
+import copy
 import email
+import imaplib
 import os
 import PyPDF2
+import struct
 import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
 
 TEST_FILES_PATH = os.path.join(os.path.dirname(__file__), "files")
 EML_TEST_FILES_PATH = os.path.join(os.path.dirname(test_parser.__file__), "files")
 
 
+def huge_png(width, height):
+    """Build a png image of black pixels (grayscale): width * height bytes once decoded, but a few MB compressed"""
+    compressor = zlib.compressobj(1)
+    rows = b"\0" * (width + 1) * 100  # filter byte and pixels of 100 rows
+    data = b"".join(compressor.compress(rows) for num in range(height // 100)) + compressor.flush()
+
+    def chunk(kind, body):
+        return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", data) + chunk(b"IEND", b"")
+
+
+def peak_memory(func, *args):
+    """Call func in the current process: (result, increase of the peak resident memory in MB), read in /proc (linux)"""
+
+    def memory(name):
+        with open("/proc/self/status") as status:
+            return [int(line.split()[1]) / 1024 for line in status if line.startswith(name + ":")][0]
+
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")  # resets the peak resident memory
+    before = memory("VmRSS")
+    result = func(*args)
+    return result, memory("VmHWM") - before
+
+
 class TestMain(unittest.TestCase):
     def setUp(self):
         self.config = configparser.ConfigParser()
@@ -57,6 +117,230 @@ class TestMain(unittest.TestCase):
             mod_attach = modify_attachments(name, parser.attachments, with_inline=False)
             self.assertEqual(len(mod_attach), dic["mod"]["at_nb"])
 
+    def test_get_image_pool(self):
+        config = configparser.ConfigParser()
+        config["images"] = {"workers": "2"}
+
+        def slow_pool(*args):
+            time.sleep(0.05)
+            return MagicMock()
+
+        with patch("imio.email.dms.main.ProcessPool", side_effect=slow_pool) as MockProcessPool:
+            # called concurrently by the transform threads: only one pool is created
+            pools = []
+            threads = [threading.Thread(target=lambda: pools.append(get_image_pool(config))) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            MockProcessPool.assert_called_once_with(2, 2)
+            self.assertEqual(len(set(map(id, pools))), 1)
+            close_image_pools()
+            pools[0].shutdown.assert_called_once_with()
+
+    def test_modify_attachments_pool(self):
+        def image(size, fmt, orientation=None):
+            img = Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3))
+            content = BytesIO()
+            exif = Image.Exif()
+            if orientation:
+                exif[0x0112] = orientation
+            img.save(content, format=fmt, exif=exif)
+            return content.getvalue()
+
+        contents = [
+            ("photo.jpg", "attachment", image((1600, 1200), "JPEG")),
+            ("logo.png", "inline", image((1200, 40), "PNG")),
+            ("notes.txt", "attachment", b"text"),
+            ("broken.png", "attachment", b"not an image"),
+            ("rotated.jpg", "attachment", image((300, 200), "JPEG", orientation=6)),
+        ]
+        attachments = [
+            {
+                "type": filename.endswith(".txt") and "text/plain" or "image/{}".format(filename[-3:]),
+                "disp": disp,
+                "filename": filename,
+                "len": len(content),
+                "content": content,
+            }
+            for filename, disp, content in contents
+        ]
+        expected = modify_attachments("1", copy.deepcopy(attachments))
+        self.assertEqual(
+            [dic["filename"] for dic in expected],
+            [
+                "photo-(redimensionné).jpg",
+                "logo-(redimensionné).png",
+                "notes.txt",
+                "broken.png",
+                "rotated-(redimensionné).jpg",
+            ],
+        )
+        self.assertEqual(expected[0]["size"], (1024, 768))
+        self.assertEqual(Image.open(BytesIO(expected[4]["content"])).size, (200, 300))
+        pool = ProcessPool(2, per_job=1)
+        try:
+            self.assertEqual(modify_attachments("1", copy.deepcopy(attachments), pool=pool), expected)
+            self.assertEqual(modify_attachments("2", copy.deepcopy(attachments), pool=pool), expected)
+        finally:
+            pool.shutdown()
+
+    @patch("imio.email.dms.main.compress_pdf")
+    def test_modify_attachments_cache(self, compress_pdf):
+        content = BytesIO()
+        Image.effect_noise((1600, 1200), 60).convert("RGB").save(content, format="JPEG")
+        compress_pdf.return_value = b"small pdf"
+        attachments = [
+            {"type": "image/jpeg", "disp": "attachment", "filename": "photo.jpg", "content": content.getvalue()},
+            {"type": "image/png", "disp": "inline", "filename": "logo.png", "content": b"not an image"},
+            {"type": "application/pdf", "disp": "attachment", "filename": "letter.pdf", "content": b"big pdf" * 100},
+        ]
+        for dic in attachments:
+            dic["len"] = len(dic["content"])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = TransformCache(tmp_dir)
+            expected = modify_attachments("1", copy.deepcopy(attachments), cache=cache)
+            self.assertEqual(
+                [dic["filename"] for dic in expected], ["photo-(redimensionné).jpg", "letter-(redimensionné).pdf"]
+            )
+            self.assertEqual((cache.hits, cache.misses), (0, 3))
+            # the same attachments in another mail
+            with patch("imio.email.dms.main.transform_image") as transform:
+                self.assertEqual(modify_attachments("2", copy.deepcopy(attachments), cache=cache), expected)
+            transform.assert_not_called()
+            self.assertEqual(compress_pdf.call_count, 1)
+            self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+    def test_modify_attachments_probe(self):
+        def image(size, fmt, **kwargs):
+            content = BytesIO()
+            Image.effect_noise(size, 60).convert("RGB").save(content, format=fmt, **kwargs)
+            return content.getvalue()
+
+        contents = [
+            ("small.jpg", "attachment", image((300, 200), "JPEG")),
+            ("banner.png", "inline", image((1050, 100), "PNG")),
+            ("scan.jpg", "attachment", image((1060, 800), "JPEG", quality=95)),
+        ]
+        attachments = [
+            {"type": "image/" + fn[-3:], "disp": disp, "filename": fn, "len": len(content), "content": content}
+            for fn, disp, content in contents
+        ]
+        self.assertEqual(
+            probe_image(contents[2][2]), {"format": "JPEG", "size": (1060, 800), "orientation": 0, "quality": 95}
+        )
+        self.assertIsNone(probe_image(b"not an image"))
+        log_image_stats()
+        with patch("imio.email.dms.main.transform_image", wraps=transform_image) as transform:
+            new_lst = modify_attachments("1", attachments)
+        # the jpeg image saved with a higher quality is transformed, even if few pixels are removed
+        transform.assert_called_once_with("1", attachments[2], False, None, IMAGE_MAX_TRIALS, IMAGE_MAX_PIXELS)
+        self.assertEqual([dic["filename"] for dic in new_lst], ["small.jpg", "banner.png", "scan-(redimensionné).jpg"])
+        self.assertEqual([dic["content"] for dic in new_lst[:2]], [contents[0][2], contents[1][2]])
+        self.assertTrue(new_lst[1]["is_inline"])
+        with self.assertLogs("imio.email.dms", level="INFO") as logs:
+            log_image_stats()
+        self.assertRegex(
+            logs.output[0],
+            r"Images: 3 probed in [\d.]+s, passed through: 1 unchanged \(33%\), 1 with a negligible gain \(33%\)",
+        )
+
+    def test_encode_image(self):
+        img = Image.effect_noise((800, 600), 60).convert("RGB")
+        content, size = encode_image(img, "JPEG")
+        self.assertEqual(size, (800, 600))
+        # the quality is lowered
+        with patch.object(Image.Image, "save", autospec=True, side_effect=Image.Image.save) as save:
+            small, size = encode_image(img, "JPEG", max_bytes=len(content) * 3 // 4)
+        self.assertLessEqual(len(small), len(content) * 3 // 4)
+        self.assertEqual(size, (800, 600))
+        self.assertLess(save.call_count, IMAGE_MAX_TRIALS)
+        # then the image is reduced, within max_trials encodes
+        with patch.object(Image.Image, "save", autospec=True, side_effect=Image.Image.save) as save:
+            smaller, size = encode_image(img, "JPEG", max_bytes=len(content) // 10, max_trials=4)
+        self.assertLess(size[0], 800)
+        self.assertLess(len(smaller), len(small))
+        self.assertLessEqual(save.call_count, 4)
+        # a png image is reduced
+        content, size = encode_image(img, "PNG", max_bytes=100000)
+        self.assertLessEqual(len(content), 100000)
+        self.assertLess(size[0], 800)
+
+    def test_modify_attachments_budget(self):
+        config = configparser.ConfigParser()
+        config.read_dict({"images": {"mail_max_bytes": "150000", "max_bytes": "100000"}})
+        budget = get_image_budget(config)
+        self.assertEqual(
+            budget, {"image": 100000, "mail": 150000, "trials": IMAGE_MAX_TRIALS, "pixels": IMAGE_MAX_PIXELS}
+        )
+        attachments = []
+        for num, size in enumerate(((900, 600), (600, 400), (200, 100))):
+            content = BytesIO()
+            Image.effect_noise(size, 60).convert("RGB").save(content, format="JPEG")
+            attachments.append(
+                {
+                    "type": "image/jpeg",
+                    "disp": "attachment",
+                    "filename": "{}.jpg".format(num),
+                    "len": len(content.getvalue()),
+                    "content": content.getvalue(),
+                }
+            )
+        new_lst = modify_attachments("1", copy.deepcopy(attachments), budget=budget)
+        self.assertLessEqual(sum(dic["len"] for dic in new_lst), 150000)
+        self.assertLessEqual(new_lst[0]["len"], 100000)
+        self.assertEqual([dic.get("modified") for dic in new_lst], [True, True, True])
+        self.assertEqual(get_image_budget(configparser.ConfigParser())["image"], 0)
+
+    def test_transform_image_pixels(self):
+        content = BytesIO()
+        Image.new("RGB", (4000, 3000), "white").save(content, format="JPEG")
+        dic = {"filename": "scan.jpg", "len": len(content.getvalue()), "content": content.getvalue()}
+        # decoded at 1/4 scale: 1000x750 pixels
+        self.assertEqual(transform_image("1", dict(dic), True, max_pixels=1000000)["size"], (1000, 750))
+        with self.assertLogs("imio.email.dms", level="WARNING") as logs:
+            self.assertEqual(transform_image("1", dict(dic), True, max_pixels=500000)["content"], dic["content"])
+        self.assertIn("image 'scan.jpg' of 1000x750 pixels is over the pixel budget", logs.output[0])
+
+    @unittest.skipUnless(os.path.exists("/proc/self/clear_refs"), "peak memory is read in /proc")
+    def test_modify_attachments_huge_image(self):
+        # 400 MB once decoded
+        content = huge_png(20000, 20000)
+        config = configparser.ConfigParser()
+        config.read_dict({"images": {"max_memory": "100"}})
+        budget = get_image_budget(config)
+        self.assertEqual(budget["pixels"], 25000000)
+        attachments = [{"type": "image/png", "disp": "attachment", "filename": "scan.png", "len": len(content)}]
+        attachments[0]["content"] = content
+        pool = ProcessPool(1)
+        try:
+            args = (modify_attachments, "1", copy.deepcopy(attachments), True, None, None, budget)
+            new_lst, peak = next(pool.map(peak_memory, [args]))
+            self.assertEqual(new_lst[0]["content"], content)
+            self.assertLess(peak, 50)
+            # without the header probe
+            args = (transform_image, "1", copy.deepcopy(attachments[0]), False, None, 6, budget["pixels"])
+            dic, peak = next(pool.map(peak_memory, [args]))
+            self.assertEqual(dic["content"], content)
+            self.assertLess(peak, 50)
+        finally:
+            pool.shutdown()
+
+    def test_transform_image_draft(self):
+        img = Image.effect_noise((2400, 1600), 60).convert("RGB")
+        exif = Image.Exif()
+        exif[0x0112] = 6  # rotated of 90°
+        content = BytesIO()
+        img.save(content, format="JPEG", exif=exif)
+        dic = {"filename": "photo.jpg", "len": len(content.getvalue()), "content": content.getvalue()}
+        draft = JpegImagePlugin.JpegImageFile.draft
+        with patch.object(JpegImagePlugin.JpegImageFile, "draft", autospec=True, side_effect=draft) as mock_draft:
+            dic = transform_image("1", dic, False)
+        # decoded at half scale, then resized and reoriented
+        mock_draft.assert_called_once_with(ANY, "RGB", (1024, 682))
+        self.assertEqual(Image.open(BytesIO(dic["content"])).size, (682, 1024))
+        self.assertEqual(dic["size"], (682, 1024))
+
     def test_compress_pdf(self):
         pdf_file = os.path.join(TEST_FILES_PATH, "pdf-example-bookmarks-1-2.pdf")
         with open(pdf_file, "rb") as pdf:
@@ -228,12 +512,14 @@ class TestMain(unittest.TestCase):
             with patch("imio.email.dms.main.IMAPEmailHandler") as MockIMAPEmailHandler:
                 with self.assertRaises(SystemExit) as cm:
                     mock_handler = MockIMAPEmailHandler.return_value
-                    mock_handler.get_waiting_emails.return_value = [
-                        MailData("01", get_eml_message("01_email_with_inline_and_annexes.eml")),
-                        MailData("02", get_eml_message("02_email_with_inline_annex_eml.eml")),
-                        MailData("03", get_eml_message("03_email_with_false_inline.eml")),
-                        MailData("04", get_eml_message("04_email_with_pdf_attachment.eml")),
-                    ]
+                    mock_handler.iter_waiting_emails.return_value = iter(
+                        [
+                            MailData("01", get_eml_message("01_email_with_inline_and_annexes.eml")),
+                            MailData("02", get_eml_message("02_email_with_inline_annex_eml.eml")),
+                            MailData("03", get_eml_message("03_email_with_false_inline.eml")),
+                            MailData("04", get_eml_message("04_email_with_pdf_attachment.eml")),
+                        ]
+                    )
                     process_mails()
 
         self.assertIsNone(cm.exception.code)
@@ -277,29 +563,456 @@ class TestMain(unittest.TestCase):
                 ],
             )
 
+    @patch("imio.email.dms.main.sleep")
+    @patch("imio.email.dms.main.treat_emails")
+    def test_run_daemon(self, treat_emails, mock_sleep):
+        config = configparser.ConfigParser()
+        config.read("../../config.ini")
+        handler = MagicMock()
+        handler.wait_for_changes.side_effect = [True, imaplib.IMAP4.abort("connection lost"), SystemExit()]
+        # the lost connection can't be logged out
+        handler.disconnect.side_effect = [imaplib.IMAP4.abort("socket error"), None]
+        mailbox_infos = ("localhost", 143, False, "login", "pass")
+        with self.assertRaises(SystemExit):  # raised by the stop signal handler
+            run_daemon(config, handler, mailbox_infos)
+        self.assertEqual(treat_emails.call_count, 3)
+        handler.connect.assert_called_once_with(*mailbox_infos)
+        mock_sleep.assert_called_once_with(60)
+        # the lost connection is closed before reconnecting
+        self.assertEqual(
+            [name for name, args, kwargs in handler.mock_calls if "connect" in name or "shutdown" in name],
+            ["disconnect", "connection.shutdown", "connect", "disconnect"],
+        )
+
     @patch("imio.email.dms.main.dev_mode", True)
     def test_clean_mails_help(self):
         with self.assertRaises(SystemExit):
             docopt(clean_mails.__doc__, argv=["--help"])
 
-    @patch("imio.email.dms.main.dev_mode", True)
+    @patch("imio.email.dms.main.notify_error")
+    @patch("imio.email.dms.main.upload_package")
+    @patch("imio.email.dms.main.package_mail")
+    @patch("imio.email.dms.main.render_pdf")
+    @patch("imio.email.dms.main.transform_mail")
+    @patch("imio.email.dms.main.check_mail")
+    @patch("imio.email.parser.parser.Parser")
+    def test_treat_emails_workers(
+        self, MockParser, check_mail, transform_mail, render_pdf, package_mail, upload, notify
+    ):
+        config = configparser.ConfigParser()
+        config.read("../../config.ini")
+        check_mail.side_effect = (
+            lambda config, mail_id, mail, parser, size=None: mail_id in ("2", "5") and "ignored" or None
+        )
+
+        def transform(mail_id, parser, pool=None, cache=None, budget=None):
+            # first mails are the slowest to transform
+            time.sleep(0.05 / int(mail_id))
+            return [], None
+
+        def upload_package(config, tar_path, mail_id, job=None):
+            if mail_id == "3":
+                raise ValueError("upload error")
+
+        transform_mail.side_effect = transform
+        upload.side_effect = upload_package
+        handler = MagicMock()
+        emails = [MailData(str(i), None) for i in range(1, 8)]
+        emails[5].partial = True
+        with self.assertLogs("imio.email.dms", level="INFO") as logs:
+            self.assertEqual(treat_emails(config, handler, emails=emails, workers=3), 7)
+        # uploads are sequential, in fetching order
+        self.assertEqual([c[0][2] for c in upload.call_args_list], ["1", "3", "4", "6", "7"])
+        handler.get_mail.assert_called_once_with("6", size=None)
+        self.assertEqual(notify.call_count, 1)
+        self.assertEqual(
+            handler.queue_mark.call_args_list,
+            [
+                call("1", "imported"),
+                call("2", "ignored"),
+                call("3", "error"),
+                call("4", "imported"),
+                call("5", "ignored"),
+                call("6", "imported"),
+                call("7", "imported"),
+            ],
+        )
+        handler.flush_marks.assert_called_once_with()
+        # the sync state is saved once the flags of all the emails are stored
+        handler.end_sync.assert_called_once_with(handler.flush_marks.return_value)
+        self.assertEqual(
+            [name for name, args, kwargs in handler.mock_calls][-3:], ["queue_mark", "flush_marks", "end_sync"]
+        )
+        self.assertIn("Treated 7 emails: 4 imported. 0 unsupported. 1 in error. 2 ignored.", logs.output[-1])
+        self.assertTrue(any("Stage render: 7 jobs, 3 threads" in line for line in logs.output))
+
+    @patch("imio.email.dms.main.post_with_retries")
+    @patch("imio.email.dms.main.package_mail")
+    @patch("imio.email.dms.main.render_pdf")
+    @patch("imio.email.dms.main.transform_mail")
+    @patch("imio.email.dms.main.check_mail")
+    @patch("imio.email.parser.parser.Parser")
+    def test_treat_emails_journal(self, MockParser, check_mail, transform_mail, render_pdf, package_mail, post):
+        config = configparser.ConfigParser()
+        config.read("../../config.ini")
+        config.remove_section("pipeline")
+        check_mail.return_value = None
+        transform_mail.return_value = ([], None)
+        render_pdf.return_value = "/tmp/3.pdf"
+        post.side_effect = lambda url, auth, action, mail_id, **kwargs: {"success": True, "id": 33}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config["webservice"]["counter_dir"] = tmp_dir
+            emails = []
+            for uid in ("1", "2", "3"):
+                mail = email.message_from_string("Message-ID: <{}@mail.be>\n\nbody\n".format(uid))
+                emails.append(MailData(uid, mail))
+            tar_paths = [Path(tmp_dir) / "01Z999900000002.tar", Path(tmp_dir) / "mail_3.tar"]
+            for tar_path in tar_paths:
+                tar_path.write_bytes(b"tar")
+            package_mail.return_value = tar_paths[1]
+            # the previous run was killed after the upload of the first email and the metadata of the second one
+            journal = Journal(os.path.join(tmp_dir, "journal.log"))
+            journal.record(emails[0], "uploaded", next_id=1, client_id="01Z9999", external_id="01Z999900000001")
+            journal.record(
+                emails[1],
+                "metadata_posted",
+                next_id=2,
+                client_id="01Z9999",
+                external_id="01Z999900000002",
+                response_id=22,
+                tar_path=str(tar_paths[0]),
+            )
+            handler = MagicMock()
+            with patch("imio.email.dms.main.get_tar_path", return_value=tar_paths[1]):
+                self.assertEqual(treat_emails(config, handler, emails=emails, journal=journal), 3)
+            # only the file of the second email and the third email are sent
+            self.assertEqual(
+                [(c[0][2], c[0][3]) for c in post.call_args_list],
+                [("upload file", "2"), ("post metadata", "3"), ("upload file", "3")],
+            )
+            self.assertIn("/file_upload/1.3/22", post.call_args_list[0][0][0])
+            transform_mail.assert_called_once()
+            self.assertEqual(post.call_args_list[1][1]["json_data"]["external_id"], "01Z999900000003")
+            self.assertEqual(handler.queue_mark.call_args_list, [call(uid, "imported") for uid in ("1", "2", "3")])
+            self.assertEqual(journal.entries, {})
+            journal.close()
+
+    @patch("imio.email.dms.main.notify_error")
+    @patch("imio.email.dms.main.post_with_retries")
+    @patch("imio.email.dms.main.package_mail")
+    @patch("imio.email.dms.main.render_pdf")
+    @patch("imio.email.dms.main.transform_mail")
+    @patch("imio.email.dms.main.check_mail")
+    @patch("imio.email.parser.parser.Parser")
+    def test_treat_emails_journal_tar(
+        self, MockParser, check_mail, transform_mail, render_pdf, package_mail, post, notify
+    ):
+        config = configparser.ConfigParser()
+        config.read("../../config.ini")
+        config.remove_section("pipeline")
+        check_mail.return_value = None
+        transform_mail.return_value = ([], None)
+        render_pdf.return_value = "/tmp/1.pdf"
+        responses = {"post metadata": {"success": True, "id": 11}, "upload file": {"success": False, "error_code": 500}}
+        responses["upload file"]["message"] = "upload error"
+        post.side_effect = lambda url, auth, action, mail_id, **kwargs: responses[action]
+        mail = MailData("1", email.message_from_string("Message-ID: <1@mail.be>\n\nbody\n"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config["webservice"]["counter_dir"] = tmp_dir
+            tmp_path = Path(tmp_dir) / "tmp"
+            tmp_path.mkdir()
+
+            def package(headers, main_file_path, attachments, mail_id):
+                (tmp_path / "mail_1.tar").write_bytes(b"tar")
+                return tmp_path / "mail_1.tar"
+
+            package_mail.side_effect = package
+            journal = Journal(os.path.join(tmp_dir, "journal.log"))
+            with patch("imio.email.dms.main.get_tar_path", return_value=tmp_path / "mail_1.tar"):
+                treat_emails(config, MagicMock(), emails=[mail], journal=journal)
+                # the tar file of the posted metadata is kept next to the journal until it's uploaded
+                tar_path = Path(tmp_dir) / "01Z999900000001.tar"
+                self.assertEqual(journal.get(mail)["tar_path"], str(tar_path))
+                self.assertTrue(tar_path.exists())
+                # requeued: only the file is uploaded
+                responses["upload file"] = {"success": True}
+                post.reset_mock()
+                treat_emails(config, MagicMock(), emails=[mail], journal=journal)
+                self.assertEqual([c[0][2] for c in post.call_args_list], ["upload file"])
+                self.assertIn("/file_upload/1.3/11", post.call_args[0][0])
+                self.assertFalse(tar_path.exists())
+                self.assertTrue((tmp_path / "01Z999900000001.tar").exists())
+                self.assertEqual(package_mail.call_count, 1)
+                # the tar file is lost: it's rebuilt and its metadata are posted again
+                post.reset_mock()
+                journal.record(mail, "metadata_posted", next_id=2, client_id="01Z9999", response_id=12, tar_path="/x")
+                treat_emails(config, MagicMock(), emails=[mail], journal=journal)
+                self.assertEqual([c[0][2] for c in post.call_args_list], ["post metadata", "upload file"])
+                self.assertEqual(post.call_args_list[0][1]["json_data"]["external_id"], "01Z999900000002")
+            journal.close()
+
+    @patch("imio.email.dms.main.notify_error")
+    @patch("imio.email.dms.main.post_with_retries")
+    @patch("imio.email.dms.main.package_mail")
+    @patch("imio.email.dms.main.render_pdf")
+    @patch("imio.email.dms.main.transform_mail")
+    @patch("imio.email.dms.main.check_mail")
+    @patch("imio.email.parser.parser.Parser")
+    def test_treat_emails_journal_upload_error(
+        self, MockParser, check_mail, transform_mail, render_pdf, package_mail, post, notify
+    ):
+        config = configparser.ConfigParser()
+        config.read("../../config.ini")
+        check_mail.return_value = None
+        transform_mail.return_value = ([], None)
+        render_pdf.return_value = "/tmp/1.pdf"
+        uploaded = {"1": {"success": False, "error_code": 500, "message": "upload error"}, "2": {"success": True}}
+
+        def post_side_effect(url, auth, action, mail_id, **kwargs):
+            if action == "post metadata":
+                return {"success": True, "id": 10 + int(mail_id)}
+            return uploaded[mail_id]
+
+        post.side_effect = post_side_effect
+        mail1 = MailData("1", email.message_from_string("Message-ID: <1@mail.be>\n\nbody 1\n"))
+        mail2 = MailData("2", email.message_from_string("Message-ID: <2@mail.be>\n\nbody 2\n"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config["webservice"]["counter_dir"] = tmp_dir
+            tmp_path = Path(tmp_dir) / "tmp"
+            tmp_path.mkdir()
+
+            def package(headers, main_file_path, attachments, mail_id):
+                tar_path = tmp_path / "mail_{}.tar".format(mail_id)
+                tar_path.write_bytes("tar {}".format(mail_id).encode())
+                return tar_path
+
+            package_mail.side_effect = package
+            journal = Journal(os.path.join(tmp_dir, "journal.log"))
+            with patch("imio.email.dms.main.get_tar_path", side_effect=lambda mail_id: tmp_path / "mail.tar"):
+                # the metadata are posted, but the upload fails: the external id is used up
+                treat_emails(config, MagicMock(), emails=[mail1], journal=journal)
+                self.assertEqual(get_next_id(config, {"nid": None})[0], 2)
+                # the next email gets the next external id
+                treat_emails(config, MagicMock(), emails=[mail2], journal=journal)
+                self.assertEqual(post.call_args_list[2][1]["json_data"]["external_id"], "01Z999900000002")
+                self.assertEqual((Path(tmp_dir) / "01Z999900000001.tar").read_bytes(), b"tar 1")
+                # requeued: the file is uploaded with its first external id and the counter isn't lowered
+                uploaded["1"] = {"success": True}
+                post.reset_mock()
+                treat_emails(config, MagicMock(), emails=[mail1], journal=journal)
+                self.assertEqual([c[0][2] for c in post.call_args_list], ["upload file"])
+                self.assertIn("/file_upload/1.3/11", post.call_args[0][0])
+                self.assertEqual(post.call_args[1]["files"]["filedata"][1], b"tar 1")
+                self.assertEqual(get_next_id(config, {"nid": None})[0], 3)
+            self.assertEqual(journal.entries, {})
+            journal.close()
+
+    @patch("imio.email.dms.main.upload_package")
+    @patch("imio.email.dms.main.package_mail")
+    @patch("imio.email.dms.main.render_pdf")
+    @patch("imio.email.dms.main.transform_mail")
+    @patch("imio.email.dms.main.check_mail")
+    @patch("imio.email.parser.parser.Parser")
+    def test_treat_emails_work_cache(self, MockParser, check_mail, transform_mail, render_pdf, package_mail, upload):
+        config = configparser.ConfigParser()
+        config.read("../../config.ini")
+        config.remove_section("pipeline")
+        check_mail.return_value = None
+        transform_mail.return_value = ([{"content": b"image"}], None)
+        mail = email.message_from_string("Message-ID: <1@mail.be>\n\nbody\n")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config["work_cache"] = {"dir": os.path.join(tmp_dir, "cache")}
+            pdf_path = Path(tmp_dir) / "1.pdf"
+            pdf_path.write_bytes(b"pdf")
+            render_pdf.return_value = str(pdf_path)
+
+            def package(headers, main_file_path, attachments, mail_id):
+                tar_path = Path(tmp_dir) / "mail_1.tar"
+                tar_path.write_bytes(b"tar")
+                return tar_path
+
+            package_mail.side_effect = package
+            upload.side_effect = ValueError("upload error")
+            handler = MagicMock()
+            with patch("imio.email.dms.main.notify_error"):
+                treat_emails(config, handler, emails=[MailData("1", mail)])
+            handler.queue_mark.assert_called_once_with("1", "error")
+            # the email is requeued: only the upload is done again
+            upload.side_effect = None
+            handler.reset_mock()
+            with patch("imio.email.dms.main.get_tar_path", return_value=Path(tmp_dir) / "mail_1_retry.tar"):
+                treat_emails(config, handler, emails=[MailData("1", mail)])
+            handler.queue_mark.assert_called_once_with("1", "imported")
+            self.assertEqual(transform_mail.call_count, 1)
+            self.assertEqual(render_pdf.call_count, 1)
+            self.assertEqual(package_mail.call_count, 1)
+            self.assertEqual(upload.call_args[0][1].read_bytes(), b"tar")
+            # the entry is dropped once the email is imported
+            self.assertEqual(os.listdir(os.path.join(tmp_dir, "cache")), [])
+
+    @patch("imio.email.dms.main.upload_package")
+    @patch("imio.email.dms.main.package_mail")
+    @patch("imio.email.dms.main.render_pdf")
+    @patch("imio.email.dms.main.transform_mail")
+    @patch("imio.email.dms.main.check_mail")
+    @patch("imio.email.parser.parser.Parser")
+    def test_treat_emails_duplicates(self, MockParser, check_mail, transform_mail, render_pdf, package_mail, upload):
+        config = configparser.ConfigParser()
+        config.read("../../config.ini")
+        MockParser.side_effect = lambda mail, dev_mode, mail_id: MagicMock(message=mail)
+        check_mail.return_value = None
+        transform_mail.return_value = ([], None)
+        render_pdf.return_value = "/tmp/1.pdf"
+        emails = [
+            MailData("1", email.message_from_string("Message-ID: <1@mail.be>\n\nbody\n")),
+            MailData("2", email.message_from_string("Message-ID: <2@mail.be>\n\nbody\n")),
+            # forwarded again
+            MailData("3", email.message_from_string("Message-ID: <1@mail.be>\n\nbody\n")),
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config["webservice"]["counter_dir"] = tmp_dir
+            handler = MagicMock()
+            with self.assertLogs("imio.email.dms", level="INFO") as logs:
+                self.assertEqual(treat_emails(config, handler, emails=emails, workers=2), 3)
+            self.assertEqual(
+                handler.queue_mark.call_args_list,
+                [call("1", "imported"), call("2", "imported"), call("3", "duplicate")],
+            )
+            self.assertIn("3: duplicate of email 1", "\n".join(logs.output))
+            self.assertIn("3 emails: 2 imported. 0 unsupported. 0 in error. 0 ignored. 1 duplicates.", logs.output[-1])
+            # the index is kept for the next runs
+            handler.reset_mock()
+            treat_emails(config, handler, emails=emails[2:])
+            handler.queue_mark.assert_called_once_with("3", "duplicate")
+            # requeued: its fingerprint is forgotten, so that it's imported
+            config_path = os.path.join(tmp_dir, "config.ini")
+            with open(config_path, "w") as config_file:
+                config.write(config_file)
+            with (
+                patch("sys.argv", ["main.py", config_path, "--reset_flags=3"]),
+                patch("imio.email.dms.main.IMAPEmailHandler") as MockIMAPEmailHandler,
+                self.assertRaises(SystemExit),
+            ):
+                process_mails()
+            MockIMAPEmailHandler.return_value.mark_reset_all.assert_called_once_with("3")
+            handler.reset_mock()
+            treat_emails(config, handler, emails=emails[2:])
+            handler.queue_mark.assert_called_once_with("3", "imported")
+
+    @patch("imio.email.dms.main.notify_error")
+    @patch("imio.email.dms.main.upload_package")
+    @patch("imio.email.dms.main.package_mail")
+    @patch("imio.email.dms.main.render_pdf")
+    @patch("imio.email.dms.main.transform_mail")
+    @patch("imio.email.dms.main.check_mail")
+    @patch("imio.email.parser.parser.Parser")
+    def test_treat_emails_duplicates_skeleton(
+        self, MockParser, check_mail, transform_mail, render_pdf, package_mail, upload, notify
+    ):
+        config = configparser.ConfigParser()
+        config.read("../../config.ini")
+        MockParser.side_effect = lambda mail, dev_mode, mail_id: MagicMock(message=mail)
+        check_mail.return_value = None
+        transform_mail.return_value = ([], None)
+        render_pdf.return_value = "/tmp/1.pdf"
+        upload.side_effect = lambda config, tar_path, mail_id, job=None: mail_id == "1" and 1 / 0
+        # two big emails with the same skeleton: their attachments differ
+        skeleton = "Message-ID: <1@mail.be>\n\nbody\n"
+        handler = MagicMock()
+        handler.get_mail.side_effect = lambda mail_id, size=None: email.message_from_string(
+            "Message-ID: <1@mail.be>\n\nbody {}\n".format(mail_id)
+        )
+        emails = [MailData(uid, email.message_from_string(skeleton), size=10000000, partial=True) for uid in "12"]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config["webservice"]["counter_dir"] = tmp_dir
+            self.assertEqual(treat_emails(config, handler, emails=emails), 2)
+            # only the whole emails are fingerprinted
+            self.assertEqual(handler.queue_mark.call_args_list, [call("1", "error"), call("2", "imported")])
+            self.assertEqual(get_fingerprint_index(config).pending, {})
+
+    @patch("imio.email.dms.main.upload_mail")
+    @patch("imio.email.dms.main.prepare_mail")
+    def test_treat_emails_async(self, prepare_mail, upload_mail):
+        config = configparser.ConfigParser()
+        config.read("../../config.ini")
+        second_rendering = threading.Event()
+
+        def prepare(config, mail_info, journal=None, get_mail=None):
+            if mail_info.partial:
+                # the whole email is fetched from the rendering thread
+                mail_info = MailData(mail_info.id, get_mail(mail_info.id, size=mail_info.size))
+                self.assertEqual(mail_info.mail.get_payload().strip(), "x" * 2000)
+            if mail_info.mail["Subject"] == "ignored":
+                return "ignored", None
+            if mail_info.id == b"3":
+                second_rendering.set()
+            return None, (mail_info.mail["Subject"], "/tmp/{}.pdf".format(mail_info.id), [])
+
+        def upload(config, mail_info, rendered):
+            # the next mail is rendered while this one is uploaded
+            self.assertTrue(mail_info.id != b"1" or second_rendering.wait(5))
+            return rendered[0] == "error" and "error" or "imported"
+
+        prepare_mail.side_effect = prepare
+        upload_mail.side_effect = upload
+        server = FakeIMAPServer()
+        for subject in ("first", "ignored", "second", "error"):
+            server.append("Subject: {}\r\n\r\nbody\r\n".format(subject).encode())
+        server.append(b"Subject: big\r\nContent-Type: application/pdf\r\n\r\n" + b"x" * 2000 + b"\r\n")
+
+        async def run():
+            await server.start()
+            handler = AsyncIMAPEmailHandler()
+            await handler.connect("127.0.0.1", server.port, False, "login", "pass")
+            try:
+                return await treat_emails_async(config, handler)
+            finally:
+                await handler.disconnect()
+                await server.stop()
+
+        with patch("imio.email.dms.main.MAX_SIZE_ATTACH", 1000):
+            self.assertEqual(asyncio.run(run()), 5)
+        # the skeleton of the big email is fetched first
+        self.assertEqual([call[0][1].id for call in upload_mail.call_args_list], [b"5", b"1", b"3", b"4"])
+        self.assertEqual(
+            {uid: flags for uid, (raw, flags) in server.mails.items()},
+            {1: {b"imported"}, 2: {b"ignored"}, 3: {b"imported"}, 4: {b"error"}, 5: {b"imported"}},
+        )
+
     def test_clean_mails_list_only(self):
-        emails = {
-            "01": get_eml_message("01_email_with_inline_and_annexes.eml"),
-            "02": get_eml_message("02_email_with_inline_annex_eml.eml"),
-            "03": get_eml_message("03_email_with_false_inline.eml"),
-            "04": get_eml_message("04_email_with_pdf_attachment.eml"),
-        }
         with (
             patch("sys.argv", ["main.py", "../../config.ini", "--list_only"]),
             patch("imio.email.dms.main.IMAPEmailHandler") as MockIMAPEmailHandler,
-            self.assertRaises(SystemExit) as cm,
+            patch("imio.email.dms.main.Notify.result") as mock_result,
+            self.assertRaises(SystemExit),
+        ):
+            mock_handler = MockIMAPEmailHandler.return_value
+            mock_handler.search.side_effect = lambda criteria: (
+                [b"03", b"04"] if "KEYWORD imported" in criteria else [b"01", b"02", b"03", b"04"]
+            )
+            mock_handler.get_subjects.return_value = {3: "Subject 3"}
+            clean_mails()
+        mock_handler.get_subjects.assert_called_once_with([b"03", b"04"])
+        mock_handler.delete_mails.assert_not_called()
+        message = mock_result.call_args[0][1]
+        self.assertIn("03: 'Subject 3'", message)
+        self.assertIn("1 emails have been deleted. 2 emails are ignored. 1 emails have caused an error.", message)
+
+    def test_clean_mails(self):
+        with (
+            patch("sys.argv", ["main.py", "../../config.ini", "--ignored_too"]),
+            patch("imio.email.dms.main.IMAPEmailHandler") as MockIMAPEmailHandler,
+            patch("imio.email.dms.main.Notify.result") as mock_result,
+            self.assertRaises(SystemExit),
         ):
             mock_handler = MockIMAPEmailHandler.return_value
-            mock_handler.connection.search.return_value = ("OK", ["01 02 03 04"])
-            mock_handler.connection.fetch.return_value = ("OK", [b""])
-            mock_handler.get_email.side_effect = lambda x: emails[x]
+            mock_handler.search.return_value = [b"01", b"02"]
+            mock_handler.get_subjects.return_value = {1: "Subject 1", 2: "Subject 2"}
+            mock_handler.delete_mails.return_value = True
             clean_mails()
+        mock_handler.search.assert_called_once()
+        mock_handler.delete_mails.assert_called_once_with([b"01", b"02"])
+        self.assertIn("2 emails have been deleted. 0 emails are ignored.", mock_result.call_args[0][1])
 
     @patch("imio.email.dms.main.Notify._send")
     def test_notify_exception(self, notify_send):
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures.process import BrokenProcessPool
+from imio.email.dms.pipeline import Pipeline
+from imio.email.dms.pipeline import ProcessPool
+from imio.email.dms.pipeline import Stage
+
+import os
+import threading
+import time
+import unittest
+
+
+class Job(object):
+    def __init__(self, num):
+        self.num = num
+        self.steps = []
+
+
+class TestPipeline(unittest.TestCase):
+    def test_pipeline(self):
+        lock = threading.Lock()
+        in_progress = []
+
+        def slow(job):
+            with lock:
+                in_progress.append(job.num)
+            # first jobs are the slowest
+            time.sleep(0.02 / (job.num + 1))
+            job.steps.append("slow")
+
+        def ordered(job):
+            job.steps.append("ordered")
+            with lock:
+                in_progress.remove(job.num)
+
+        stages = [Stage("slow", slow, concurrency=3, queue_size=1), Stage("ordered", ordered, ordered=True)]
+        pipeline = Pipeline(stages)
+        self.assertEqual(pipeline.max_jobs, 7)
+        pipeline.start()
+        finished = []
+        max_in_progress = 0
+        for num in range(20):
+            finished.extend(pipeline.put(Job(num)))
+            max_in_progress = max(max_in_progress, pipeline.pending)
+        pipeline.close()
+        finished.extend(pipeline.results(wait=True))
+        # jobs leave the ordered stage in the putting order
+        self.assertEqual([job.num for job in finished], list(range(20)))
+        self.assertTrue(all(job.steps == ["slow", "ordered"] for job in finished))
+        self.assertLessEqual(max_in_progress, 7)
+        for thread in pipeline.threads:
+            thread.join(1)
+            self.assertFalse(thread.is_alive())
+        report = pipeline.report()
+        self.assertTrue(report[0].startswith("Stage slow: 20 jobs, 3 threads, busy "), report[0])
+        self.assertTrue(report[1].startswith("Stage ordered: 20 jobs, 1 threads, busy "), report[1])
+
+    def test_stage_error(self):
+        def failing(job):
+            raise ValueError("error")
+
+        pipeline = Pipeline([Stage("failing", failing)])
+        pipeline.start()
+        with self.assertLogs("imio.email.dms", level="ERROR"):
+            pipeline.put(Job(1))
+            pipeline.close()
+            self.assertEqual(len(list(pipeline.results(wait=True))), 1)
+
+    def test_ordered_stage(self):
+        with self.assertRaises(ValueError):
+            Stage("ordered", None, concurrency=2, ordered=True)
+
+    def test_process_pool(self):
+        pool = ProcessPool(2, per_job=3)
+        try:
+            self.assertEqual(list(pool.map(pow, [(2, num) for num in range(10)])), [2**num for num in range(10)])
+            executor = pool.executor
+            self.assertEqual(list(pool.map(pow, [(3, 2)])), [9])
+            self.assertIs(pool.executor, executor)
+            # a crashed process
+            with self.assertRaises(BrokenProcessPool):
+                list(pool.map(os._exit, [(1,)]))
+            self.assertIsNone(pool.executor)
+            self.assertEqual(list(pool.map(pow, [(3, 2)])), [9])
+        finally:
+            pool.shutdown()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from imio.email.dms.tests.imap_server import FakeIMAPServer
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+
+# command paths of the console scripts of setup.py, which don't need the mail parsing and rendering stack
+COMMANDS = {
+    "stats": ("process_mails", ["--stats"]),
+    "requeue_errors": ("process_mails", ["--requeue_errors"]),
+    "reset_flags": ("process_mails", ["--reset_flags=3"]),
+    "list_emails": ("process_mails", ["--list_emails=1"]),
+    "clean_mails": ("clean_mails", ["--kept_days=0"]),
+}
+# modules loaded only by the code paths using them
+HEAVY_MODULES = ("asyncio", "bs4", "chardet", "email2pdf2", "imio.email.parser.parser", "mailparser", "PIL", "requests")
+
+CONFIG = """
+[mailbox]
+host = 127.0.0.1
+port = {port}
+ssl = false
+login = login
+pass = pass
+
+[mailinfos]
+sender-pattern = .+
+
+[webservice]
+client_id = 019999
+counter_dir = {counter_dir}
+
+[smtp]
+host = localhost
+port = 25
+sender = sender@mail.be
+recipient = recipient@mail.be
+"""
+
+FORWARD = (
+    b"Date: Mon, 12 Oct 2026 10:00:00 +0200\r\n"
+    b"From: Agent <agent@mail.be>\r\n"
+    b"Subject: Fwd: request\r\n"
+    b'Content-Type: multipart/mixed; boundary="limit"\r\n'
+    b"\r\n"
+    b"--limit\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"\r\n"
+    b"see attached\r\n"
+    b"--limit\r\n"
+    b"Content-Type: message/rfc822\r\n"
+    b"\r\n"
+    b"From: Citizen <citizen@mail.be>\r\n"
+    b"Subject: request\r\n"
+    b"\r\n"
+    b"body\r\n"
+    b"--limit--\r\n"
+)
+
+# unittest.mock imports asyncio: the SMTP and HTTP calls are replaced by plain functions
+SCRIPT = """
+import json
+import sys
+from imio.email.dms import main
+
+sent = []
+main.SMTP = lambda host, port: type("SMTP", (), {{"send_message": sent.append, "quit": lambda self: None}})()
+main.post_with_retries = lambda *args, **kwargs: sys.exit("HTTP call")
+sys.argv = ["{func}", "{config}"] + {args!r}
+try:
+    main.{func}()
+except SystemExit as error:
+    if error.code:
+        raise
+print(json.dumps({{"loaded": sorted(name for name in {heavy!r} if name in sys.modules), "sent": len(sent)}}))
+"""
+
+
+def run_command(func, args, config):
+    """Run a console script function in a new interpreter.
+
+    :return: dict with the list of loaded heavy modules ("loaded") and the number of emails sent ("sent")
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(func=func, config=config, args=args, heavy=HEAVY_MODULES)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        # same import path, but not the working directory, where the email package would shadow the stdlib one
+        cwd=tempfile.gettempdir(),
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path)),
+    )
+    if result.returncode:
+        raise AssertionError(result.stderr)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+class TestStartup(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeIMAPServer()
+        self.server.append(b"Subject: imported\r\n\r\nbody\r\n", flags=[b"imported"])
+        self.server.append(b"Subject: error\r\n\r\nbody\r\n", flags=[b"error"])
+        # a forward with the original email attached: listed from its ENVELOPE and BODYSTRUCTURE
+        self.server.append(FORWARD, flags=[b"ignored", b"duplicate"])
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result(5)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = os.path.join(self.tmp_dir.name, "config.ini")
+        with open(self.config, "w") as config:
+            config.write(CONFIG.format(port=self.server.port, counter_dir=self.tmp_dir.name))
+
+    def tearDown(self):
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.tmp_dir.cleanup()
+
+    def test_commands(self):
+        sent = {}
+        for name, (func, args) in COMMANDS.items():
+            with self.subTest(command=name):
+                result = run_command(func, args, self.config)
+                self.assertEqual(result["loaded"], [])
+                sent[name] = result["sent"]
+        # the commands did their job against the server
+        self.assertIn(b"UID FETCH 1:* (FLAGS)", self.server.commands)
+        self.assertIn(b"UID FETCH 3 (UID FLAGS INTERNALDATE ENVELOPE BODYSTRUCTURE)", self.server.commands)
+        self.assertNotIn(b"UID FETCH 3 (RFC822)", self.server.commands)
+        self.assertEqual({uid: flags for uid, (raw, flags) in self.server.mails.items()}, {2: {b"waiting"}, 3: set()})
+        self.assertEqual(sent, {"stats": 0, "requeue_errors": 0, "reset_flags": 0, "list_emails": 0, "clean_mails": 1})
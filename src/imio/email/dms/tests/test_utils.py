@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from imio.email.dms.utils import estimate_jpeg_quality
 from imio.email.dms.utils import get_next_id
 from imio.email.dms.utils import get_reduced_size
 from imio.email.dms.utils import reception_date
@@ -8,7 +9,9 @@ from imio.email.dms.utils import save_attachment
 from imio.email.dms.utils import set_next_id
 from imio.email.parser.parser import Parser
 from imio.email.parser.tests.test_parser import get_eml_message
+from io import BytesIO
 from pathlib import Path
+from PIL import Image
 from unittest.mock import patch
 
 import configparser
@@ -55,20 +58,32 @@ class TestUtils(unittest.TestCase):
         self.assertTupleEqual((True, (400, 333)), get_reduced_size((600, 500), (400, None)))
         self.assertTupleEqual((True, (300, 400)), get_reduced_size((600, 800), (None, 400)))
 
+    def test_estimate_jpeg_quality(self):
+        for quality in (30, 75, 95):
+            content = BytesIO()
+            Image.new("RGB", (8, 8)).save(content, format="JPEG", quality=quality)
+            img = Image.open(content)
+            self.assertEqual(estimate_jpeg_quality(img.quantization[0]), quality)
+
     def test_next_id(self):
         config = configparser.ConfigParser()
         config.read("../../config.ini")
 
+        counter_path = Path(config["webservice"]["counter_dir"]) / "01Z9999"
         devinfos = {"nid": None}
         with patch("imio.email.dms.utils.dev_mode", True):
-            set_next_id(config, 0)
+            counter_path.unlink(missing_ok=True)
             self.assertTupleEqual((1, "01Z9999"), get_next_id(config, devinfos))
             self.assertTupleEqual((2, "01Z9999"), get_next_id(config, devinfos))
             self.assertTupleEqual((3, "01Z9999"), get_next_id(config, devinfos))
 
         devinfos = {"nid": None}
         with patch("imio.email.dms.utils.dev_mode", False):
-            set_next_id(config, 0)
-            self.assertTupleEqual((1, "01Z9999"), get_next_id(config, devinfos))
+            counter_path.unlink(missing_ok=True)
             self.assertTupleEqual((1, "01Z9999"), get_next_id(config, devinfos))
             self.assertTupleEqual((1, "01Z9999"), get_next_id(config, devinfos))
+            set_next_id(config, 3)
+            self.assertTupleEqual((4, "01Z9999"), get_next_id(config, devinfos))
+            # the counter is never lowered
+            set_next_id(config, 2)
+            self.assertTupleEqual((4, "01Z9999"), get_next_id(config, devinfos))
@@ -40,7 +40,11 @@ def save_as_eml(path, message):
 
 def reception_date(message):
     """Returns localized mail date"""
-    date_str = message.get("date")
+    return localized_date(message.get("date"))
+
+
+def localized_date(date_str):
+    """Returns localized date from a mail date string"""
     r_date = u""
     if date_str:
         date_tuple = utils.parsedate_tz(date_str)
@@ -97,6 +101,21 @@ def get_reduced_size(size, max_size):
     return size_reduced, (new_width, new_height)
 
 
+def estimate_jpeg_quality(table):
+    """Estimate the quality a jpeg image was saved with, from its luminance quantization table (IJG scaling).
+
+    :param table: the 64 values of the luminance quantization table
+    :return: quality between 1 and 100
+    """
+    # sum of the standard luminance table, scaled by 5000 / quality under 50 and by 200 - 2 * quality above
+    scale = sum(table) * 100.0 / 3688
+    if scale <= 100:
+        quality = (200 - scale) / 2
+    else:
+        quality = 5000 / scale
+    return int(round(min(max(quality, 1), 100)))
+
+
 def get_unique_name(filename, files):
     """Get a filename and eventually rename it so it is unique in files list"""
     new_filename = filename
@@ -110,10 +129,12 @@ def get_unique_name(filename, files):
 
 
 def set_next_id(config, current_id):
-    """Set current id in counter file"""
+    """Set current id in counter file. The counter is never lowered: an external id is given only once."""
     ws = config["webservice"]
     client_id = "{0}Z{1}".format(ws["client_id"][:2], ws["client_id"][-4:])
     counter_dir = Path(ws["counter_dir"])
     next_id_path = counter_dir / client_id
+    if next_id_path.exists() and next_id_path.read_text() and int(next_id_path.read_text()) >= current_id:
+        return
     current_id_txt = str(current_id) if six.PY3 else str(current_id).decode()
     next_id_path.write_text(current_id_txt)